@@ -7,6 +7,7 @@ from proteomics.analysis.deg_analysis.base_args import (
     RunRMixin,
     RConfig,
 )
+from proteomics.analysis.io.tabular import TableFormat
 
 
 class LimmaArgs(DegAnalysisArgs):
@@ -20,6 +21,8 @@ class LimmaArgs(DegAnalysisArgs):
     - make_option(c("--contrast_name"), type = "character", help = "Name of the contrast"),
     - make_option(c("--contrast_1"), type = "character", help = "First group for contrast"),
     - make_option(c("--contrast_2"), type = "character", help = "Second group for contrast"),
+    - make_option(c("--table_format"), type = "character", default = "feather", help = "File format of the DEG table (feather or csv)"),
+    - make_option(c("--csv_copy"), type = "logical", default = FALSE, help = "Also write a csv copy of a feather DEG table")
 
     """
 
@@ -32,12 +35,21 @@ class LimmaArgs(DegAnalysisArgs):
     contrast_name: str = Field(..., description="Name of the contrast")
     contrast_1: str = Field(..., description="First group for contrast")
     contrast_2: str = Field(..., description="Second group for contrast")
+    table_format: TableFormat = Field(
+        "feather", description="File format of the DEG table"
+    )
+    csv_copy: bool = Field(
+        False, description="Also write a csv copy of a feather DEG table"
+    )
 
 
 class RunLimma(LimmaArgs, RunRMixin[Path]):
     def get_r_script(self) -> Path:
         return Path(__file__).parent / "limma.R"
 
+    def resource_class(self) -> str:
+        return "limma"
+
     def process_stdout(self, stdout: list[str]) -> Path | None:
         try:
             result_path = Path(stdout[-1].strip())
@@ -60,6 +72,8 @@ def run_limma_r(
     contrast_name: str,
     contrast_1: str,
     contrast_2: str,
+    fc_threshold: float = 1.5,
+    pval_threshold: float = 0.05,
 ) -> Path | None:
     limma = RunLimma(
         rscript_bin=r_config.rscript_bin,
@@ -70,6 +84,10 @@ def run_limma_r(
         contrast_name=contrast_name,
         contrast_1=contrast_1,
         contrast_2=contrast_2,
+        fc_threshold=fc_threshold,
+        pval_threshold=pval_threshold,
+        table_format=r_config.table_format,
+        csv_copy=r_config.csv_copy,
     )
 
     return limma.run_analysis()
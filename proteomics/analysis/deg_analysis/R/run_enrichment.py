@@ -41,6 +41,9 @@ class EnrichmentAnalysis(EnrichmentArgs, RunRDegAnalysis[list[EnrichResult]]):
     def get_r_script(self) -> Path:
         return Path(__file__).parent / "run_enrichment.R"
 
+    def resource_class(self) -> str:
+        return "enrichment"
+
     def process_stdout(self, stdout: str) -> list[EnrichResult]:
         results = []
 
@@ -74,15 +77,15 @@ def fix_result_for_excel(result: EnrichResult) -> None:
     df.to_csv(result.file_path, index=False)
 
 
-def run_enrichment_r(
+def make_enrichment_analysis(
     *,
     r_config: RConfig,
     output_dir: Path,
     deg_results: Path,
     experiment: str,
     enrichment_args: EnrichmentArgs,
-) -> list[EnrichResult]:
-    enrichment_analysis = EnrichmentAnalysis(
+) -> EnrichmentAnalysis:
+    return EnrichmentAnalysis(
         output_dir=output_dir,
         input_file=deg_results,
         rscript_bin=r_config.rscript_bin,
@@ -90,8 +93,11 @@ def run_enrichment_r(
         **enrichment_args.model_dump(),
     )
 
-    results: list[EnrichResult] = enrichment_analysis.run_analysis()
 
+def fix_enrichment_results(results: list[EnrichResult]) -> list[EnrichResult]:
+    """
+    Fixes the tables of an EnrichmentAnalysis for excel.
+    """
     for result in results:
         if (result.result_type == "enrichResult") or (
             result.result_type == "compareResult"
@@ -101,6 +107,27 @@ def run_enrichment_r(
     return results
 
 
+def run_enrichment_r(
+    *,
+    r_config: RConfig,
+    output_dir: Path,
+    deg_results: Path,
+    experiment: str,
+    enrichment_args: EnrichmentArgs,
+) -> list[EnrichResult]:
+    enrichment_analysis = make_enrichment_analysis(
+        r_config=r_config,
+        output_dir=output_dir,
+        deg_results=deg_results,
+        experiment=experiment,
+        enrichment_args=enrichment_args,
+    )
+
+    results: list[EnrichResult] = enrichment_analysis.run_analysis()
+
+    return fix_enrichment_results(results)
+
+
 def main():
     r_config = RConfig(
         rscript_bin="/Users/ac4294/.pyenv/versions/miniforge3-24.11.3-0/envs/liver_prot_s2808d_2025/bin/Rscript"
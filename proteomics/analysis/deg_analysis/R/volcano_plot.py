@@ -18,6 +18,9 @@ class VolcanoPlot(VolcanoArgs, RunRDegAnalysis[Path]):
     def get_r_script(self) -> Path:
         return Path(__file__).parent / "volcano-plot.R"
 
+    def resource_class(self) -> str:
+        return "plot"
+
     def process_stdout(self, stdout: str) -> Path | None:
         try:
             cleaned_string = re.sub(r"^\[\d+]\s*", "", stdout[-1].strip())
@@ -35,15 +38,15 @@ class VolcanoPlot(VolcanoArgs, RunRDegAnalysis[Path]):
         return volcano_png
 
 
-def run_volcano_plot_r(
+def make_volcano_plot(
     *,
     r_config: RConfig,
     output_dir: Path,
     deg_results: Path,
     experiment: str,
     volcano_args: VolcanoArgs,
-) -> Path | None:
-    volcano_plot = VolcanoPlot(
+) -> VolcanoPlot:
+    return VolcanoPlot(
         output_dir=output_dir,
         input_file=deg_results,
         rscript_bin=r_config.rscript_bin,
@@ -51,6 +54,23 @@ def run_volcano_plot_r(
         **volcano_args.model_dump(),
     )
 
+
+def run_volcano_plot_r(
+    *,
+    r_config: RConfig,
+    output_dir: Path,
+    deg_results: Path,
+    experiment: str,
+    volcano_args: VolcanoArgs,
+) -> Path | None:
+    volcano_plot = make_volcano_plot(
+        r_config=r_config,
+        output_dir=output_dir,
+        deg_results=deg_results,
+        experiment=experiment,
+        volcano_args=volcano_args,
+    )
+
     return volcano_plot.run_analysis()
 
 
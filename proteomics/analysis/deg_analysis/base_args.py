@@ -1,10 +1,22 @@
 import abc
-from typing import TypeVar
+from contextlib import contextmanager
+from typing import Iterator, TypeVar
 
 from pydantic import BaseModel, Field, FilePath, DirectoryPath
 
+from proteomics.analysis.io.tabular import TableFormat
 from proteomics.utils.base_params import BaseParams
-from proteomics.utils.run_r import RunRMixin
+from proteomics.utils.r_worker import DEFAULT_PRELOAD, RWorkerPool
+from proteomics.utils.resources import ResourceLimits
+from proteomics.utils.run_r import (
+    RunRMixin,
+    get_r_worker_pool,
+    use_r_limits,
+    use_r_memo,
+    use_r_timeout,
+    use_r_worker_pool,
+)
+from proteomics.utils.slots import SlotParams, use_slots
 
 __all__ = [
     "DegAnalysisArgs",
@@ -12,6 +24,7 @@ __all__ = [
     "RDegPlotArgs",
     "RConfig",
     "RunRDegAnalysis",
+    "r_session",
 ]
 
 
@@ -62,6 +75,82 @@ class RDegPlotArgs(DegPlotArgs):
 
 class RConfig(BaseParams):
     rscript_bin: FilePath = "/opt/conda/bin/Rscript"
+    worker_pool_size: int = Field(
+        0,
+        description="Number of long lived R workers with the libraries "
+        "preloaded. 0 starts a new Rscript for every analysis.",
+    )
+    worker_preload: list[str] = Field(
+        DEFAULT_PRELOAD,
+        description="The R packages the workers load at startup",
+    )
+    table_format: TableFormat = Field(
+        "feather",
+        description="File format of the count, metadata and DEG tables "
+        "passed between the python steps and the R scripts",
+    )
+    csv_copy: bool = Field(
+        False,
+        description="Also write a csv copy of every feather table",
+    )
+    memoize: bool = Field(
+        False,
+        description="Replay the outputs of an R script that ran before with "
+        "the same script, arguments and input files",
+    )
+    timeout: float | None = Field(
+        None,
+        description="Seconds after which an R script is stopped. "
+        "None waits until it finishes.",
+    )
+    limits: ResourceLimits = Field(
+        ResourceLimits(),
+        description="Memory and CPU caps of every R script",
+    )
+    slots: SlotParams = Field(
+        SlotParams(),
+        description="How many R scripts of each resource class run at once "
+        "on a node, across tasks",
+    )
+
+
+@contextmanager
+def r_session(r_config: RConfig, *, pool: bool = True) -> Iterator[None]:
+    """
+    Runs the R analyses inside the context on a worker pool if
+    r_config.worker_pool_size is set, memoized if r_config.memoize is set.
+    Scripts started outside the pool are stopped after r_config.timeout
+    and capped by r_config.limits. Every script waits for a slot of its
+    resource class, see r_config.slots.
+
+    The pool of an outer r_session is reused, a new one is only started
+    for the first session of a process.
+
+    Args:
+        pool: False never starts a pool, e.g. for a task that runs a
+            single R script, which would only pay for the preload
+    """
+    with (
+        use_r_memo(r_config.memoize),
+        use_r_timeout(r_config.timeout),
+        use_r_limits(r_config.limits),
+        use_slots(r_config.slots),
+    ):
+        if (
+            not pool
+            or r_config.worker_pool_size < 1
+            or get_r_worker_pool() is not None
+        ):
+            yield
+            return
+
+        with RWorkerPool(
+            r_config.rscript_bin,
+            size=r_config.worker_pool_size,
+            preload=r_config.worker_preload,
+        ) as pool:
+            with use_r_worker_pool(pool):
+                yield
 
 
 RResultType = TypeVar("RResultType")
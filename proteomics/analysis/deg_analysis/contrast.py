@@ -0,0 +1,294 @@
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import get_context
+from pathlib import Path
+from typing import NamedTuple
+
+from pydantic import Field
+
+from proteomics.analysis.deg_analysis.R.limma import run_limma_r
+from proteomics.analysis.deg_analysis.R.run_enrichment import EnrichmentArgs
+from proteomics.analysis.deg_analysis.R.volcano_plot import VolcanoArgs
+from proteomics.analysis.deg_analysis.base_args import RConfig, r_session
+from proteomics.analysis.deg_analysis.heatmap import MakeHeatmapOtherKwargs
+from proteomics.analysis.deg_analysis.limma import LimmaParams, run_limma_py
+from proteomics.analysis.deg_analysis.post_deg import (
+    PostDegResults,
+    run_post_deg,
+)
+from proteomics.analysis.preprocess.export_limma import LimmaInputs
+from proteomics.utils.base_params import BaseParams
+from proteomics.utils.render import RenderParams
+from proteomics.utils.stage_cache import StageCache
+
+__all__ = [
+    "ExecutionParams",
+    "ContrastRun",
+    "limma_output_files",
+    "fit_contrast",
+    "run_contrast",
+    "make_batches",
+    "run_contrasts",
+]
+
+
+class ExecutionParams(BaseParams):
+    fused: bool = False
+    """
+    Run the heatmap, volcano plot, enrichment and KEGG id fix of a contrast
+    in the task that ran limma, instead of a task for each of them
+    """
+    batches: int = Field(
+        0,
+        description="Split the contrasts into this many tasks, each running "
+        "its contrasts fused on a local process pool. Set it to the "
+        "--max-workers of the run. 0 runs a task per contrast.",
+    )
+    batch_workers: int | None = Field(
+        None,
+        description="Processes of the pool in a batch task. None uses the "
+        "CPUs of the node divided by batches.",
+    )
+
+    @property
+    def mode(self) -> str:
+        """
+        The branch of the flow after export_limma_contrasts.
+        """
+        if self.batches > 0:
+            return "batched"
+        return "fused" if self.fused else "split"
+
+    def workers_per_batch(self) -> int:
+        if self.batch_workers is not None:
+            return self.batch_workers
+        return max(1, (os.cpu_count() or 1) // max(1, self.batches))
+
+
+class ContrastRun(NamedTuple):
+    """
+    The outputs of limma and the steps after it for one contrast.
+    """
+
+    limma_input: LimmaInputs
+    result_path: Path | None
+    post_deg: PostDegResults | None
+
+
+def limma_output_files(results_dir: Path, contrast_name: str) -> list[Path]:
+    return [
+        file
+        for stub in ("limma_outputs", "limma_sig_results")
+        for file in (results_dir / contrast_name / stub).glob("*")
+    ]
+
+
+def _fit(
+    limma_input: LimmaInputs,
+    *,
+    results_dir: Path,
+    limma: LimmaParams,
+    r_config: RConfig,
+) -> Path | None:
+    contrast_dir = results_dir / limma_input.contrast_name
+    output_dir = contrast_dir / "limma_outputs"
+    sig_output_dir = contrast_dir / "limma_sig_results"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    sig_output_dir.mkdir(parents=True, exist_ok=True)
+
+    limma_kwargs = dict(
+        output_dir=output_dir,
+        sig_output_dir=sig_output_dir,
+        contrast_name=limma_input.contrast_name,
+        contrast_1=limma_input.contrast_1,
+        contrast_2=limma_input.contrast_2,
+        fc_threshold=limma.fc_threshold,
+        pval_threshold=limma.pval_threshold,
+    )
+
+    if limma.engine == "python":
+        return run_limma_py(
+            counts=limma_input.counts(),
+            metadata=limma_input.metadata(),
+            table_format=r_config.table_format,
+            csv_copy=r_config.csv_copy,
+            **limma_kwargs,
+        )
+
+    # limma.R reads the contrast from files
+    counts_file, metadata_file = limma_input.write_files(
+        results_dir / "limma_inputs",
+        table_format=r_config.table_format,
+        csv_copy=r_config.csv_copy,
+    )
+    # the R worker pool, if any, is the one of the process
+    with r_session(r_config, pool=False):
+        return run_limma_r(
+            r_config=r_config,
+            counts=counts_file,
+            metadata=metadata_file,
+            **limma_kwargs,
+        )
+
+
+def fit_contrast(
+    limma_input: LimmaInputs,
+    *,
+    results_dir: Path,
+    limma: LimmaParams,
+    r_config: RConfig,
+    limma_cache: StageCache | None = None,
+) -> Path | None:
+    """
+    Runs limma for one contrast into results_dir/<contrast>, or restores it
+    from limma_cache.
+
+    Returns: The DEG table, None if limma failed
+    """
+    if limma_cache is not None:
+        cached = limma_cache.load(results_dir)
+        if cached:
+            return (
+                results_dir / cached["result_path"]
+                if cached["result_path"]
+                else None
+            )
+
+    result_path = _fit(
+        limma_input, results_dir=results_dir, limma=limma, r_config=r_config
+    )
+
+    if limma_cache is not None:
+        limma_cache.save(
+            results_dir,
+            limma_output_files(results_dir, limma_input.contrast_name),
+            result_path=result_path.relative_to(results_dir)
+            if result_path
+            else None,
+        )
+
+    return result_path
+
+
+def run_contrast(
+    limma_input: LimmaInputs,
+    *,
+    results_dir: Path,
+    limma: LimmaParams,
+    r_config: RConfig,
+    heatmap: MakeHeatmapOtherKwargs,
+    volcano: VolcanoArgs,
+    enrich: EnrichmentArgs,
+    limma_cache: StageCache | None = None,
+    result_path: Path | None = None,
+    render: RenderParams = RenderParams(),
+) -> ContrastRun:
+    """
+    limma and every step after it for one contrast, into the same
+    directories as the steps of the flow. Starts an R worker pool for the
+    contrast unless the caller already has one.
+
+    Args:
+        result_path: The DEG table if limma already ran, e.g. with
+            multi_contrast
+    """
+    with r_session(r_config):
+        if result_path is None:
+            result_path = fit_contrast(
+                limma_input,
+                results_dir=results_dir,
+                limma=limma,
+                r_config=r_config,
+                limma_cache=limma_cache,
+            )
+
+        if not result_path:
+            print(f"No DEG result for {limma_input.contrast_name}")
+            return ContrastRun(limma_input, None, None)
+
+        post_deg = run_post_deg(
+            limma_input=limma_input,
+            result_path=result_path,
+            contrast_dir=results_dir / limma_input.contrast_name,
+            r_config=r_config,
+            heatmap=heatmap,
+            volcano=volcano,
+            enrich=enrich,
+            render=render,
+        )
+
+    return ContrastRun(limma_input, result_path, post_deg)
+
+
+def make_batches(
+    limma_inputs: list[LimmaInputs], batches: int
+) -> list[list[LimmaInputs]]:
+    """
+    Deals the contrasts round robin into at most batches non-empty lists.
+    """
+    n_batches = max(1, min(batches, len(limma_inputs)))
+    return [limma_inputs[i::n_batches] for i in range(n_batches)]
+
+
+def _run_contrast_kwargs(kwargs: dict) -> ContrastRun:
+    return run_contrast(**kwargs)
+
+
+def _open_r_session(r_config: RConfig) -> None:
+    """
+    Initializer of the contrast pool: one R session, and worker pool, for
+    all the contrasts of the process, closed when the process exits.
+    """
+    stack = ExitStack()
+    stack.enter_context(r_session(r_config))
+    atexit.register(stack.close)
+
+
+def run_contrasts(
+    limma_inputs: list[LimmaInputs],
+    *,
+    max_workers: int,
+    limma_caches: dict[str, StageCache] | None = None,
+    result_paths: dict[str, Path] | None = None,
+    **kwargs,
+) -> list[ContrastRun]:
+    """
+    run_contrast for every contrast, on a pool of max_workers processes.
+    Every process starts one R worker pool (r_config.worker_pool_size) for
+    all of its contrasts.
+
+    Args:
+        limma_caches: The limma stage cache of each contrast
+        result_paths: The DEG table of each contrast that already ran limma
+        kwargs: The other arguments of run_contrast
+
+    Returns: The runs in the order of limma_inputs
+    """
+    jobs = [
+        dict(
+            limma_input=limma_input,
+            limma_cache=(limma_caches or {}).get(limma_input.contrast_name),
+            result_path=(result_paths or {}).get(limma_input.contrast_name),
+            **kwargs,
+        )
+        for limma_input in limma_inputs
+    ]
+
+    if not jobs:
+        return []
+
+    if max_workers <= 1 or len(jobs) <= 1:
+        with r_session(kwargs["r_config"]):
+            return [_run_contrast_kwargs(job) for job in jobs]
+
+    # spawn, the task may have threads and matplotlib state that do not
+    # survive a fork
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(jobs)),
+        mp_context=get_context("spawn"),
+        initializer=_open_r_session,
+        initargs=(kwargs["r_config"],),
+    ) as executor:
+        return list(executor.map(_run_contrast_kwargs, jobs))
@@ -0,0 +1,136 @@
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from proteomics.analysis.io.tabular import read_table, write_table
+
+__all__ = [
+    "LFC_COLUMN",
+    "PVAL_COLUMN",
+    "deg_index_file",
+    "DegResults",
+]
+
+LFC_COLUMN = "logFC"
+PVAL_COLUMN = "adj.P.Val"
+
+
+def deg_index_file(deg_file: Path) -> Path:
+    """
+    <table>_index.<format>, next to the DEG table. Same as deg_index_file
+    in deg_table.R.
+    """
+    deg_file = Path(deg_file)
+    return deg_file.with_name(f"{deg_file.stem}_index{deg_file.suffix}")
+
+
+class DegResults(NamedTuple):
+    """
+    A DEG table written by limma.R or the python limma engine, with the
+    row positions sorted by p-value and by |logFC| (largest first). limma
+    writes both orders to deg_index_file when it writes the table, so the
+    significant genes for any pair of thresholds are found by binary search
+    on both without sorting the table again. The table itself is left as
+    limma wrote it.
+    """
+
+    table: pd.DataFrame
+    pval_order: np.ndarray
+    lfc_order: np.ndarray
+    lfc_column: str = LFC_COLUMN
+    pval_column: str = PVAL_COLUMN
+
+    @classmethod
+    def index(
+        cls,
+        table: pd.DataFrame,
+        *,
+        lfc_column: str = LFC_COLUMN,
+        pval_column: str = PVAL_COLUMN,
+    ) -> "DegResults":
+        # missing p-values sort last and never pass a threshold
+        return cls(
+            table,
+            np.argsort(table[pval_column].to_numpy(), kind="stable"),
+            np.argsort(-table[lfc_column].abs().to_numpy(), kind="stable"),
+            lfc_column,
+            pval_column,
+        )
+
+    @classmethod
+    def read(
+        cls,
+        deg_file: Path,
+        *,
+        lfc_column: str = LFC_COLUMN,
+        pval_column: str = PVAL_COLUMN,
+    ) -> "DegResults":
+        """
+        Reads the table and its stored orders. Tables without an index
+        file, or other columns than logFC and adj.P.Val, are sorted here.
+        """
+        table = read_table(deg_file, index_col=0)
+        index_file = deg_index_file(deg_file)
+        if (
+            lfc_column == LFC_COLUMN
+            and pval_column == PVAL_COLUMN
+            and index_file.exists()
+        ):
+            index = read_table(index_file)
+            if len(index) == len(table):
+                return cls(
+                    table,
+                    index["pval_order"].to_numpy(),
+                    index["lfc_order"].to_numpy(),
+                )
+
+        return cls.index(
+            table, lfc_column=lfc_column, pval_column=pval_column
+        )
+
+    def write_index(self, deg_file: Path) -> Path:
+        """
+        Writes the orders next to the DEG table, in the same format.
+        """
+        return write_table(
+            pd.DataFrame(
+                {"pval_order": self.pval_order, "lfc_order": self.lfc_order}
+            ),
+            deg_index_file(deg_file),
+            index=False,
+        )
+
+    def significant_positions(
+        self, fc_threshold: float, pval_threshold: float
+    ) -> np.ndarray:
+        """
+        The positions of the rows with pval < pval_threshold and
+        |lfc| >= log2(fc_threshold), in table order.
+        """
+        lfc = self.table[self.lfc_column].to_numpy()
+        pval = self.table[self.pval_column].to_numpy()
+
+        n_pval = np.searchsorted(
+            pval[self.pval_order], pval_threshold, side="left"
+        )
+        n_lfc = np.searchsorted(
+            -np.abs(lfc[self.lfc_order]),
+            -np.log2(fc_threshold),
+            side="right",
+        )
+
+        return np.intersect1d(
+            self.pval_order[:n_pval], self.lfc_order[:n_lfc]
+        )
+
+    def significant(
+        self, fc_threshold: float, pval_threshold: float
+    ) -> pd.DataFrame:
+        """
+        The significant genes, in table order.
+        """
+        return self.table.iloc[
+            self.significant_positions(fc_threshold, pval_threshold)
+        ]
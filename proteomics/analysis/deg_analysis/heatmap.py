@@ -1,13 +1,19 @@
 from pathlib import Path
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 
-import numpy as np
 import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
 from matplotlib.colors import Colormap
 from pydantic import BaseModel
 
+from proteomics.analysis.deg_analysis.deg_results import DegResults
+from proteomics.utils.render import render
+
+if TYPE_CHECKING:
+    from seaborn.matrix import ClusterGrid
+
+# seaborn and pyplot are imported by the functions that plot, they take
+# seconds to import and the params of this module are needed by every step
+
 
 def create_category_colors(
     *,
@@ -83,7 +89,7 @@ def make_heatmap(
     cbar_label: str = "Abundance",
     figsize: tuple[float, float] = None,
     dendrogram_ratio: tuple[float, float] = None,
-) -> sns.matrix.ClusterGrid:
+) -> "ClusterGrid":
     """
     Creates a heatmap of the DE genes from a limma/deseq2 analysis.
 
@@ -113,6 +119,9 @@ def make_heatmap(
 
     Returns: The heatmap figure.
     """
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     colors = create_category_colors(
         metadata_df=metadata_df,
         sample_col=sample_col,
@@ -184,50 +193,22 @@ def make_heatmap(
     return fig
 
 
-def make_heatmap_sample(
+def save_heatmap(
     *,
-    counts_file: Path,
-    metadata_file: Path,
-    limma_results_file: Path,
+    counts_df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    sig_limma_results: pd.DataFrame,
     output_dir: Path,
-    fc_cutoff: float = 1.5,
-    pval_cutoff: float = 0.05,
-    # kwargs for make_heatmap
     make_heatmap_kwargs: MakeHeatmapOtherKwargs,
 ) -> Path:
     """
-    Creates the heatmap, returns the figure. Writes the figure, the DE matrix,
-    and whatever seaborn plots to the output directory.
-
-    Args:
-        output_dir: The output directory.
-        counts_file: The counts file.
-        metadata_file: The metadata file.
-        limma_results_file: The limma results file.
-        fc_cutoff: The fold change cutoff.
-        pval_cutoff: The p-value cutoff.
-        make_heatmap_kwargs: The kwargs for :py:func:`make_heatmap`.
+    Draws the heatmap of make_heatmap_sample and writes it as PDF and PNG
+    with the clustered matrix (data2d.csv), for the render pool.
 
     Returns: The figure path.
     """
-
-    if not output_dir.exists():
-        raise FileNotFoundError(
-            f"Output directory {output_dir} does not exist."
-        )
-
-    counts_df = pd.read_csv(counts_file, index_col=0)
-    metadata_df = pd.read_csv(metadata_file)
-    limma_results = pd.read_csv(limma_results_file, index_col=0)
-
-    log_fc = np.log2(fc_cutoff)
-
-    sig_limma_results = limma_results[
-        (limma_results["logFC"].abs() >= log_fc)
-        & (limma_results["adj.P.Val"] <= pval_cutoff)
-    ]
-
-    print(f"Found {len(sig_limma_results)} significant genes.")
+    import seaborn as sns
+    from matplotlib import pyplot as plt
 
     default_kwargs = {
         "category_colors": sns.color_palette(
@@ -256,10 +237,63 @@ def make_heatmap_sample(
     for fmt in ["pdf", "png"]:
         cluster_fig.savefig(output_dir / f"heatmap.{fmt}", bbox_inches="tight")
 
-    print("Saving DE matrix...")
-    counts_df.loc[sig_limma_results.index].to_csv(output_dir / "de_matrix.csv")
     cluster_fig.data2d.to_csv(output_dir / "data2d.csv")
 
     plt.close()
 
     return output_dir / "heatmap.png"
+
+
+def make_heatmap_sample(
+    *,
+    counts_df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    limma_results_file: Path,
+    output_dir: Path,
+    fc_cutoff: float = 1.5,
+    pval_cutoff: float = 0.05,
+    # kwargs for make_heatmap
+    make_heatmap_kwargs: MakeHeatmapOtherKwargs,
+) -> Path | None:
+    """
+    Writes the DE matrix to the output directory and draws the heatmap with
+    render (see proteomics.utils.render) into it.
+
+    Args:
+        output_dir: The output directory.
+        counts_df: The counts of the contrast.
+        metadata_df: The Sample / Group table of the contrast.
+        limma_results_file: The limma results file.
+        fc_cutoff: The fold change cutoff.
+        pval_cutoff: The p-value cutoff.
+        make_heatmap_kwargs: The kwargs for :py:func:`make_heatmap`.
+
+    Returns: The figure path, written when the renders are done. None with
+        the figures off.
+    """
+    if not output_dir.exists():
+        raise FileNotFoundError(
+            f"Output directory {output_dir} does not exist."
+        )
+
+    sig_limma_results = DegResults.read(limma_results_file).significant(
+        fc_cutoff, pval_cutoff
+    )
+
+    print(f"Found {len(sig_limma_results)} significant genes.")
+
+    print("Saving DE matrix...")
+    de_counts = counts_df.loc[sig_limma_results.index]
+    de_counts.to_csv(output_dir / "de_matrix.csv")
+
+    heatmap = render(
+        save_heatmap,
+        # only the significant genes are sent to the render pool
+        counts_df=de_counts,
+        metadata_df=metadata_df,
+        sig_limma_results=sig_limma_results,
+        output_dir=output_dir,
+        make_heatmap_kwargs=make_heatmap_kwargs,
+    )
+
+    return output_dir / "heatmap.png" if heatmap is not None else None
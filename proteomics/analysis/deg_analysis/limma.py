@@ -0,0 +1,630 @@
+from pathlib import Path
+from typing import Literal, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pydantic import Field, model_validator
+
+from proteomics.analysis.deg_analysis.base_args import DegAnalysisArgs
+from proteomics.analysis.deg_analysis.deg_results import DegResults
+from proteomics.analysis.io.load_metadata import Contrast, MetadataMaps
+from proteomics.analysis.io.tabular import (
+    TableFormat,
+    table_file,
+    write_table,
+)
+from proteomics.analysis.io.workbook import WorkbookSession
+from proteomics.analysis.preprocess.export_limma import load_contrast_genes
+
+__all__ = [
+    "LimmaParams",
+    "LimmaFit",
+    "EBayesFit",
+    "make_design",
+    "lm_fit",
+    "contrasts_fit",
+    "e_bayes",
+    "top_table",
+    "fit_limma",
+    "fit_limma_contrasts",
+    "run_limma_py",
+    "run_limma_contrasts_py",
+    "write_significant_genes",
+]
+
+class LimmaParams(DegAnalysisArgs):
+    """
+    Selects how the limma analysis is run.
+    """
+
+    engine: Literal["R", "python"] = Field(
+        "R",
+        description="Run limma with Rscript (R) or with the numpy port "
+        "in this module (python)",
+    )
+    multi_contrast: bool = Field(
+        False,
+        description="Fit the design of all samples once and apply every "
+        "contrast from it. Only supported by the python engine.",
+    )
+
+    @model_validator(mode="after")
+    def check_multi_contrast_engine(self) -> "LimmaParams":
+        if self.multi_contrast and self.engine != "python":
+            raise ValueError("multi_contrast requires the python engine")
+        return self
+
+
+class LimmaFit(NamedTuple):
+    """
+    The fields of an MArrayLM object that are needed for eBayes.
+    All per gene arrays have the genes in the rows.
+    """
+
+    coefficients: np.ndarray
+    stdev_unscaled: np.ndarray
+    sigma: np.ndarray
+    df_residual: np.ndarray
+    amean: np.ndarray
+    cov_coefficients: np.ndarray
+    coef_names: list[str]
+
+
+class EBayesFit(NamedTuple):
+    fit: LimmaFit
+    df_prior: float
+    s2_prior: float
+    s2_post: np.ndarray
+    df_total: np.ndarray
+    t: np.ndarray
+    p_value: np.ndarray
+    lods: np.ndarray
+
+
+def make_design(groups: list[str]) -> tuple[np.ndarray, list[str]]:
+    """
+    The numpy version of model.matrix(~0 + groups). Levels are sorted like
+    the levels of an R factor.
+    """
+    levels = sorted(set(groups))
+    design = np.array(
+        [
+            [1.0 if group == level else 0.0 for level in levels]
+            for group in groups
+        ]
+    )
+    return design, levels
+
+
+def lm_fit(
+    expr: np.ndarray, design: np.ndarray, coef_names: list[str]
+) -> LimmaFit:
+    """
+    Fits every gene (row of expr) to the design at once. Equivalent to
+    limma::lmFit for a full rank matrix without missing values or weights.
+    """
+    n_samples, n_coef = design.shape
+    if expr.shape[1] != n_samples:
+        raise ValueError(
+            "Number of columns in expr does not match the rows in the design"
+        )
+    if np.isnan(expr).any():
+        raise ValueError("There are missing values in the data.")
+
+    q, r = np.linalg.qr(design)
+    if np.linalg.matrix_rank(r) < n_coef:
+        raise ValueError("The design matrix is not full rank")
+
+    r_inv = np.linalg.inv(r)
+    # (genes x samples) @ (samples x coef) -> (genes x coef)
+    coefficients = (expr @ q) @ r_inv.T
+    residuals = expr - coefficients @ design.T
+
+    df_residual = n_samples - n_coef
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma = np.sqrt((residuals**2).sum(axis=1) / df_residual)
+
+    cov_coefficients = r_inv @ r_inv.T
+    stdev_unscaled = np.broadcast_to(
+        np.sqrt(np.diag(cov_coefficients)), coefficients.shape
+    ).copy()
+
+    return LimmaFit(
+        coefficients=coefficients,
+        stdev_unscaled=stdev_unscaled,
+        sigma=sigma,
+        df_residual=np.full(expr.shape[0], float(df_residual)),
+        amean=expr.mean(axis=1),
+        cov_coefficients=cov_coefficients,
+        coef_names=coef_names,
+    )
+
+
+def contrasts_fit(
+    fit: LimmaFit, contrasts: np.ndarray, contrast_names: list[str]
+) -> LimmaFit:
+    """
+    limma::contrasts.fit. contrasts is a (coef x contrast) matrix.
+    """
+    cov_coefficients = contrasts.T @ fit.cov_coefficients @ contrasts
+
+    return fit._replace(
+        coefficients=fit.coefficients @ contrasts,
+        stdev_unscaled=np.broadcast_to(
+            np.sqrt(np.diag(cov_coefficients)),
+            (fit.coefficients.shape[0], contrasts.shape[1]),
+        ).copy(),
+        cov_coefficients=cov_coefficients,
+        coef_names=contrast_names,
+    )
+
+
+def _trigamma_inverse(x: float) -> float:
+    """
+    limma::trigammaInverse. Newton iteration for the inverse of trigamma.
+    """
+    from scipy import special
+
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / special.polygamma(2, y)
+        y = y + dif
+        if -dif / y < 1e-8:
+            break
+    else:
+        print("Warning: iteration limit exceeded in trigamma inverse")
+
+    return y
+
+
+def _fit_f_dist(x: np.ndarray, df1: np.ndarray) -> tuple[float, float]:
+    """
+    limma::fitFDist without covariates. Returns the scale (s2_prior) and
+    the prior degrees of freedom (df_prior).
+    """
+    from scipy import special
+
+    ok = np.isfinite(df1) & (df1 > 1e-15) & np.isfinite(x) & (x > -1e-15)
+    x = x[ok]
+    df1 = df1[ok]
+    if len(x) < 2:
+        return np.nan, np.nan
+
+    x = np.maximum(x, 0)
+    m = np.median(x)
+    if m == 0:
+        print("Warning: more than half of residual variances are exactly zero")
+        m = 1
+    x = np.maximum(x, 1e-5 * m)
+
+    z = np.log(x)
+    e = z - special.digamma(df1 / 2) + np.log(df1 / 2)
+    emean = e.mean()
+    evar = ((e - emean) ** 2).sum() / (len(x) - 1)
+    evar = evar - special.polygamma(1, df1 / 2).mean()
+
+    if evar > 0:
+        df2 = 2 * _trigamma_inverse(evar)
+        s20 = np.exp(emean + special.digamma(df2 / 2) - np.log(df2 / 2))
+    else:
+        df2 = np.inf
+        s20 = np.exp(emean)
+
+    return s20, df2
+
+
+def _tmixture(
+    tstat: np.ndarray,
+    stdev_unscaled: np.ndarray,
+    df: np.ndarray,
+    proportion: float,
+    v0_lim: tuple[float, float],
+) -> float:
+    """
+    limma::tmixture.vector. Estimates the prior variance of the
+    coefficients of the differentially expressed genes.
+    """
+    from scipy import stats
+
+    ok = np.isfinite(tstat)
+    tstat = np.abs(tstat[ok])
+    stdev_unscaled = stdev_unscaled[ok]
+    df = df[ok]
+
+    n_genes = len(tstat)
+    n_target = int(np.ceil(proportion / 2 * n_genes))
+    if n_target < 1:
+        return np.nan
+
+    p = max(n_target / n_genes, proportion)
+
+    max_df = df[np.isfinite(df)].max()
+    # the genes with fewer residual df are moved to max_df
+    low = df < max_df
+    if low.any():
+        tstat[low] = stats.t.isf(stats.t.sf(tstat[low], df[low]), max_df)
+        df = np.where(low, max_df, df)
+
+    order = np.argsort(-tstat, kind="stable")[:n_target]
+    tstat = tstat[order]
+    v1 = stdev_unscaled[order] ** 2
+    df = df[order]
+
+    r = np.arange(1, n_target + 1)
+    p0 = 2 * stats.t.sf(tstat, df)
+    ptarget = ((r - 0.5) / n_genes - (1 - p) * p0) / p
+
+    v0 = np.zeros(n_target)
+    pos = ptarget > p0
+    if pos.any():
+        q_target = stats.t.isf(ptarget[pos] / 2, df[pos])
+        v0[pos] = v1[pos] * ((tstat[pos] / q_target) ** 2 - 1)
+
+    v0 = np.clip(v0, v0_lim[0], v0_lim[1])
+    return v0.mean()
+
+
+def e_bayes(
+    fit: LimmaFit,
+    proportion: float = 0.01,
+    stdev_coef_lim: tuple[float, float] = (0.1, 4),
+) -> EBayesFit:
+    """
+    limma::eBayes with the default arguments (no trend, not robust).
+    """
+    # scipy.stats takes a second to import, the params of this module are
+    # needed by every step
+    from scipy import stats
+
+    s2 = fit.sigma**2
+    s2_prior, df_prior = _fit_f_dist(s2, fit.df_residual)
+
+    if np.isinf(df_prior):
+        s2_post = np.full_like(s2, s2_prior)
+    else:
+        s2_post = (fit.df_residual * s2 + df_prior * s2_prior) / (
+            fit.df_residual + df_prior
+        )
+
+    df_pooled = fit.df_residual[np.isfinite(fit.df_residual)].sum()
+    df_total = np.minimum(fit.df_residual + df_prior, df_pooled)
+
+    t = fit.coefficients / fit.stdev_unscaled / np.sqrt(s2_post)[:, None]
+    p_value = 2 * stats.t.sf(np.abs(t), df_total[:, None])
+
+    # B-statistic
+    var_prior_lim = (
+        stdev_coef_lim[0] ** 2 / s2_prior,
+        stdev_coef_lim[1] ** 2 / s2_prior,
+    )
+    var_prior = np.array(
+        [
+            _tmixture(
+                t[:, j],
+                fit.stdev_unscaled[:, j],
+                df_total,
+                proportion,
+                var_prior_lim,
+            )
+            for j in range(t.shape[1])
+        ]
+    )
+    if np.isnan(var_prior).any():
+        var_prior[np.isnan(var_prior)] = 1 / s2_prior
+        print("Warning: estimation of var.prior failed - set to default value")
+
+    r = (fit.stdev_unscaled**2 + var_prior) / fit.stdev_unscaled**2
+    t2 = t**2
+    df_total_col = df_total[:, None]
+    if df_prior > 1e6:
+        kernel = t2 * (1 - 1 / r) / 2
+    else:
+        kernel = (
+            (1 + df_total_col)
+            / 2
+            * np.log((t2 + df_total_col) / (t2 / r + df_total_col))
+        )
+    lods = np.log(proportion / (1 - proportion)) - np.log(r) / 2 + kernel
+
+    return EBayesFit(
+        fit=fit,
+        df_prior=df_prior,
+        s2_prior=s2_prior,
+        s2_post=s2_post,
+        df_total=df_total,
+        t=t,
+        p_value=p_value,
+        lods=lods,
+    )
+
+
+def _p_adjust_bh(p: np.ndarray) -> np.ndarray:
+    """
+    p.adjust(p, method = "BH")
+    """
+    n = len(p)
+    order = np.argsort(p, kind="stable")[::-1]
+    ranks = np.arange(n, 0, -1)
+    adjusted = np.minimum.accumulate(p[order] * n / ranks)
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+def top_table(
+    ebayes: EBayesFit, coef: int | str, genes: pd.Index
+) -> pd.DataFrame:
+    """
+    topTable(fit, coef = coef, number = Inf). The output is sorted by the
+    B-statistic like limma does by default.
+    """
+    if isinstance(coef, str):
+        coef = ebayes.fit.coef_names.index(coef)
+
+    p_value = ebayes.p_value[:, coef]
+    table = pd.DataFrame(
+        {
+            "logFC": ebayes.fit.coefficients[:, coef],
+            "AveExpr": ebayes.fit.amean,
+            "t": ebayes.t[:, coef],
+            "P.Value": p_value,
+            "adj.P.Val": _p_adjust_bh(p_value),
+            "B": ebayes.lods[:, coef],
+        },
+        index=genes,
+    )
+
+    return table.iloc[np.argsort(-table["B"].to_numpy(), kind="stable")]
+
+
+def fit_limma(
+    counts_df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    contrast_name: str,
+    contrast_1: str,
+    contrast_2: str,
+    *,
+    sample_col: str = "Sample",
+    group_col: str = "Group",
+) -> pd.DataFrame:
+    """
+    Same as fit_limma in limma.R: fits ~0 + Group and returns the topTable
+    for contrast_1 - contrast_2.
+    """
+    if not metadata_df[sample_col].isin(counts_df.columns).all():
+        raise ValueError("Not all metadata samples are in the count matrix")
+
+    if metadata_df[group_col].nunique() != 2:
+        raise ValueError("Number of groups in metadata is not equal to 2")
+
+    group_of = dict(zip(metadata_df[sample_col], metadata_df[group_col]))
+
+    return fit_limma_contrasts(
+        counts_df,
+        [group_of[s] for s in counts_df.columns],
+        {contrast_name: (contrast_1, contrast_2)},
+    )[contrast_name]
+
+
+def fit_limma_contrasts(
+    counts_df: pd.DataFrame,
+    groups: list[str],
+    contrasts: dict[str, tuple[str, str]],
+) -> dict[str, pd.DataFrame]:
+    """
+    Fits ~0 + Group once and applies every contrast through one contrast
+    matrix, like makeContrasts with several contrasts in R.
+
+    Args:
+        counts_df: The normalized counts. The row index MUST be the gene names.
+        groups: The group of every column in counts_df.
+        contrasts: Maps the contrast name to (contrast_1, contrast_2) for
+            the formula contrast_1 - contrast_2.
+
+    Returns: The topTable of every contrast keyed by the contrast name.
+    """
+    design, levels = make_design(groups)
+
+    contrast_matrix = np.zeros((len(levels), len(contrasts)))
+    for j, (contrast_1, contrast_2) in enumerate(contrasts.values()):
+        contrast_matrix[levels.index(contrast_1), j] = 1
+        contrast_matrix[levels.index(contrast_2), j] = -1
+
+    fit = lm_fit(counts_df.to_numpy(dtype=float), design, levels)
+    fit = contrasts_fit(fit, contrast_matrix, list(contrasts))
+    ebayes = e_bayes(fit)
+
+    return {
+        contrast_name: top_table(ebayes, contrast_name, counts_df.index)
+        for contrast_name in contrasts
+    }
+
+
+def write_limma_results(
+    result: pd.DataFrame,
+    *,
+    output_dir: Path,
+    sig_output_dir: Path,
+    contrast_name: str,
+    contrast_formula: str,
+    fc_threshold: float,
+    pval_threshold: float,
+    table_format: TableFormat = "feather",
+    csv_copy: bool = False,
+) -> Path:
+    """
+    Writes the same files as main() in limma.R and returns the path to the
+    full DEG table.
+    """
+    # write.csv leaves the row name header blank, which R reads back as "X"
+    deg_file = write_table(
+        result,
+        table_file(output_dir, f"{contrast_name}_deg_limma", table_format),
+        index_label="",
+        csv_copy=csv_copy,
+    )
+    deg_results = DegResults.index(result)
+    deg_results.write_index(deg_file)
+
+    write_significant_genes(
+        deg_results.significant(fc_threshold, pval_threshold),
+        sig_output_dir=sig_output_dir,
+        contrast_name=contrast_name,
+        contrast_formula=contrast_formula,
+        fc_threshold=fc_threshold,
+        pval_threshold=pval_threshold,
+    )
+
+    return deg_file
+
+
+def write_significant_genes(
+    sig_genes: pd.DataFrame,
+    *,
+    sig_output_dir: Path,
+    contrast_name: str,
+    contrast_formula: str,
+    fc_threshold: float,
+    pval_threshold: float,
+) -> Path:
+    """
+    Writes the significant genes and the summary line like limma.R.
+
+    Returns: The csv of significant genes
+    """
+    num_sig = (
+        f"There are {len(sig_genes)} significant genes with p-value < "
+        f"{pval_threshold} and fold change > {fc_threshold} for contrast "
+        f"{contrast_name} with formula '{contrast_formula}'"
+    )
+    print(num_sig)
+
+    print("Writing significant genes to file")
+    (sig_output_dir / f"{contrast_name}_deg_limma_sig.txt").write_text(
+        num_sig + "\n"
+    )
+    sig_file = sig_output_dir / f"{contrast_name}_deg_limma_sig.csv"
+    sig_genes.to_csv(sig_file, index_label="")
+
+    return sig_file
+
+
+def run_limma_py(
+    *,
+    output_dir: Path,
+    counts: pd.DataFrame,
+    metadata: pd.DataFrame,
+    sig_output_dir: Path,
+    contrast_name: str,
+    contrast_1: str,
+    contrast_2: str,
+    fc_threshold: float = 1.5,
+    pval_threshold: float = 0.05,
+    table_format: TableFormat = "feather",
+    csv_copy: bool = False,
+) -> Path | None:
+    """
+    Drop in replacement for run_limma_r that does not start an R process.
+    Takes the counts and metadata tables instead of files.
+    """
+    if not output_dir.exists() or not sig_output_dir.exists():
+        raise FileNotFoundError("Output directories does not exist")
+
+    contrast_formula = f"{contrast_name} = {contrast_1} - {contrast_2}"
+    print("Running limma (python) with the following contrast formula:")
+    print(contrast_formula)
+
+    result = fit_limma(
+        counts,
+        metadata,
+        contrast_name,
+        contrast_1,
+        contrast_2,
+    )
+
+    return write_limma_results(
+        result,
+        output_dir=output_dir,
+        sig_output_dir=sig_output_dir,
+        contrast_name=contrast_name,
+        contrast_formula=contrast_formula,
+        fc_threshold=fc_threshold,
+        pval_threshold=pval_threshold,
+        table_format=table_format,
+        csv_copy=csv_copy,
+    )
+
+
+def run_limma_contrasts_py(
+    df: pd.DataFrame,
+    *,
+    metadata_maps: MetadataMaps,
+    contrast_list: list[Contrast],
+    gene_list_file: Path | None,
+    output_dir: Path,
+    fc_threshold: float = 1.5,
+    pval_threshold: float = 0.05,
+    workbook: WorkbookSession | None = None,
+    table_format: TableFormat = "feather",
+    csv_copy: bool = False,
+) -> dict[str, Path]:
+    """
+    Runs every contrast with one model fit on all samples of df. Contrasts
+    that subset the same gene list share a fit, so the cost grows with the
+    number of groups and gene lists, not the number of contrasts.
+
+    The results are written to output_dir/<contrast>/limma_outputs and
+    output_dir/<contrast>/limma_sig_results like the per contrast engines.
+
+    Returns: The path to the DEG table of every contrast.
+    """
+    groups = [metadata_maps.sample_to_condition[col] for col in df.columns]
+
+    # contrasts with the same gene list are fit together
+    gene_list_contrasts: dict[tuple, list[Contrast]] = {}
+    for contrast in contrast_list:
+        key = (contrast["genes_sheet"], contrast["gene_list_col"])
+        gene_list_contrasts.setdefault(key, []).append(contrast)
+
+    result_paths = {}
+    for contrasts in gene_list_contrasts.values():
+        genes = load_contrast_genes(
+            gene_list_file, contrasts[0], workbook=workbook
+        )
+        counts_df = df if genes is None else df.loc[genes]
+
+        contrast_groups = {
+            f"{g1}_vs_{g2}": (g1, g2)
+            for g1, g2 in (contrast["contrast"] for contrast in contrasts)
+        }
+        print(
+            f"Fitting {len(contrast_groups)} contrasts on "
+            f"{counts_df.shape[0]} genes and {counts_df.shape[1]} samples"
+        )
+        results = fit_limma_contrasts(counts_df, groups, contrast_groups)
+
+        for contrast_name, (g1, g2) in contrast_groups.items():
+            limma_output_dir = output_dir / contrast_name / "limma_outputs"
+            sig_output_dir = output_dir / contrast_name / "limma_sig_results"
+            limma_output_dir.mkdir(parents=True, exist_ok=True)
+            sig_output_dir.mkdir(parents=True, exist_ok=True)
+
+            result_paths[contrast_name] = write_limma_results(
+                results[contrast_name],
+                output_dir=limma_output_dir,
+                sig_output_dir=sig_output_dir,
+                contrast_name=contrast_name,
+                contrast_formula=f"{contrast_name} = {g1} - {g2}",
+                fc_threshold=fc_threshold,
+                pval_threshold=pval_threshold,
+                table_format=table_format,
+                csv_copy=csv_copy,
+            )
+
+    return result_paths
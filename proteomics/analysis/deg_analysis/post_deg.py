@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import pandas as pd
+from matplotlib.colors import LinearSegmentedColormap
+
+from proteomics.analysis.deg_analysis.R.run_enrichment import (
+    EnrichmentArgs,
+    EnrichResult,
+    fix_enrichment_results,
+    make_enrichment_analysis,
+)
+from proteomics.analysis.deg_analysis.R.volcano_plot import (
+    VolcanoArgs,
+    make_volcano_plot,
+)
+from proteomics.analysis.deg_analysis.base_args import RConfig, r_session
+from proteomics.analysis.deg_analysis.fix_kegg_ids import fix_kegg_ids
+from proteomics.analysis.deg_analysis.heatmap import (
+    MakeHeatmapOtherKwargs,
+    make_heatmap_sample,
+)
+from proteomics.analysis.preprocess.export_limma import LimmaInputs
+from proteomics.utils.render import (
+    RenderParams,
+    figures_enabled,
+    use_render_pool,
+)
+from proteomics.utils.run_r import run_analyses
+
+__all__ = [
+    "PostDegResults",
+    "heatmap_kwargs",
+    "fix_kegg_results",
+    "run_post_deg",
+]
+
+
+class PostDegResults(NamedTuple):
+    """
+    The outputs of the steps after limma for one contrast.
+    """
+
+    heatmap: Path | None
+    volcano: Path | None
+    enrichment: list[EnrichResult]
+
+
+def heatmap_kwargs(
+    heatmap: MakeHeatmapOtherKwargs, title: str
+) -> MakeHeatmapOtherKwargs:
+    """
+    The heatmap params of the config with the contrast as the title and the
+    blue-white-red colormap.
+    """
+    cmap = LinearSegmentedColormap.from_list(
+        "custom_cmap", ["royalblue", "white", "red"], N=100
+    )
+    return MakeHeatmapOtherKwargs(
+        title=title,
+        cmap=cmap,
+        **heatmap.model_dump(exclude={"cmap", "title"}, exclude_unset=True),
+    )
+
+
+def fix_kegg_results(
+    enrich_results: list[EnrichResult], kegg_fixed_dir: Path
+) -> list[Path]:
+    """
+    Same as the fix_kegg_gene_ids step of the flow.
+
+    Returns: The fixed KEGG tables
+    """
+    gene_ids = None
+    kegg_results = []
+    for result in enrich_results:
+        if result.result_type == "geneIds":
+            gene_ids = pd.read_csv(result.file_path)
+        elif result.result_type == "compareResult" or (
+            result.result_type == "enrichResult" and result.ont == "KEGG"
+        ):
+            kegg_results.append(result.file_path)
+
+    if gene_ids is None or len(gene_ids) == 0:
+        print("No gene ids or kegg results found")
+        return []
+
+    fixed = []
+    for kegg_result in kegg_results:
+        print("Fixing KEGG ids for ", kegg_result)
+        kegg_fixed = fix_kegg_ids(
+            gene_ids=gene_ids,
+            kegg_df=pd.read_csv(kegg_result),
+        )
+        kegg_fixed.to_csv(kegg_fixed_dir / kegg_result.name)
+        fixed.append(kegg_fixed_dir / kegg_result.name)
+
+    return fixed
+
+
+def _output_dir(contrast_dir: Path, stub: str) -> Path:
+    output_dir = contrast_dir / stub
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return output_dir
+
+
+def run_post_deg(
+    *,
+    limma_input: LimmaInputs,
+    result_path: Path,
+    contrast_dir: Path,
+    r_config: RConfig,
+    heatmap: MakeHeatmapOtherKwargs,
+    volcano: VolcanoArgs,
+    enrich: EnrichmentArgs,
+    render: RenderParams = RenderParams(),
+) -> PostDegResults:
+    """
+    Runs the heatmap, volcano plot, enrichment and KEGG id fix of a contrast
+    into the same directories as the steps of the flow. The volcano plot
+    and the enrichment Rscripts run at the same time in a worker thread
+    while the heatmap is drawn in this one. With render.figures off the
+    volcano plot and the heatmap are skipped, the heatmap directory only
+    gets the DE matrix.
+    """
+    name = limma_input.contrast_name
+
+    # the contrast already runs in its own task or pool process, the heatmap
+    # is drawn here while the Rscripts run on the R worker pool of the
+    # process, if any
+    with (
+        r_session(r_config, pool=False),
+        use_render_pool(render, workers=0),
+        ThreadPoolExecutor(max_workers=1) as executor,
+    ):
+        analyses = {}
+        if figures_enabled():
+            analyses["volcano"] = make_volcano_plot(
+                r_config=r_config,
+                output_dir=_output_dir(contrast_dir, "volcano"),
+                deg_results=result_path,
+                experiment=name,
+                volcano_args=volcano,
+            )
+        analyses["enrichment"] = make_enrichment_analysis(
+            r_config=r_config,
+            output_dir=_output_dir(contrast_dir, "enrichment"),
+            deg_results=result_path,
+            experiment=name,
+            enrichment_args=enrich,
+        )
+        r_results = executor.submit(run_analyses, list(analyses.values()))
+
+        print(f"Making heatmap for {name}")
+        heatmap_png = make_heatmap_sample(
+            counts_df=limma_input.counts(),
+            metadata_df=limma_input.metadata(),
+            limma_results_file=result_path,
+            output_dir=_output_dir(contrast_dir, "heatmap"),
+            make_heatmap_kwargs=heatmap_kwargs(heatmap, name),
+        )
+
+        results = dict(zip(analyses, r_results.result()))
+
+    enrich_results = fix_enrichment_results(results["enrichment"] or [])
+    fix_kegg_results(enrich_results, _output_dir(contrast_dir, "kegg_fixed"))
+
+    return PostDegResults(heatmap_png, results.get("volcano"), enrich_results)
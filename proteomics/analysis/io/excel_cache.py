@@ -0,0 +1,133 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from proteomics.utils.cache import get_cache_dir, hash_file_cached
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pa = None
+    pq = None
+
+__all__ = [
+    "read_excel_cached",
+    "read_cached_sheet",
+    "cache_sheet",
+    "set_index_col",
+]
+
+
+def get_cache_file(
+    input_file: Path, sheet_name: str, engine: str | None
+) -> Path:
+    """
+    The parquet file that holds the sheet. The name changes with the
+    contents of the excel file, so an edited workbook is never served from
+    a stale cache, and with the reader engine, since the engines do not
+    parse every cell the same way.
+    """
+    sheet_hash = hashlib.sha256(
+        f"{sheet_name}\0{engine}".encode()
+    ).hexdigest()[:12]
+    return (
+        get_cache_dir("excel")
+        / f"{hash_file_cached(input_file)}-{sheet_hash}.parquet"
+    )
+
+
+def set_index_col(df: pd.DataFrame, index_col: int | None) -> pd.DataFrame:
+    """
+    Same as passing index_col to pd.read_excel.
+    """
+    if index_col is None:
+        return df
+
+    df = df.set_index(df.columns[index_col])
+    # a blank header cell is read as "Unnamed: <n>" (or "" by the pyarrow
+    # csv reader) without index_col
+    if df.index.name == "" or str(df.index.name).startswith("Unnamed: "):
+        df.index.name = None
+
+    return df
+
+
+def read_cached_sheet(
+    input_file: Path, sheet_name: str, engine: str | None
+) -> pd.DataFrame | None:
+    """
+    Returns the sheet read with engine if it is in the cache, None
+    otherwise.
+    """
+    if pq is None:
+        return None
+
+    cache_file = get_cache_file(Path(input_file), sheet_name, engine)
+    if not cache_file.exists():
+        return None
+
+    print(f"Reading {input_file} [{sheet_name}] from {cache_file}")
+    return pq.read_table(cache_file, memory_map=True).to_pandas()
+
+
+def cache_sheet(
+    input_file: Path, sheet_name: str, df: pd.DataFrame, engine: str | None
+) -> None:
+    """
+    Stores a sheet read with pd.read_excel (without index_col) and engine in
+    the cache. Sheets with headers that are not strings are not cached.
+    """
+    if pq is None:
+        return
+
+    # parquet stores every column name as a string, a header of numbers
+    # (e.g. [101, 102]) would come back as ["101", "102"]
+    if not all(isinstance(column, str) for column in df.columns):
+        print(f"Not caching sheet {sheet_name} as parquet: non string headers")
+        return
+
+    cache_file = get_cache_file(Path(input_file), sheet_name, engine)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        # e.g. columns with mixed types
+        print(f"Not caching sheet as parquet: {e}")
+        return
+
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    pq.write_table(table, tmp_file)
+    tmp_file.replace(cache_file)
+
+
+def read_excel_cached(
+    input_file: Path,
+    sheet_name: str,
+    *,
+    index_col: int | None = None,
+    engine: str | None = None,
+) -> pd.DataFrame:
+    """
+    Reads a sheet from an excel file. The first read of a sheet stores it
+    as parquet keyed by the hash of the file, later reads memory map the
+    parquet file instead of parsing the workbook again.
+
+    Falls back to pd.read_excel if pyarrow is not installed.
+    """
+    if pq is None:
+        print("pyarrow not found. Reading excel file without cache.")
+        return pd.read_excel(
+            input_file,
+            sheet_name=sheet_name,
+            index_col=index_col,
+            engine=engine,
+        )
+
+    df = read_cached_sheet(input_file, sheet_name, engine)
+    if df is None:
+        df = pd.read_excel(input_file, sheet_name=sheet_name, engine=engine)
+        cache_sheet(input_file, sheet_name, df, engine)
+
+    return set_index_col(df, index_col)
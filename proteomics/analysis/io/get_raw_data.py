@@ -1,40 +1,91 @@
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, Iterator, Literal
 
 import pandas as pd
 
+try:
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pq = None
+
 __all__ = [
+    "accumulate_long_format",
     "load_imputed_counts",
+    "load_long_format_counts",
     "ImputedIntensity",
+    "LongFormatReport",
+    "read_table",
 ]
 
-from pydantic import AfterValidator, FilePath
+from pydantic import AfterValidator, FilePath, model_validator
 
 from proteomics.analysis.io.load_metadata import MetadataMaps
-from proteomics.utils.base_params import BaseParams, is_xlsx_file
+from proteomics.analysis.io.tabular import (
+    DELIMITERS,
+    PARQUET_SUFFIXES,
+    CsvEngine,
+    ExcelEngine,
+    is_excel_file,
+    is_tabular_file,
+    read_table,
+)
+from proteomics.analysis.io.workbook import WorkbookSession
+from proteomics.utils.base_params import BaseParams
 
 
 class ImputedIntensity(BaseParams):
-    input_file: Annotated[FilePath, AfterValidator(is_xlsx_file)]
+    input_file: Annotated[FilePath, AfterValidator(is_tabular_file)] | None = (
+        None
+    )
+    """Not needed when the counts are computed with maxlfq"""
     index_col: int = 0
-    sheet_name: str
+    sheet_name: str | None = None
+    """Required for excel files"""
 
     # metadata
-    metadata_file: Annotated[FilePath, AfterValidator(is_xlsx_file)]
-    metadata_sheet_name: str
+    metadata_file: Annotated[FilePath, AfterValidator(is_tabular_file)]
+    metadata_sheet_name: str | None = None
+    """Required for excel files"""
     metadata_index_col: int = 0
     condition_col: str = "condition"
 
+    # reader backends
+    excel_engine: ExcelEngine = "auto"
+    csv_engine: CsvEngine = "auto"
+
+    @model_validator(mode="after")
+    def check_sheet_names(self) -> "ImputedIntensity":
+        if (
+            self.input_file is not None
+            and is_excel_file(self.input_file)
+            and self.sheet_name is None
+        ):
+            raise ValueError("sheet_name is required for excel input files")
+        if (
+            is_excel_file(self.metadata_file)
+            and self.metadata_sheet_name is None
+        ):
+            raise ValueError(
+                "metadata_sheet_name is required for excel metadata files"
+            )
+        return self
+
 
 def load_imputed_counts(
     input_file: Path,
-    sheet_name: str,
+    sheet_name: str | None,
     index_col: int,
+    *,
+    workbook: WorkbookSession | None = None,
 ) -> pd.DataFrame:
     """
-    Loads a full rank counts matrix from an excel file.
+    Loads a full rank counts matrix from an excel, csv/tsv, parquet or
+    feather file. Reads the sheet from the workbook session if one is given.
     """
-    df = pd.read_excel(input_file, index_col=index_col, sheet_name=sheet_name)
+    if workbook is not None:
+        df = workbook.read(input_file, sheet_name, index_col=index_col)
+    else:
+        df = read_table(input_file, sheet_name=sheet_name, index_col=index_col)
 
     # check to make sure there are NO missing values
     if df.isnull().values.any():
@@ -45,14 +96,14 @@ def load_imputed_counts(
 
 def load_orig_counts(
         input_file: Path,
-        sheet_name: str,
+        sheet_name: str | None,
         genes_col: str,
         metadata_maps: MetadataMaps,
 ) -> pd.DataFrame:
     """
-    Loads the original counts matrix from an excel file.
+    Loads the original counts matrix from an excel (or other tabular) file.
     """
-    df = pd.read_excel(input_file, sheet_name=sheet_name)
+    df = read_table(input_file, sheet_name=sheet_name)
 
     # drop duplicates from genes_col
     print(f"Loaded {df.shape[0]} genes and {df.shape[1]} columns")
@@ -68,4 +119,177 @@ def load_orig_counts(
     ]
     print(f"There are {df.shape[1]} observations with metadata")
 
-    return df
\ No newline at end of file
+    return df
+
+
+def is_long_format_file(value: FilePath) -> FilePath:
+    suffix = Path(value).suffix.lower()
+    if suffix not in DELIMITERS.keys() | PARQUET_SUFFIXES:
+        raise ValueError("Report must be a csv, tsv or parquet file")
+    return value
+
+
+class LongFormatReport(BaseParams):
+    """
+    A long format Spectronaut report with one row per precursor per run.
+    """
+
+    report_file: Annotated[FilePath, AfterValidator(is_long_format_file)]
+    protein_col: str = "PG.Genes"
+    sample_col: str = "R.FileName"
+    intensity_col: str = "FG.Quantity"
+    qvalue_col: str = "EG.Qvalue"
+    qvalue_cutoff: float = 0.01
+    aggregate: Literal["sum", "max"] = "sum"
+    """How the precursors of a protein group are combined"""
+    precursor_col: str | None = None
+    """
+    Set (e.g. to EG.PrecursorId) for reports that also have fragment rows,
+    so each precursor is counted once per run
+    """
+    chunk_size: int = 1_000_000
+
+
+def _iter_report_chunks(
+    report_file: Path,
+    columns: list[str],
+    chunk_size: int,
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads only the needed columns of the report, chunk_size rows at a time.
+    """
+    report_file = Path(report_file)
+    suffix = report_file.suffix.lower()
+
+    if suffix in PARQUET_SUFFIXES:
+        if pq is None:
+            raise ModuleNotFoundError(
+                "pyarrow is required to read parquet reports"
+            )
+        parquet_file = pq.ParquetFile(report_file)
+        for batch in parquet_file.iter_batches(
+            batch_size=chunk_size, columns=columns
+        ):
+            yield batch.to_pandas()
+        return
+
+    # the pyarrow csv engine does not support chunksize
+    yield from pd.read_csv(
+        report_file,
+        sep=DELIMITERS[suffix],
+        usecols=columns,
+        chunksize=chunk_size,
+        engine="c",
+    )
+
+
+def accumulate_long_format(
+    report_file: Path,
+    *,
+    keys: list[str],
+    sample_col: str,
+    intensity_col: str,
+    qvalue_col: str,
+    qvalue_cutoff: float,
+    aggregate: Literal["sum", "max"],
+    chunk_size: int,
+) -> pd.Series:
+    """
+    Streams the report and aggregates the intensities of the rows passing
+    the q-value cutoff by (*keys, sample_col). Each chunk is reduced before
+    it is merged into the running result, so memory scales with the number
+    of (*keys, sample) pairs and not the size of the report.
+
+    Returns: The intensities indexed by (*keys, sample_col)
+    """
+    group_cols = [*keys, sample_col]
+    columns = list(dict.fromkeys([*group_cols, intensity_col, qvalue_col]))
+
+    total = None
+    n_rows = 0
+    n_kept = 0
+    for chunk in _iter_report_chunks(report_file, columns, chunk_size):
+        n_rows += len(chunk)
+
+        # spectronaut writes "Filtered" / "NaN" for missing values
+        intensity = pd.to_numeric(chunk[intensity_col], errors="coerce")
+        qvalue = pd.to_numeric(chunk[qvalue_col], errors="coerce")
+        keep = (qvalue <= qvalue_cutoff) & (intensity > 0)
+
+        chunk = chunk.loc[keep, group_cols].assign(
+            **{intensity_col: intensity[keep]}
+        )
+        chunk = chunk.dropna(subset=group_cols)
+        n_kept += len(chunk)
+
+        partial = chunk.groupby(group_cols, sort=False)[intensity_col].agg(
+            aggregate
+        )
+        if total is None:
+            total = partial
+        else:
+            total = (
+                pd.concat([total, partial])
+                .groupby(level=group_cols, sort=False)
+                .agg(aggregate)
+            )
+
+    print(
+        f"Read {n_rows} rows from {report_file}. {n_kept} passed the "
+        f"q-value cutoff of {qvalue_cutoff}"
+    )
+
+    if total is None or total.empty:
+        raise ValueError(f"No rows in {report_file} passed the filters")
+
+    return total.sort_index()
+
+
+def load_long_format_counts(
+    report: LongFormatReport,
+    metadata_maps: MetadataMaps | None = None,
+) -> pd.DataFrame:
+    """
+    Builds the protein group x sample intensity matrix from a long format
+    report. Missing values are NaN, so the matrix still needs to be imputed.
+    Only samples in the metadata are kept if metadata_maps is given.
+    """
+    if report.precursor_col is None:
+        intensities = accumulate_long_format(
+            report.report_file,
+            keys=[report.protein_col],
+            sample_col=report.sample_col,
+            intensity_col=report.intensity_col,
+            qvalue_col=report.qvalue_col,
+            qvalue_cutoff=report.qvalue_cutoff,
+            aggregate=report.aggregate,
+            chunk_size=report.chunk_size,
+        )
+    else:
+        # fragment rows repeat the precursor quantity
+        intensities = (
+            accumulate_long_format(
+                report.report_file,
+                keys=[report.protein_col, report.precursor_col],
+                sample_col=report.sample_col,
+                intensity_col=report.intensity_col,
+                qvalue_col=report.qvalue_col,
+                qvalue_cutoff=report.qvalue_cutoff,
+                aggregate="max",
+                chunk_size=report.chunk_size,
+            )
+            .groupby(level=[report.protein_col, report.sample_col])
+            .agg(report.aggregate)
+        )
+
+    df = intensities.unstack(report.sample_col).sort_index()
+    df.columns.name = None
+    print(f"Loaded {df.shape[0]} protein groups and {df.shape[1]} samples")
+
+    if metadata_maps is not None:
+        df = df[
+            [x for x in df.columns if x in metadata_maps.sample_to_condition]
+        ]
+        print(f"There are {df.shape[1]} observations with metadata")
+
+    return df
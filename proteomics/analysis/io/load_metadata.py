@@ -3,6 +3,9 @@ from typing import TypedDict, NamedTuple
 
 import pandas as pd
 
+from proteomics.analysis.io.tabular import read_table
+from proteomics.analysis.io.workbook import WorkbookSession
+
 
 class ContrastInput(TypedDict):
     contrast: tuple[str, str]
@@ -22,18 +25,25 @@ class MetadataMaps(NamedTuple):
 
 def make_metadata(
     metadata_file: Path,
-    metadata_sheet_name: str,
+    metadata_sheet_name: str | None,
     metadata_index_col: int,
     condition_col: str,
+    *,
+    workbook: WorkbookSession | None = None,
 ) -> MetadataMaps:
     """
     Maps the conditions to sample names
     """
-    df = pd.read_excel(
-        metadata_file,
-        sheet_name=metadata_sheet_name,
-        index_col=metadata_index_col,
-    )
+    if workbook is not None:
+        df = workbook.read(
+            metadata_file, metadata_sheet_name, index_col=metadata_index_col
+        )
+    else:
+        df = read_table(
+            metadata_file,
+            sheet_name=metadata_sheet_name,
+            index_col=metadata_index_col,
+        )
 
     # make sure condition col exists and is not null
     if condition_col not in df.columns:
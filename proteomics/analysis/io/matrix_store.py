@@ -0,0 +1,102 @@
+import json
+from pathlib import Path
+from typing import NamedTuple, Sequence
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "MatrixStore",
+]
+
+
+class MatrixStore(NamedTuple):
+    """
+    A float matrix stored as a Fortran ordered .npy file, so every column
+    (sample) is contiguous on disk, and a JSON sidecar with the row and
+    column labels. Only the two paths are pickled when the store is passed
+    between Metaflow steps. Readers memory map the array instead of loading
+    a copy of the matrix in every task.
+    """
+
+    data_file: Path
+    index_file: Path
+
+    @classmethod
+    def write(
+        cls,
+        df: pd.DataFrame,
+        output_dir: Path,
+        name: str,
+    ) -> "MatrixStore":
+        store = cls(
+            data_file=Path(output_dir) / f"{name}.npy",
+            index_file=Path(output_dir) / f"{name}.json",
+        )
+
+        np.save(
+            store.data_file,
+            np.asfortranarray(df.to_numpy(dtype=np.float64)),
+        )
+        store.index_file.write_text(
+            json.dumps(
+                {
+                    "index_name": df.index.name,
+                    "index": df.index.tolist(),
+                    "columns": df.columns.tolist(),
+                }
+            )
+        )
+        print(
+            f"Wrote {df.shape[0]} x {df.shape[1]} matrix to {store.data_file}"
+        )
+
+        return store
+
+    def labels(self) -> tuple[pd.Index, pd.Index]:
+        """
+        Returns: The row and column labels
+        """
+        labels = json.loads(self.index_file.read_text())
+        return (
+            pd.Index(labels["index"], name=labels["index_name"]),
+            pd.Index(labels["columns"]),
+        )
+
+    def array(self) -> np.ndarray:
+        """
+        The read only memory mapped matrix.
+        """
+        return np.load(self.data_file, mmap_mode="r")
+
+    def open(self) -> pd.DataFrame:
+        """
+        The whole matrix as a DataFrame backed by the memory map.
+        """
+        index, columns = self.labels()
+        return pd.DataFrame(
+            self.array(), index=index, columns=columns, copy=False
+        )
+
+    def take(
+        self,
+        rows: Sequence[int] | np.ndarray | None = None,
+        columns: Sequence[int] | np.ndarray | None = None,
+    ) -> pd.DataFrame:
+        """
+        Reads a subset of the matrix by row and column positions. Only the
+        selected columns are paged in.
+        """
+        index, all_columns = self.labels()
+        data = self.array()
+
+        if columns is not None:
+            columns = np.asarray(columns, dtype=np.intp)
+            data = data[:, columns]
+            all_columns = all_columns[columns]
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.intp)
+            data = data[rows]
+            index = index[rows]
+
+        return pd.DataFrame(np.asarray(data), index=index, columns=all_columns)
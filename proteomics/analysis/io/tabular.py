@@ -0,0 +1,192 @@
+import importlib.util
+from pathlib import Path
+from typing import Literal
+
+import pandas as pd
+from pydantic import FilePath
+
+from proteomics.analysis.io.excel_cache import read_excel_cached, set_index_col
+
+__all__ = [
+    "ExcelEngine",
+    "CsvEngine",
+    "EXCEL_SUFFIXES",
+    "DELIMITERS",
+    "PARQUET_SUFFIXES",
+    "FEATHER_SUFFIXES",
+    "is_excel_file",
+    "is_tabular_file",
+    "resolve_excel_engine",
+    "resolve_csv_engine",
+    "read_table",
+    "TableFormat",
+    "table_file",
+    "write_table",
+]
+
+ExcelEngine = Literal["auto", "calamine", "openpyxl"]
+CsvEngine = Literal["auto", "pyarrow", "c"]
+TableFormat = Literal["feather", "csv"]
+"""The format of the tables passed between the python steps and R"""
+
+EXCEL_SUFFIXES = {".xlsx", ".xlsm", ".xls"}
+DELIMITERS = {".csv": ",", ".tsv": "\t", ".txt": "\t"}
+PARQUET_SUFFIXES = {".parquet"}
+FEATHER_SUFFIXES = {".feather", ".arrow"}
+
+
+def is_excel_file(path: Path) -> bool:
+    return Path(path).suffix.lower() in EXCEL_SUFFIXES
+
+
+def is_tabular_file(value: FilePath) -> FilePath:
+    suffix = Path(value).suffix.lower()
+    if suffix not in (
+        EXCEL_SUFFIXES
+        | DELIMITERS.keys()
+        | PARQUET_SUFFIXES
+        | FEATHER_SUFFIXES
+    ):
+        raise ValueError(
+            "File must be an excel, csv, tsv, parquet or feather file"
+        )
+    return value
+
+
+def _has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def resolve_excel_engine(
+    engine: ExcelEngine, file: Path | None = None
+) -> str:
+    """
+    auto uses the rust based calamine reader if python-calamine is
+    installed, openpyxl otherwise. openpyxl can not read the old .xls
+    format, those files go to xlrd without calamine.
+    """
+    is_xls = file is not None and Path(file).suffix.lower() == ".xls"
+    if engine == "auto":
+        if _has_module("python_calamine"):
+            return "calamine"
+        return "xlrd" if is_xls else "openpyxl"
+    if engine == "openpyxl" and is_xls:
+        raise ValueError(
+            f"openpyxl can not read {file}, use excel_engine: calamine"
+        )
+    return engine
+
+
+def resolve_csv_engine(engine: CsvEngine) -> str:
+    """
+    auto uses the multithreaded pyarrow csv reader if pyarrow is installed,
+    the pandas c reader otherwise.
+    """
+    if engine == "auto":
+        return "pyarrow" if _has_module("pyarrow") else "c"
+    return engine
+
+
+def read_table(
+    input_file: Path,
+    *,
+    sheet_name: str | None = None,
+    index_col: int | None = None,
+    excel_engine: ExcelEngine = "auto",
+    csv_engine: CsvEngine = "auto",
+) -> pd.DataFrame:
+    """
+    Reads an excel sheet, a csv/tsv file or a parquet/feather file into a
+    DataFrame. index_col works like in pd.read_excel for every format.
+    """
+    input_file = Path(input_file)
+    suffix = input_file.suffix.lower()
+
+    if suffix in EXCEL_SUFFIXES:
+        if sheet_name is None:
+            raise ValueError(f"A sheet name is required for {input_file}")
+        return read_excel_cached(
+            input_file,
+            sheet_name=sheet_name,
+            index_col=index_col,
+            engine=resolve_excel_engine(excel_engine, input_file),
+        )
+
+    if suffix in DELIMITERS:
+        df = pd.read_csv(
+            input_file,
+            sep=DELIMITERS[suffix],
+            engine=resolve_csv_engine(csv_engine),
+        )
+    elif suffix in PARQUET_SUFFIXES:
+        df = pd.read_parquet(input_file)
+    elif suffix in FEATHER_SUFFIXES:
+        df = pd.read_feather(input_file)
+    else:
+        raise ValueError(f"Unsupported file type: {input_file}")
+
+    # an index stored in the file counts as the first columns, like the
+    # row names column of a csv
+    if not isinstance(df.index, pd.RangeIndex):
+        df = df.reset_index()
+
+    return set_index_col(df, index_col)
+
+
+def table_file(output_dir: Path, stem: str, table_format: TableFormat) -> Path:
+    return Path(output_dir) / f"{stem}.{table_format}"
+
+
+def write_table(
+    df: pd.DataFrame,
+    output_file: Path,
+    *,
+    index: bool = True,
+    index_label: str | None = None,
+    csv_copy: bool = False,
+) -> Path:
+    """
+    Writes a DataFrame as csv/tsv, parquet or feather, picked by the file
+    suffix. Parquet and feather files store the index as the first column.
+    It is named X if there is no label, which is what R calls the blank row
+    names header of write.csv, so both formats read the same in R.
+
+    Args:
+        csv_copy: Also write a csv next to a parquet or feather file, for
+            reading the table outside the pipeline.
+    """
+    output_file = Path(output_file)
+    suffix = output_file.suffix.lower()
+
+    if suffix in DELIMITERS:
+        df.to_csv(
+            output_file,
+            sep=DELIMITERS[suffix],
+            index=index,
+            index_label=index_label,
+        )
+        return output_file
+
+    if index:
+        name = (
+            index_label if index_label is not None else df.index.name
+        ) or "X"
+        table = df.reset_index(names=name)
+    else:
+        table = df.reset_index(drop=True)
+
+    if suffix in PARQUET_SUFFIXES:
+        table.to_parquet(output_file, index=False)
+    elif suffix in FEATHER_SUFFIXES:
+        table.to_feather(output_file)
+    else:
+        raise ValueError(f"Unsupported file type: {output_file}")
+
+    if csv_copy:
+        df.to_csv(
+            output_file.with_suffix(".csv"),
+            index=index,
+            index_label=index_label,
+        )
+
+    return output_file
@@ -0,0 +1,115 @@
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+import pandas as pd
+
+from proteomics.analysis.io.excel_cache import (
+    cache_sheet,
+    read_cached_sheet,
+    set_index_col,
+)
+from proteomics.analysis.io.tabular import (
+    CsvEngine,
+    ExcelEngine,
+    is_excel_file,
+    read_table,
+    resolve_excel_engine,
+)
+
+__all__ = [
+    "SheetRef",
+    "WorkbookSession",
+]
+
+
+class SheetRef(NamedTuple):
+    file: Path
+    sheet_name: str | None
+    """None for csv, tsv, parquet and feather files"""
+
+
+class WorkbookSession:
+    """
+    Holds every sheet a run needs. Each distinct workbook is opened once
+    and all of its sheets that are not in the parquet cache are parsed in
+    the same pass, instead of every loader opening the file again. Other
+    tabular files are read once as a single sheet.
+    """
+
+    def __init__(self, sheets: dict[tuple[str, str], pd.DataFrame]):
+        self._sheets = sheets
+
+    @staticmethod
+    def _key(file: Path, sheet_name: str | None) -> tuple[str, str | None]:
+        if not is_excel_file(file):
+            sheet_name = None
+        return str(Path(file).resolve()), sheet_name
+
+    @classmethod
+    def open(
+        cls,
+        refs: Iterable[SheetRef],
+        *,
+        excel_engine: ExcelEngine = "auto",
+        csv_engine: CsvEngine = "auto",
+    ) -> "WorkbookSession":
+        files: dict[Path, set[str | None]] = {}
+        for file, sheet_name in refs:
+            files.setdefault(Path(file).resolve(), set()).add(sheet_name)
+
+        sheets = {}
+        for file, sheet_names in files.items():
+            if not is_excel_file(file):
+                sheets[cls._key(file, None)] = read_table(
+                    file, csv_engine=csv_engine
+                )
+                continue
+
+            engine = resolve_excel_engine(excel_engine, file)
+            missing = []
+            for sheet_name in sorted(sheet_names):
+                df = read_cached_sheet(file, sheet_name, engine)
+                if df is None:
+                    missing.append(sheet_name)
+                else:
+                    sheets[cls._key(file, sheet_name)] = df
+
+            if not missing:
+                continue
+
+            print(f"Reading sheets {missing} from {file}")
+            with pd.ExcelFile(file, engine=engine) as xls:
+                dfs = pd.read_excel(xls, sheet_name=missing)
+
+            for sheet_name, df in dfs.items():
+                cache_sheet(file, sheet_name, df, engine)
+                sheets[cls._key(file, sheet_name)] = df
+
+        return cls(sheets)
+
+    def read(
+        self,
+        file: Path,
+        sheet_name: str | None,
+        *,
+        index_col: int | None = None,
+    ) -> pd.DataFrame:
+        """
+        Returns a sheet as if it was read with
+        pd.read_excel(file, sheet_name=sheet_name, index_col=index_col).
+        """
+        key = self._key(file, sheet_name)
+        if key not in self._sheets:
+            raise KeyError(f"Sheet {sheet_name} of {file} was not loaded")
+
+        return set_index_col(self._sheets[key].copy(), index_col)
+
+    def subset(self, refs: Iterable[SheetRef]) -> "WorkbookSession":
+        """
+        A session with only the given sheets, e.g. to keep the gene lists
+        for a later step without keeping the counts matrix.
+        """
+        keys = {self._key(file, sheet_name) for file, sheet_name in refs}
+        return WorkbookSession(
+            {key: df for key, df in self._sheets.items() if key in keys}
+        )
@@ -1,58 +1,76 @@
 from pathlib import Path
-from typing import NamedTuple
+from typing import TYPE_CHECKING, NamedTuple
 
+import numpy as np
 import pandas as pd
-from matplotlib.figure import Figure
-from sklearn.decomposition import PCA
 
 from proteomics.analysis.io.load_metadata import MetadataMaps
+from proteomics.utils.render import render
 
-from matplotlib import pyplot as plt
-import seaborn as sns
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
 
 class ScreeOutput(NamedTuple):
-    figure: Figure
+    explained_variance_ratio: np.ndarray
     explained_variance: float
+    """Of PC 1 and 2, in percent"""
 
 
-def plot_scree(
-    df: pd.DataFrame,
-    *,
-    plt_name: Path | None = None,
-) -> ScreeOutput:
+def fit_scree(df: pd.DataFrame) -> ScreeOutput:
+    from sklearn.decomposition import PCA
+
     pca = PCA()
 
     pca.fit(df.T)
 
+    explained_variance = pca.explained_variance_ratio_[:2].sum() * 100
+
+    print(f"PC1 and PC2 explain {explained_variance:.2f}% of the variance")
+
+    return ScreeOutput(
+        explained_variance_ratio=pca.explained_variance_ratio_,
+        explained_variance=explained_variance,
+    )
+
+
+def plot_scree(
+    explained_variance_ratio: np.ndarray,
+    *,
+    plt_name: Path | None = None,
+) -> "Figure":
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     sns.set_style("ticks")
 
     # plot the scree plot
     fig = plt.figure()
-    plt.plot(pca.explained_variance_ratio_)
+    plt.plot(explained_variance_ratio)
     plt.xlabel("PC")
     plt.ylabel("Explained variance ratio")
     plt.title("Scree plot")
 
-    explained_variance = pca.explained_variance_ratio_[:2].sum() * 100
-
-    print(f"PC1 and PC2 explain {explained_variance:.2f}% of the variance")
-
     if plt_name:
         plt.savefig(plt_name)
 
     plt.close()
 
-    return ScreeOutput(
-        figure=fig,
-        explained_variance=explained_variance,
-    )
+    return fig
+
+
+def save_scree(explained_variance_ratio: np.ndarray, plt_name: Path) -> Path:
+    plot_scree(explained_variance_ratio, plt_name=plt_name)
+    return plt_name
 
 
 def plot_pca(
     df_pca: pd.DataFrame,
     fig_name: Path | None = None,
-) -> Figure:
+) -> "Figure":
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     # plot the PCA
     sns.set_style("ticks")
 
@@ -92,9 +110,13 @@ def plot_pca(
     return fig
 
 
+def save_pca(df_pca: pd.DataFrame, fig_name: Path) -> Path:
+    plot_pca(df_pca, fig_name=fig_name)
+    return fig_name
+
+
 class PCAOutput(NamedTuple):
     pca_df: pd.DataFrame
-    pca_fig: Figure
     scree_output: ScreeOutput
 
 
@@ -105,7 +127,18 @@ def run_pca(
     scree_fig_name: Path,
     pca_fig_name: Path,
 ) -> PCAOutput:
-    scree_output = plot_scree(df_norm, plt_name=scree_fig_name)
+    """
+    PCA of the samples. The scree and PCA plots are drawn with render, see
+    proteomics.utils.render.
+    """
+    from sklearn.decomposition import PCA
+
+    scree_output = fit_scree(df_norm)
+    render(
+        save_scree,
+        scree_output.explained_variance_ratio,
+        plt_name=scree_fig_name,
+    )
 
     pca = PCA(n_components=2)
 
@@ -129,10 +162,9 @@ def run_pca(
         axis=1,
     )
 
-    pca_fig = plot_pca(df_pca, fig_name=pca_fig_name)
+    render(save_pca, df_pca, fig_name=pca_fig_name)
 
     return PCAOutput(
         pca_df=df_pca,
-        pca_fig=pca_fig,
         scree_output=scree_output,
     )
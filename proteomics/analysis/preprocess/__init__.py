@@ -3,7 +3,8 @@ from typing import Annotated, Literal, TypedDict
 from pydantic import FilePath, AfterValidator
 
 from .normalize import normalize
-from proteomics.utils.base_params import BaseParams, is_xlsx_file
+from proteomics.utils.base_params import BaseParams
+from ..io.tabular import is_tabular_file
 from ..io.load_metadata import ContrastInput
 
 
@@ -16,7 +17,7 @@ class PreprocessParams(BaseParams):
 
     # contrasts
     gene_input_file: (
-        Annotated[FilePath, AfterValidator(is_xlsx_file)] | None
+        Annotated[FilePath, AfterValidator(is_tabular_file)] | None
     ) = None
     contrasts: list[ContrastInput]
 
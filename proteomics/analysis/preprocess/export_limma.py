@@ -1,11 +1,26 @@
+import json
 from pathlib import Path
 from typing import NamedTuple
 
 import pandas as pd
 
+from proteomics.analysis.io.matrix_store import MatrixStore
+from proteomics.analysis.io.tabular import (
+    TableFormat,
+    is_excel_file,
+    read_table,
+    table_file,
+    write_table,
+)
 from proteomics.analysis.io.load_metadata import Contrast
+from proteomics.analysis.io.workbook import WorkbookSession
 
-__all__ = ["make_limma_contrasts", "LimmaInputs"]
+__all__ = [
+    "make_limma_contrasts",
+    "load_contrast_genes",
+    "LimmaInputs",
+    "read_limma_inputs",
+]
 
 
 def subset_genes(
@@ -13,76 +28,195 @@ def subset_genes(
     gene_list_col: str | None,
     genes_sheet: str | None,
 ) -> bool:
-    return not (
-        gene_list_file is None or gene_list_col is None or genes_sheet is None
-    )
+    if gene_list_file is None or gene_list_col is None:
+        return False
+
+    # csv, parquet and feather gene lists do not have sheets
+    return genes_sheet is not None or not is_excel_file(gene_list_file)
+
+
+def load_contrast_genes(
+    gene_list_file: Path | None,
+    contrast: Contrast,
+    *,
+    workbook: WorkbookSession | None = None,
+) -> pd.Series | None:
+    """
+    Loads the genes to run the contrast on. None if all genes are used.
+    """
+    if not subset_genes(
+        gene_list_file=gene_list_file,
+        gene_list_col=contrast["gene_list_col"],
+        genes_sheet=contrast["genes_sheet"],
+    ):
+        return None
+
+    if workbook is not None:
+        genes_df = workbook.read(gene_list_file, contrast["genes_sheet"])
+    else:
+        genes_df = read_table(
+            gene_list_file, sheet_name=contrast["genes_sheet"]
+        )
+
+    return genes_df[contrast["gene_list_col"]]
 
 
 class LimmaInputs(NamedTuple):
     """
-    Inputs into a function that runs limma.
+    Inputs into a function that runs limma. The counts are a view into the
+    shared matrix store: the positions of the genes (None for all genes)
+    and of the samples of the contrast. Nothing is copied until an engine
+    asks for the counts.
     """
-    counts_file: Path
-    metadata_file: Path
+
+    store: MatrixStore
+    rows: list[int] | None
+    columns: list[int]
+    groups: list[str]
+    """The group of each column"""
     contrast_name: str
     contrast_1: str
     contrast_2: str
 
+    def counts(self) -> pd.DataFrame:
+        return self.store.take(self.rows, self.columns)
+
+    def metadata(self) -> pd.DataFrame:
+        _, columns = self.store.labels()
+        return pd.DataFrame(
+            {
+                "Sample": columns[self.columns],
+                "Group": self.groups,
+            }
+        )
+
+    def write_files(
+        self,
+        output_dir: Path,
+        *,
+        table_format: TableFormat = "feather",
+        csv_copy: bool = False,
+    ) -> tuple[Path, Path]:
+        """
+        Writes the counts and metadata tables for engines that read files,
+        like limma.R.
+
+        Returns: The counts file and the metadata file
+        """
+        counts_file = write_table(
+            self.counts(),
+            table_file(
+                output_dir, f"{self.contrast_name}_counts", table_format
+            ),
+            csv_copy=csv_copy,
+        )
+        metadata_file = write_table(
+            self.metadata(),
+            table_file(
+                output_dir, f"{self.contrast_name}_metadata", table_format
+            ),
+            index=False,
+            csv_copy=csv_copy,
+        )
+
+        return counts_file, metadata_file
+
 
 def make_limma_contrasts(
-    df: pd.DataFrame,
+    store: MatrixStore,
     *,
     output_dir: Path,
     contrast_list: list[Contrast],
     gene_list_file: Path | None,
+    workbook: WorkbookSession | None = None,
 ) -> list[LimmaInputs]:
+    """
+    Describes every contrast as rows and columns of the store. Only a small
+    JSON spec is written per contrast.
+    """
     if not output_dir.exists():
         output_dir.mkdir()
         print(f"Created directory: {output_dir}")
 
+    index, columns = store.labels()
+
     limma_inputs = []
     for contrast in contrast_list:
         g1, g2 = contrast["contrast"]
+        samples = contrast["group_0_cols"] + contrast["group_1_cols"]
 
-        counts_df = df[contrast["group_0_cols"] + contrast["group_1_cols"]]
-
-        if subset_genes(
-            gene_list_file=gene_list_file,
-            gene_list_col=contrast["gene_list_col"],
-            genes_sheet=contrast["genes_sheet"],
-        ):
+        rows = None
+        genes_df = load_contrast_genes(
+            gene_list_file, contrast, workbook=workbook
+        )
+        if genes_df is not None:
             print("Subsetting genes")
-            genes_df = pd.read_excel(
-                gene_list_file, sheet_name=contrast["genes_sheet"]
-            )[contrast["gene_list_col"]]
             print(
-                f"Counts df genes: {counts_df.shape[0]}, Gene list: {genes_df.shape[0]}"
+                f"Counts df genes: {len(index)}, Gene list: {genes_df.shape[0]}"
             )
-            counts_df = counts_df.loc[genes_df]
-            print(f"Counts df genes after subsetting: {counts_df.shape[0]}")
-
-        counts_df.to_csv(output_dir / f"{g1}_vs_{g2}_counts.csv")
-
-        metadata = pd.DataFrame(
-            {
-                "Sample": counts_df.columns,
-                "Group": [
-                    g1 if col in contrast["group_0_cols"] else g2
-                    for col in counts_df.columns
-                ],
-            }
+            rows = index.get_indexer(genes_df)
+            if (rows < 0).any():
+                raise KeyError(
+                    f"Genes not in the counts: {list(genes_df[rows < 0])}"
+                )
+            rows = rows.tolist()
+            print(f"Counts df genes after subsetting: {len(rows)}")
+
+        limma_input = LimmaInputs(
+            store=store,
+            rows=rows,
+            columns=columns.get_indexer(samples).tolist(),
+            groups=[
+                g1 if col in contrast["group_0_cols"] else g2
+                for col in samples
+            ],
+            contrast_name=f"{g1}_vs_{g2}",
+            contrast_1=g1,
+            contrast_2=g2,
         )
 
-        metadata.to_csv(output_dir / f"{g1}_vs_{g2}_metadata.csv", index=False)
-
-        limma_inputs.append(
-            LimmaInputs(
-                counts_file=output_dir / f"{g1}_vs_{g2}_counts.csv",
-                metadata_file=output_dir / f"{g1}_vs_{g2}_metadata.csv",
-                contrast_name=f"{g1}_vs_{g2}",
-                contrast_1=g1,
-                contrast_2=g2,
+        spec_file = output_dir / f"{limma_input.contrast_name}.json"
+        spec_file.write_text(
+            json.dumps(
+                {
+                    "matrix": str(store.data_file),
+                    "rows": rows,
+                    "samples": samples,
+                    "groups": limma_input.groups,
+                    "contrast_name": limma_input.contrast_name,
+                    "contrast_1": g1,
+                    "contrast_2": g2,
+                },
+                indent=2,
             )
         )
 
+        limma_inputs.append(limma_input)
+
     return limma_inputs
+
+
+def read_limma_inputs(spec_file: Path) -> LimmaInputs:
+    """
+    Reads a spec written by make_limma_contrasts. If the run directory was
+    moved, the store is looked up in the normalization directory next to
+    the spec's directory.
+    """
+    spec_file = Path(spec_file)
+    spec = json.loads(spec_file.read_text())
+
+    data_file = Path(spec["matrix"])
+    if not data_file.exists():
+        data_file = spec_file.parent.parent / "normalization" / data_file.name
+    store = MatrixStore(data_file, data_file.with_suffix(".json"))
+
+    _, columns = store.labels()
+    return LimmaInputs(
+        store=store,
+        rows=spec["rows"],
+        columns=columns.get_indexer(spec["samples"]).tolist(),
+        groups=spec["groups"],
+        contrast_name=spec.get("contrast_name", spec_file.stem),
+        contrast_1=spec["contrast_1"],
+        contrast_2=spec["contrast_2"],
+    )
@@ -2,8 +2,6 @@ from typing import Literal
 
 import numpy as np
 import pandas as pd
-from missforest import MissForest
-import seaborn as sns
 
 from proteomics.analysis.deg_analysis.heatmap import make_heatmap
 from proteomics.analysis.io.load_metadata import MetadataMaps
@@ -88,6 +86,8 @@ def heatmap_missing_vals(
         category_col: str,
         col_name_replace_regex: str = ""
 ):
+    import seaborn as sns
+
     # Convert to boolean mask
     missing_mask = counts.isnull()
     # only get the rows with 1
@@ -114,6 +114,9 @@ def impute_missing_vals(
         counts: pd.DataFrame,
 
 ):
+    # MissForest pulls in scikit-learn, only import it when imputing
+    from missforest import MissForest
+
     # Initialize MissForest imputer
     mf = MissForest()
 
@@ -0,0 +1,271 @@
+import os
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from pydantic import model_validator
+
+from proteomics.analysis.io.get_raw_data import (
+    LongFormatReport,
+    accumulate_long_format,
+)
+from proteomics.analysis.io.load_metadata import MetadataMaps
+from proteomics.utils.base_params import BaseParams
+
+__all__ = [
+    "MaxLFQParams",
+    "maxlfq",
+    "maxlfq_batch",
+    "run_maxlfq",
+]
+
+
+class MaxLFQParams(BaseParams):
+    """
+    Protein intensities computed from the precursors of a long format
+    report with the MaxLFQ algorithm.
+    """
+
+    report: LongFormatReport
+    min_ratio_count: int = 1
+    """Precursors two samples must share to compare them"""
+    max_workers: int | None = None
+    """Processes used for the roll up. None uses every cpu"""
+    batch_elements: int = 1 << 24
+    """Upper bound on proteins * precursors * samples^2 per batch"""
+
+    @model_validator(mode="after")
+    def check_precursor_col(self) -> "MaxLFQParams":
+        if self.report.precursor_col is None:
+            raise ValueError("report.precursor_col is required for MaxLFQ")
+        return self
+
+
+def _component_masks(adjacency: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    same[p, i, j] is True if samples i and j of protein p are connected
+    by a chain of ratios. Computed by squaring the reachability matrix.
+    """
+    n_samples = adjacency.shape[-1]
+    reach = (adjacency | np.eye(n_samples, dtype=bool)) & valid[:, :, None]
+    reach = reach.astype(np.float64)
+
+    for _ in range(max(1, int(np.ceil(np.log2(n_samples))))):
+        reach = np.minimum(reach @ reach, 1.0)
+
+    return reach > 0
+
+
+def maxlfq_batch(log_x: np.ndarray, min_ratio_count: int = 1) -> np.ndarray:
+    """
+    MaxLFQ for a batch of proteins.
+
+    Args:
+        log_x: (proteins, precursors, samples) log2 intensities. Missing
+            values and the padding of proteins with fewer precursors are NaN.
+        min_ratio_count: Precursors two samples must share to compare them
+
+    Returns: (proteins, samples) log2 protein intensities, NaN if a sample
+        has no precursor of the protein.
+    """
+    n_samples = log_x.shape[2]
+    diagonal = np.arange(n_samples)
+
+    # median log ratio of every pair of samples over the shared precursors
+    diffs = log_x[:, :, :, None] - log_x[:, :, None, :]
+    counts = np.sum(~np.isnan(diffs), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ratios = np.nanmedian(diffs, axis=1)
+    del diffs
+
+    valid = np.any(~np.isnan(log_x), axis=1)
+    adjacency = counts >= min_ratio_count
+    adjacency[:, diagonal, diagonal] = False
+    ratios = np.where(adjacency, ratios, 0.0)
+
+    # least squares of x_i - x_j = r_ij gives L x = b with the graph
+    # laplacian L. L is singular, one per connected component, so the
+    # component sums are pinned to 0 by adding the component indicator
+    same = _component_masks(adjacency, valid)
+    laplacian = -adjacency.astype(np.float64)
+    laplacian[:, diagonal, diagonal] = adjacency.sum(axis=2)
+    system = laplacian + same
+    b = ratios.sum(axis=2)
+
+    # samples without data are solved as x = 0 and set to NaN after
+    missing = ~valid
+    system[missing] = 0.0
+    p_idx, s_idx = np.nonzero(missing)
+    system[p_idx, s_idx, s_idx] = 1.0
+    b[missing] = 0.0
+
+    x = np.linalg.solve(system, b[:, :, None])[:, :, 0]
+
+    # scale each component so that it sums to the summed precursor
+    # intensities of its samples. Samples without data have no component.
+    totals = np.nansum(np.exp2(log_x), axis=1)
+    same = same.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (
+            x
+            + np.log2(same @ totals[:, :, None])[:, :, 0]
+            - np.log2(same @ np.exp2(x)[:, :, None])[:, :, 0]
+        )
+    x[missing] = np.nan
+
+    return x
+
+
+def _iter_batches(
+    n_precursors: np.ndarray,
+    n_samples: int,
+    batch_elements: int,
+) -> Iterator[np.ndarray]:
+    """
+    Groups proteins with a similar number of precursors, so that little
+    of a batch is padding.
+    """
+    order = np.argsort(n_precursors, kind="stable")
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while (
+            end < len(order)
+            and (end - start + 1) * n_precursors[order[end]] * n_samples**2
+            <= batch_elements
+        ):
+            end += 1
+        yield order[start:end]
+        start = end
+
+
+def maxlfq(
+    precursors: pd.DataFrame,
+    *,
+    min_ratio_count: int = 1,
+    max_workers: int | None = None,
+    batch_elements: int = 1 << 24,
+) -> pd.DataFrame:
+    """
+    Rolls up precursor intensities into protein intensities.
+
+    Args:
+        precursors: The precursor intensities (not log transformed) with a
+            (protein, precursor) MultiIndex and the samples in the columns
+        min_ratio_count: Precursors two samples must share to compare them
+        max_workers: Processes used for the batches
+        batch_elements: Upper bound on proteins * precursors * samples^2
+            per batch
+
+    Returns: The protein x sample intensities (not log transformed)
+    """
+    precursors = precursors.sort_index(level=0, sort_remaining=False)
+    proteins, protein_codes = np.unique(
+        precursors.index.get_level_values(0), return_inverse=True
+    )
+    n_precursors = np.bincount(protein_codes)
+    first_row = np.concatenate([[0], np.cumsum(n_precursors)[:-1]])
+    row_in_protein = np.arange(len(protein_codes)) - first_row[protein_codes]
+
+    with np.errstate(divide="ignore"):
+        log_values = np.log2(precursors.to_numpy(dtype=np.float64))
+    log_values[~np.isfinite(log_values)] = np.nan
+    n_samples = log_values.shape[1]
+
+    def make_batch(batch: np.ndarray) -> np.ndarray:
+        rows = np.concatenate(
+            [
+                np.arange(first_row[p], first_row[p] + n_precursors[p])
+                for p in batch
+            ]
+        )
+        local = np.repeat(np.arange(len(batch)), n_precursors[batch])
+        log_x = np.full(
+            (len(batch), n_precursors[batch].max(), n_samples), np.nan
+        )
+        log_x[local, row_in_protein[rows]] = log_values[rows]
+        return log_x
+
+    batches = list(_iter_batches(n_precursors, n_samples, batch_elements))
+    print(
+        f"Running MaxLFQ on {len(proteins)} proteins in {len(batches)} batches"
+    )
+
+    result = np.full((len(proteins), n_samples), np.nan)
+    if max_workers == 1 or len(batches) == 1:
+        for batch in batches:
+            result[batch] = maxlfq_batch(make_batch(batch), min_ratio_count)
+    else:
+        # a padded batch is up to batch_elements floats, only a few per
+        # worker are built and in flight at once
+        window = 2 * (max_workers or os.cpu_count() or 1)
+        todo = iter(batches)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            while True:
+                for batch in todo:
+                    future = executor.submit(
+                        maxlfq_batch, make_batch(batch), min_ratio_count
+                    )
+                    pending[future] = batch
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result[pending.pop(future)] = future.result()
+
+    return pd.DataFrame(
+        np.exp2(result),
+        index=pd.Index(proteins, name=precursors.index.names[0]),
+        columns=precursors.columns,
+    )
+
+
+def run_maxlfq(
+    params: MaxLFQParams,
+    metadata_maps: MetadataMaps | None = None,
+) -> pd.DataFrame:
+    """
+    Streams the precursors out of the report and rolls them up into the
+    protein x sample matrix. Only samples in the metadata are kept if
+    metadata_maps is given.
+    """
+    report = params.report
+    intensities = accumulate_long_format(
+        report.report_file,
+        keys=[report.protein_col, report.precursor_col],
+        sample_col=report.sample_col,
+        intensity_col=report.intensity_col,
+        qvalue_col=report.qvalue_col,
+        qvalue_cutoff=report.qvalue_cutoff,
+        # fragment rows repeat the precursor quantity
+        aggregate="max",
+        chunk_size=report.chunk_size,
+    )
+    precursors = intensities.unstack(report.sample_col)
+    precursors.columns.name = None
+
+    if metadata_maps is not None:
+        precursors = precursors[
+            [
+                x
+                for x in precursors.columns
+                if x in metadata_maps.sample_to_condition
+            ]
+        ]
+
+    df = maxlfq(
+        precursors,
+        min_ratio_count=params.min_ratio_count,
+        max_workers=params.max_workers,
+        batch_elements=params.batch_elements,
+    )
+    print(f"Computed MaxLFQ intensities for {df.shape[0]} protein groups")
+
+    return df
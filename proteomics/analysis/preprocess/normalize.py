@@ -1,11 +1,13 @@
 from pathlib import Path
-from typing import Literal, NamedTuple
+from typing import TYPE_CHECKING, Literal, NamedTuple
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-import seaborn as sns
-from matplotlib.figure import Figure
+
+from proteomics.utils.render import render
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
 
 def center_median_normalize(df: pd.DataFrame) -> pd.DataFrame:
@@ -42,7 +44,10 @@ def plot_ms_abundances(
     plt_name: Path | None = None,
     show: bool = False,
     title: str,
-) -> Figure:
+) -> "Figure":
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     if n_rows * n_cols < df.shape[1]:
         raise ValueError("n_rows * n_cols < number of columns in df")
 
@@ -70,10 +75,30 @@ def plot_ms_abundances(
     return f1_fig
 
 
+def save_ms_abundances(
+    df: pd.DataFrame,
+    n_rows: int,
+    n_cols: int,
+    *,
+    plt_name: Path,
+    title: str,
+) -> Path:
+    """
+    plot_ms_abundances into plt_name, for the render pool.
+    """
+    from matplotlib import pyplot as plt
+
+    plt.close(
+        plot_ms_abundances(df, n_rows, n_cols, plt_name=plt_name, title=title)
+    )
+    return plt_name
+
+
 class NormalizeRt(NamedTuple):
     df_norm: pd.DataFrame
-    before_norm_fig: Figure
-    after_norm_fig: Figure
+    before_norm_png: Path | None
+    """Written when the renders are done, None with the figures off"""
+    after_norm_png: Path | None
 
 
 def normalize(
@@ -83,22 +108,36 @@ def normalize(
     n_rows: int,
     n_cols: int,
 ) -> NormalizeRt:
+    """
+    Log2 and center median normalizes the counts. The histograms of the
+    counts before and after are drawn with render, see
+    proteomics.utils.render.
+    """
+    before_norm_png = plot_dir / "before-normalization.png"
+    after_norm_png = plot_dir / "center-median.png"
+
+    before = render(
+        save_ms_abundances,
+        df,
+        n_rows,
+        n_cols,
+        plt_name=before_norm_png,
+        title="Before normalization",
+    )
+
     df_norm = log_normalize(df, "center.median")
 
+    after = render(
+        save_ms_abundances,
+        df_norm,
+        n_rows,
+        n_cols,
+        plt_name=after_norm_png,
+        title="After normalization",
+    )
+
     return NormalizeRt(
         df_norm=df_norm,
-        before_norm_fig=plot_ms_abundances(
-            df,
-            n_rows,
-            n_cols,
-            plt_name=plot_dir / "before-normalization.png",
-            title="Before normalization",
-        ),
-        after_norm_fig=plot_ms_abundances(
-            df_norm,
-            n_rows,
-            n_cols,
-            plt_name=plot_dir / "center-median.png",
-            title="After normalization",
-        ),
+        before_norm_png=before_norm_png if before is not None else None,
+        after_norm_png=after_norm_png if after is not None else None,
     )
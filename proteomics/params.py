@@ -0,0 +1,97 @@
+import yaml
+from pydantic import model_validator
+
+from proteomics.analysis.deg_analysis.R.run_enrichment import EnrichmentArgs
+from proteomics.analysis.deg_analysis.R.volcano_plot import VolcanoArgs
+from proteomics.analysis.deg_analysis.base_args import RConfig
+from proteomics.analysis.deg_analysis.contrast import ExecutionParams
+from proteomics.analysis.deg_analysis.heatmap import MakeHeatmapOtherKwargs
+from proteomics.analysis.deg_analysis.limma import LimmaParams
+from proteomics.analysis.io.get_raw_data import (
+    ImputedIntensity,
+    LongFormatReport,
+)
+from proteomics.analysis.io.workbook import SheetRef
+from proteomics.analysis.preprocess import PreprocessParams
+from proteomics.analysis.preprocess.export_limma import subset_genes
+from proteomics.analysis.preprocess.maxlfq import MaxLFQParams
+from proteomics.utils.base_params import BaseParams
+from proteomics.utils.incremental import IncrementalParams
+from proteomics.utils.render import RenderParams
+from proteomics.utils.stage_cache import StageCacheParams
+
+__all__ = [
+    "ParameterFile",
+    "config_file_parser",
+]
+
+
+class ParameterFile(BaseParams):
+    imputed_data: ImputedIntensity
+    preprocess: PreprocessParams
+    r: RConfig
+    limma: LimmaParams = LimmaParams()
+    heatmap: MakeHeatmapOtherKwargs
+    volcano: VolcanoArgs
+    enrich: EnrichmentArgs
+    maxlfq: MaxLFQParams | None = None
+    long_format: LongFormatReport | None = None
+    stage_cache: StageCacheParams = StageCacheParams()
+    incremental: IncrementalParams = IncrementalParams()
+    execution: ExecutionParams = ExecutionParams()
+    render: RenderParams = RenderParams()
+
+    @model_validator(mode="after")
+    def check_counts_source(self) -> "ParameterFile":
+        sources = [
+            self.imputed_data.input_file,
+            self.maxlfq,
+            self.long_format,
+        ]
+        if sum(source is not None for source in sources) != 1:
+            raise ValueError(
+                "Set exactly one of imputed_data.input_file, maxlfq and "
+                "long_format"
+            )
+        return self
+
+    def gene_list_sheets(self) -> list[SheetRef]:
+        if self.preprocess.gene_input_file is None:
+            return []
+
+        return [
+            SheetRef(self.preprocess.gene_input_file, contrast["genes_sheet"])
+            for contrast in self.preprocess.contrasts
+            if subset_genes(
+                gene_list_file=self.preprocess.gene_input_file,
+                gene_list_col=contrast["gene_list_col"],
+                genes_sheet=contrast["genes_sheet"],
+            )
+        ]
+
+    def workbook_sheets(self) -> list[SheetRef]:
+        """
+        Every excel sheet the run reads.
+        """
+        sheets = [
+            SheetRef(
+                self.imputed_data.metadata_file,
+                self.imputed_data.metadata_sheet_name,
+            ),
+            *self.gene_list_sheets(),
+        ]
+        if self.imputed_data.input_file is not None:
+            sheets.append(
+                SheetRef(
+                    self.imputed_data.input_file, self.imputed_data.sheet_name
+                )
+            )
+
+        return sheets
+
+
+def config_file_parser(config: str) -> ParameterFile:
+    config = yaml.safe_load(config)
+    print("Loaded:")
+    print(config)
+    return ParameterFile(**config)
@@ -0,0 +1,621 @@
+"""
+The stages of the analysis as plain python, without Metaflow. The
+ProteomicsAnalysis flow runs the same stages in its steps; here they run in
+one process, with the contrasts on a process pool, which starts in a
+fraction of the time and suits interactive use, e.g. in a notebook:
+
+    from proteomics.params import config_file_parser
+    from proteomics.pipeline import Pipeline
+
+    pipeline = Pipeline(config_file_parser(open("config.yaml").read()),
+                        Path("output/run1/_results"))
+    result = pipeline.run()
+    result.pca.pca_df
+
+or from the command line:
+
+    python -m proteomics.pipeline --params_file config.yaml \\
+        --results_dir output/run1/_results
+"""
+
+import argparse
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import pandas as pd
+
+from proteomics.analysis.deg_analysis.contrast import (
+    ContrastRun,
+    limma_output_files,
+    run_contrasts,
+)
+from proteomics.analysis.deg_analysis.limma import run_limma_contrasts_py
+from proteomics.analysis.io.get_raw_data import (
+    load_imputed_counts,
+    load_long_format_counts,
+)
+from proteomics.analysis.io.load_metadata import (
+    MetadataMaps,
+    create_contrast_from_metadata,
+    make_metadata,
+    validate_metadata,
+)
+from proteomics.analysis.io.matrix_store import MatrixStore
+from proteomics.analysis.io.workbook import WorkbookSession
+from proteomics.analysis.pca.pca import run_pca
+from proteomics.analysis.preprocess import normalize
+from proteomics.analysis.preprocess.export_limma import (
+    LimmaInputs,
+    make_limma_contrasts,
+)
+from proteomics.analysis.preprocess.maxlfq import run_maxlfq
+from proteomics.params import ParameterFile, config_file_parser
+from proteomics.utils.incremental import (
+    complete_manifest,
+    find_previous_results,
+    link_contrast,
+    read_manifest,
+    write_manifest,
+)
+from proteomics.utils.render import use_render_pool, wait_renders
+from proteomics.utils.stage_cache import StageCache
+
+__all__ = [
+    "Ingested",
+    "Normalized",
+    "PcaResult",
+    "ContrastPlan",
+    "PipelineResult",
+    "Pipeline",
+]
+
+
+class Ingested(NamedTuple):
+    raw_store: MatrixStore
+    """The raw counts, memory mapped"""
+    metadata_maps: MetadataMaps
+    gene_list_workbook: WorkbookSession
+    """The gene list sheets, read again when the contrasts are made"""
+    cache: StageCache
+
+
+class Normalized(NamedTuple):
+    counts_store: MatrixStore
+    """The normalized counts, memory mapped"""
+    before_norm_png: Path | None
+    """None with render.figures off"""
+    after_norm_png: Path | None
+    cache: StageCache
+
+
+class PcaResult(NamedTuple):
+    pca_df: pd.DataFrame
+    explained_variance: float
+    """Of PC 1 and 2, in percent"""
+    pca_png: Path | None
+    """None with render.figures off"""
+    scree_png: Path | None
+
+
+class ContrastPlan(NamedTuple):
+    limma_inputs: list[LimmaInputs]
+    """The contrasts to run, without the ones reused by an incremental run"""
+    contrast_keys: dict[str, str]
+    """The key of every contrast, see Pipeline.contrast_key"""
+    limma_results: dict[str, Path]
+    """The DEG tables already fit with limma.multi_contrast"""
+
+
+class PipelineResult(NamedTuple):
+    ingested: Ingested
+    normalized: Normalized
+    pca: PcaResult
+    plan: ContrastPlan
+    contrasts: list[ContrastRun]
+
+
+class Pipeline(NamedTuple):
+    """
+    The stages of the analysis, writing into results_dir. Each stage is
+    served from the stage cache when stage_cache.enabled is set.
+    """
+
+    parameters: ParameterFile
+    results_dir: Path
+
+    def _cache_enabled(self) -> bool:
+        return self.parameters.stage_cache.enabled
+
+    def _render_key(self) -> str:
+        """
+        The figures are part of the cached outputs, the render workers are
+        not.
+        """
+        return self.parameters.render.hash_params(exclude={"workers"})
+
+    def _wait_renders(self, cache: StageCache) -> None:
+        # the cache copies the figures, so they have to be written first
+        if cache.enabled:
+            wait_renders()
+
+    def _output_dir(self, stub: str) -> Path:
+        output_dir = self.results_dir / stub
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return output_dir
+
+    def ingest(self) -> Ingested:
+        """
+        Reads the counts (or computes them with MaxLFQ, or streams them
+        from a long format report) and the metadata.
+        """
+        raw_input = self.parameters.imputed_data
+        maxlfq = self.parameters.maxlfq
+        long_format = self.parameters.long_format
+
+        cache = StageCache.make(
+            "ingest",
+            params=[raw_input, maxlfq, long_format],
+            inputs=[
+                raw_input.input_file,
+                raw_input.metadata_file,
+                maxlfq.report.report_file if maxlfq else None,
+                long_format.report_file if long_format else None,
+            ],
+            enabled=self._cache_enabled(),
+        )
+        cached = cache.load(self.results_dir)
+
+        workbook = WorkbookSession.open(
+            self.parameters.gene_list_sheets()
+            if cached
+            else self.parameters.workbook_sheets(),
+            excel_engine=raw_input.excel_engine,
+            csv_engine=raw_input.csv_engine,
+        )
+
+        raw_dir = self._output_dir("raw_counts")
+        if cached:
+            metadata_maps = cached["metadata_maps"]
+            raw_store = MatrixStore(
+                raw_dir / "counts_raw.npy", raw_dir / "counts_raw.json"
+            )
+        else:
+            metadata_maps, raw_counts = self._read_counts_and_metadata(
+                workbook
+            )
+            # like the normalized counts, only the paths are pickled into
+            # the artifact and the cache
+            raw_store = MatrixStore.write(raw_counts, raw_dir, "counts_raw")
+            cache.save(
+                self.results_dir,
+                [raw_store.data_file, raw_store.index_file],
+                metadata_maps=metadata_maps,
+            )
+
+        raw_counts = raw_store.open()
+        print(
+            f"Loaded proteomics data with {raw_counts.shape[0]} genes "
+            f"and {raw_counts.shape[1]} samples"
+        )
+        validate_metadata(raw_counts, metadata_maps)
+
+        return Ingested(
+            raw_store,
+            metadata_maps,
+            # only the gene lists are read again, in export_contrasts
+            workbook.subset(self.parameters.gene_list_sheets()),
+            cache,
+        )
+
+    def _read_counts_and_metadata(
+        self, workbook: WorkbookSession
+    ) -> tuple[MetadataMaps, pd.DataFrame]:
+        raw_input = self.parameters.imputed_data
+        metadata_maps = make_metadata(
+            metadata_file=Path(raw_input.metadata_file),
+            metadata_sheet_name=raw_input.metadata_sheet_name,
+            metadata_index_col=raw_input.metadata_index_col,
+            condition_col=raw_input.condition_col,
+            workbook=workbook,
+        )
+
+        if raw_input.input_file is not None:
+            return metadata_maps, load_imputed_counts(
+                input_file=raw_input.input_file,
+                sheet_name=raw_input.sheet_name,
+                index_col=raw_input.index_col,
+                workbook=workbook,
+            )
+
+        if self.parameters.maxlfq is not None:
+            raw_counts = run_maxlfq(self.parameters.maxlfq, metadata_maps)
+        else:
+            # read in chunks, memory scales with the matrix, not the report
+            raw_counts = load_long_format_counts(
+                self.parameters.long_format, metadata_maps
+            )
+
+        # the downstream steps need a full matrix
+        complete = raw_counts.dropna()
+        print(
+            f"Dropped {raw_counts.shape[0] - complete.shape[0]} "
+            "protein groups with missing values"
+        )
+        return metadata_maps, complete
+
+    def normalize(self, ingested: Ingested) -> Normalized:
+        plot_dir = self._output_dir("normalization")
+        preprocess = self.parameters.preprocess
+
+        cache = StageCache.make(
+            "normalize",
+            params=[
+                preprocess.hash_params(
+                    exclude={"gene_input_file", "contrasts"}
+                ),
+                self._render_key(),
+            ],
+            parents=[ingested.cache],
+            enabled=self._cache_enabled(),
+        )
+
+        figures = self.parameters.render.figures
+        before_norm_png = (
+            plot_dir / "before-normalization.png" if figures else None
+        )
+        after_norm_png = plot_dir / "center-median.png" if figures else None
+
+        if cache.load(self.results_dir) is not None:
+            counts_store = MatrixStore(
+                plot_dir / "counts_norm.npy", plot_dir / "counts_norm.json"
+            )
+        else:
+            print("Normalizing data")
+            normalize_rt = normalize(
+                df=ingested.raw_store.open(),
+                plot_dir=plot_dir,
+                n_rows=preprocess.n_rows,
+                n_cols=preprocess.n_cols,
+            )
+
+            # written once and memory mapped by the contrasts instead of
+            # copying the matrix into every task or worker
+            counts_store = MatrixStore.write(
+                normalize_rt.df_norm, plot_dir, "counts_norm"
+            )
+            self._wait_renders(cache)
+            cache.save(self.results_dir, list(plot_dir.iterdir()))
+
+        print("Data normalized")
+        return Normalized(counts_store, before_norm_png, after_norm_png, cache)
+
+    def pca(self, ingested: Ingested, normalized: Normalized) -> PcaResult:
+        plot_dir = self._output_dir("pca")
+        figures = self.parameters.render.figures
+        pca_png = plot_dir / "pca.png" if figures else None
+        scree_png = plot_dir / "scree.png" if figures else None
+
+        cache = StageCache.make(
+            "pca",
+            params=[self._render_key()],
+            parents=[normalized.cache],
+            enabled=self._cache_enabled(),
+        )
+        cached = cache.load(self.results_dir)
+        if cached:
+            return PcaResult(
+                cached["pca_df"],
+                cached["explained_variance"],
+                pca_png,
+                scree_png,
+            )
+
+        print("Running PCA")
+        pca_output = run_pca(
+            df_norm=normalized.counts_store.open(),
+            metadata_maps=ingested.metadata_maps,
+            scree_fig_name=plot_dir / "scree.png",
+            pca_fig_name=plot_dir / "pca.png",
+        )
+        explained_variance = pca_output.scree_output.explained_variance
+        self._wait_renders(cache)
+        cache.save(
+            self.results_dir,
+            [x for x in (scree_png, pca_png) if x is not None],
+            pca_df=pca_output.pca_df,
+            explained_variance=explained_variance,
+        )
+
+        print("PCA finished")
+        return PcaResult(
+            pca_output.pca_df, explained_variance, pca_png, scree_png
+        )
+
+    def contrast_key(
+        self, limma_input: LimmaInputs, normalized: Normalized
+    ) -> str:
+        """
+        The hash of everything the outputs of a contrast depend on.
+        """
+        return StageCache.make(
+            "contrast",
+            params=[
+                self.parameters.limma,
+                self.parameters.heatmap,
+                self.parameters.volcano,
+                self.parameters.enrich,
+                self._render_key(),
+            ],
+            parents=[normalized.cache],
+            extra=[
+                limma_input._replace(store=None),
+                self.parameters.r.table_format,
+                self.parameters.r.csv_copy,
+            ],
+            enabled=False,
+        ).key
+
+    def limma_cache(
+        self,
+        stage: str,
+        limma_inputs: list[LimmaInputs],
+        normalized: Normalized,
+    ) -> StageCache:
+        return StageCache.make(
+            stage,
+            params=[self.parameters.limma],
+            parents=[normalized.cache],
+            # the store is the same matrix as the normalize key
+            extra=[
+                [x._replace(store=None) for x in limma_inputs],
+                self.parameters.r.table_format,
+                self.parameters.r.csv_copy,
+            ],
+            enabled=self._cache_enabled(),
+        )
+
+    def export_contrasts(
+        self, ingested: Ingested, normalized: Normalized
+    ) -> ContrastPlan:
+        """
+        Makes the contrasts, writes the pending manifest, leaves out the
+        unchanged contrasts of an incremental run and fits all of them at
+        once with limma.multi_contrast.
+        """
+        preprocess = self.parameters.preprocess
+        gene_input_file = (
+            Path(preprocess.gene_input_file)
+            if preprocess.gene_input_file
+            else None
+        )
+
+        print("Getting contrasts")
+        contrast_list = create_contrast_from_metadata(
+            ingested.metadata_maps,
+            preprocess.contrasts,
+        )
+
+        print("Exporting limma contrasts")
+        limma_inputs = make_limma_contrasts(
+            normalized.counts_store,
+            output_dir=self._output_dir("limma_inputs"),
+            contrast_list=contrast_list,
+            gene_list_file=gene_input_file,
+            workbook=ingested.gene_list_workbook,
+        )
+
+        contrast_keys = {
+            x.contrast_name: self.contrast_key(x, normalized)
+            for x in limma_inputs
+        }
+        write_manifest(self.results_dir, contrast_keys)
+        if self.parameters.incremental.enabled:
+            limma_inputs = self.schedule_contrasts(limma_inputs, contrast_keys)
+
+        limma_results = {}
+        if self.parameters.limma.multi_contrast and limma_inputs:
+            scheduled = {x.contrast_name for x in limma_inputs}
+            limma_results = self.fit_contrasts(
+                [
+                    x
+                    for x in contrast_list
+                    if "{}_vs_{}".format(*x["contrast"]) in scheduled
+                ],
+                limma_inputs,
+                ingested,
+                normalized,
+            )
+
+        return ContrastPlan(limma_inputs, contrast_keys, limma_results)
+
+    def schedule_contrasts(
+        self, limma_inputs: list[LimmaInputs], contrast_keys: dict[str, str]
+    ) -> list[LimmaInputs]:
+        """
+        Links the outputs of the contrasts that did not change since the
+        previous run.
+
+        Returns: The contrasts that are new or changed, empty if none
+        """
+        previous_results = (
+            self.parameters.incremental.previous_results
+            or find_previous_results(self.results_dir)
+        )
+        if previous_results is None:
+            print("No finished previous run found, running every contrast")
+            return limma_inputs
+
+        previous_keys = read_manifest(Path(previous_results))
+        unchanged = [
+            x
+            for x in limma_inputs
+            if previous_keys.get(x.contrast_name)
+            == contrast_keys[x.contrast_name]
+        ]
+        for limma_input in unchanged:
+            link_contrast(
+                Path(previous_results),
+                self.results_dir,
+                limma_input.contrast_name,
+            )
+
+        scheduled = [x for x in limma_inputs if x not in unchanged]
+        print(
+            f"Reusing {len(unchanged)} contrasts from {previous_results}, "
+            f"running {len(scheduled)}"
+        )
+        return scheduled
+
+    def fit_contrasts(
+        self,
+        contrast_list: list,
+        limma_inputs: list[LimmaInputs],
+        ingested: Ingested,
+        normalized: Normalized,
+    ) -> dict[str, Path]:
+        """
+        Fits limma once for all the contrasts (limma.multi_contrast).
+
+        Returns: The DEG table of every contrast
+        """
+        limma_cache = self.limma_cache(
+            "limma_contrasts", limma_inputs, normalized
+        )
+        cached = limma_cache.load(self.results_dir)
+        if cached:
+            return {
+                name: self.results_dir / path
+                for name, path in cached["limma_results"].items()
+            }
+
+        print("Running limma on all contrasts at once")
+        preprocess = self.parameters.preprocess
+        limma_results = run_limma_contrasts_py(
+            normalized.counts_store.open(),
+            metadata_maps=ingested.metadata_maps,
+            contrast_list=contrast_list,
+            gene_list_file=Path(preprocess.gene_input_file)
+            if preprocess.gene_input_file
+            else None,
+            output_dir=self.results_dir,
+            fc_threshold=self.parameters.limma.fc_threshold,
+            pval_threshold=self.parameters.limma.pval_threshold,
+            workbook=ingested.gene_list_workbook,
+            table_format=self.parameters.r.table_format,
+            csv_copy=self.parameters.r.csv_copy,
+        )
+
+        limma_cache.save(
+            self.results_dir,
+            [
+                file
+                for name in limma_results
+                for file in limma_output_files(self.results_dir, name)
+            ],
+            limma_results={
+                name: path.relative_to(self.results_dir)
+                for name, path in limma_results.items()
+            },
+        )
+        return limma_results
+
+    def contrast_kwargs(self) -> dict:
+        """
+        The settings of run_contrast.
+        """
+        return dict(
+            results_dir=self.results_dir,
+            limma=self.parameters.limma,
+            r_config=self.parameters.r,
+            heatmap=self.parameters.heatmap,
+            volcano=self.parameters.volcano,
+            enrich=self.parameters.enrich,
+            render=self.parameters.render,
+        )
+
+    def run_contrasts(
+        self,
+        limma_inputs: list[LimmaInputs],
+        limma_results: dict[str, Path],
+        normalized: Normalized,
+        *,
+        max_workers: int,
+    ) -> list[ContrastRun]:
+        """
+        limma and the steps after it for the contrasts, on a pool of
+        max_workers processes.
+
+        Args:
+            limma_results: ContrastPlan.limma_results
+        """
+        multi_contrast = self.parameters.limma.multi_contrast
+        return run_contrasts(
+            limma_inputs,
+            max_workers=max_workers,
+            limma_caches=None
+            if multi_contrast
+            else {
+                x.contrast_name: self.limma_cache("limma", [x], normalized)
+                for x in limma_inputs
+            },
+            result_paths=limma_results if multi_contrast else None,
+            **self.contrast_kwargs(),
+        )
+
+    def run(self, *, max_workers: int | None = None) -> PipelineResult:
+        """
+        Runs every stage. The figures of normalize and pca are drawn on the
+        render pool while the next stages run.
+
+        Args:
+            max_workers: Processes for the contrasts, the CPUs of the
+                machine if None
+        """
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+
+        with use_render_pool(self.parameters.render):
+            ingested = self.ingest()
+            normalized = self.normalize(ingested)
+            pca = self.pca(ingested, normalized)
+            plan = self.export_contrasts(ingested, normalized)
+            contrasts = self.run_contrasts(
+                plan.limma_inputs,
+                plan.limma_results,
+                normalized,
+                max_workers=max_workers or os.cpu_count() or 1,
+            )
+
+        # the contrasts of this run can be reused from now on
+        complete_manifest(self.results_dir)
+
+        return PipelineResult(ingested, normalized, pca, plan, contrasts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--params_file", type=Path, required=True)
+    parser.add_argument(
+        "--results_dir",
+        type=Path,
+        required=True,
+        help="Where the outputs are written, the _results of a flow run",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="Processes for the contrasts, all CPUs by default",
+    )
+    args = parser.parse_args()
+
+    Pipeline(
+        config_file_parser(args.params_file.read_text()), args.results_dir
+    ).run(max_workers=args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Applies new significance thresholds to a finished run without running
+limma again. The significant gene lists are rewritten from the stored DEG
+tables. Heatmaps and enrichment are only redone for contrasts whose
+significant set changed, volcano plots when the set or the thresholds
+changed (the cutoffs are drawn on the plot).
+
+    python -m proteomics.rethreshold --params_file config.yaml \\
+        --results_dir .metaflow/ProteomicsAnalysis/<run>/_results \\
+        --fc_threshold 2 --pval_threshold 0.01 --enrichment
+"""
+
+import argparse
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import NamedTuple
+
+import pandas as pd
+
+from proteomics.analysis.deg_analysis.R.run_enrichment import (
+    fix_enrichment_results,
+    make_enrichment_analysis,
+)
+from proteomics.analysis.deg_analysis.R.volcano_plot import make_volcano_plot
+from proteomics.analysis.deg_analysis.base_args import r_session
+from proteomics.analysis.deg_analysis.deg_results import DegResults
+from proteomics.analysis.deg_analysis.heatmap import make_heatmap_sample
+from proteomics.analysis.deg_analysis.limma import write_significant_genes
+from proteomics.analysis.deg_analysis.post_deg import (
+    fix_kegg_results,
+    heatmap_kwargs,
+)
+from proteomics.analysis.io.tabular import FEATHER_SUFFIXES
+from proteomics.analysis.preprocess.export_limma import (
+    LimmaInputs,
+    read_limma_inputs,
+)
+from proteomics.params import ParameterFile, config_file_parser
+from proteomics.utils.render import figures_enabled, use_render_pool
+from proteomics.utils.run_r import run_analyses
+
+__all__ = [
+    "STATE_FILE",
+    "ContrastResults",
+    "find_contrasts",
+    "rethreshold_contrast",
+    "rethreshold_run",
+]
+
+STATE_FILE = "thresholds.json"
+"""Per contrast record of the genes and thresholds the plots were made with"""
+
+
+class ContrastResults(NamedTuple):
+    """
+    The stored outputs of one contrast of a run.
+    """
+
+    limma_input: LimmaInputs
+    contrast_dir: Path
+    deg_file: Path
+
+    @property
+    def sig_output_dir(self) -> Path:
+        return self.contrast_dir / "limma_sig_results"
+
+    @property
+    def sig_file(self) -> Path:
+        name = self.limma_input.contrast_name
+        return self.sig_output_dir / f"{name}_deg_limma_sig.csv"
+
+    @property
+    def state_file(self) -> Path:
+        return self.contrast_dir / STATE_FILE
+
+
+def find_contrasts(results_dir: Path) -> list[ContrastResults]:
+    """
+    The contrasts of a run that have a DEG table.
+    """
+    contrasts = []
+    for spec_file in sorted((results_dir / "limma_inputs").glob("*.json")):
+        limma_input = read_limma_inputs(spec_file)
+        contrast_dir = results_dir / limma_input.contrast_name
+        # prefer the feather table over its csv copy
+        deg_files = sorted(
+            (contrast_dir / "limma_outputs").glob(
+                f"{limma_input.contrast_name}_deg_limma.*"
+            ),
+            key=lambda x: x.suffix not in FEATHER_SUFFIXES,
+        )
+        if not deg_files:
+            print(f"No DEG table for {limma_input.contrast_name}, skipping")
+            continue
+
+        contrasts.append(
+            ContrastResults(limma_input, contrast_dir, deg_files[0])
+        )
+
+    return contrasts
+
+
+def _genes_digest(genes: pd.Index) -> str:
+    return hashlib.sha256(
+        "\n".join(sorted(map(str, genes))).encode()
+    ).hexdigest()
+
+
+def _read_state(contrast: ContrastResults, parameters: ParameterFile) -> dict:
+    """
+    What the current plots were made with. A run that was never
+    re-thresholded has no state file, so it is taken from the files of the
+    run and the thresholds in the params file.
+    """
+    if contrast.state_file.exists():
+        return json.loads(contrast.state_file.read_text())
+
+    genes = None
+    if contrast.sig_file.exists():
+        genes = _genes_digest(
+            pd.read_csv(contrast.sig_file, index_col=0).index
+        )
+
+    enrich_dir = contrast.contrast_dir / "enrichment"
+    has_enrichment = enrich_dir.exists() and any(enrich_dir.iterdir())
+
+    return {
+        "genes": genes,
+        "volcano": [
+            parameters.volcano.fc_threshold,
+            parameters.volcano.pval_threshold,
+        ],
+        "enrichment": genes if has_enrichment else None,
+    }
+
+
+def _clean_dir(output_dir: Path) -> Path:
+    """
+    Removes the outputs of the old thresholds, so that files the new run
+    does not write are not left behind.
+    """
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True)
+    return output_dir
+
+
+def _unlink_contrast_dir(contrast_dir: Path) -> None:
+    """
+    Replaces a contrast linked from an earlier run by an incremental run
+    with a copy, so that the earlier run is not changed.
+    """
+    target = contrast_dir.resolve()
+    contrast_dir.unlink()
+    shutil.copytree(target, contrast_dir, symlinks=True)
+
+
+def rethreshold_contrast(
+    contrast: ContrastResults,
+    parameters: ParameterFile,
+    *,
+    fc_threshold: float,
+    pval_threshold: float,
+    enrichment: bool = False,
+) -> None:
+    """
+    Rewrites the significant genes of a contrast and redoes the plots that
+    depend on them.
+    """
+    limma_input = contrast.limma_input
+    name = limma_input.contrast_name
+    if contrast.contrast_dir.is_symlink():
+        _unlink_contrast_dir(contrast.contrast_dir)
+    state = _read_state(contrast, parameters)
+
+    sig_genes = DegResults.read(contrast.deg_file).significant(
+        fc_threshold, pval_threshold
+    )
+    genes = _genes_digest(sig_genes.index)
+
+    contrast.sig_output_dir.mkdir(parents=True, exist_ok=True)
+    write_significant_genes(
+        sig_genes,
+        sig_output_dir=contrast.sig_output_dir,
+        contrast_name=name,
+        contrast_formula=f"{name} = {limma_input.contrast_1} - "
+        f"{limma_input.contrast_2}",
+        fc_threshold=fc_threshold,
+        pval_threshold=pval_threshold,
+    )
+
+    if genes == state["genes"]:
+        print(f"Significant genes of {name} did not change")
+    elif len(sig_genes) == 0:
+        print(f"No significant genes for {name}, not making a heatmap")
+        _clean_dir(contrast.contrast_dir / "heatmap")
+        state["genes"] = genes
+    else:
+        print(f"Making heatmap for {name}")
+        heatmap = make_heatmap_sample(
+            counts_df=limma_input.counts(),
+            metadata_df=limma_input.metadata(),
+            limma_results_file=contrast.deg_file,
+            output_dir=_clean_dir(contrast.contrast_dir / "heatmap"),
+            fc_cutoff=fc_threshold,
+            pval_cutoff=pval_threshold,
+            make_heatmap_kwargs=heatmap_kwargs(parameters.heatmap, name),
+        )
+        # with the figures off the old heatmap is still out of date
+        if heatmap is not None:
+            state["genes"] = genes
+
+    thresholds = {
+        "fc_threshold": fc_threshold,
+        "pval_threshold": pval_threshold,
+    }
+
+    # the volcano plot and the enrichment run at the same time
+    analyses = {}
+    volcano_changed = state["volcano"] != [fc_threshold, pval_threshold]
+    if volcano_changed and figures_enabled():
+        print(f"Making volcano plot for {name}")
+        analyses["volcano"] = make_volcano_plot(
+            r_config=parameters.r,
+            output_dir=_clean_dir(contrast.contrast_dir / "volcano"),
+            deg_results=contrast.deg_file,
+            experiment=name,
+            volcano_args=parameters.volcano.model_copy(update=thresholds),
+        )
+
+    if enrichment and genes != state["enrichment"]:
+        print(f"Running enrichment analysis for {name}")
+        analyses["enrichment"] = make_enrichment_analysis(
+            r_config=parameters.r,
+            output_dir=_clean_dir(contrast.contrast_dir / "enrichment"),
+            deg_results=contrast.deg_file,
+            experiment=name,
+            enrichment_args=parameters.enrich.model_copy(update=thresholds),
+        )
+
+    results = dict(zip(analyses, run_analyses(list(analyses.values()))))
+
+    if "volcano" in results:
+        state["volcano"] = [fc_threshold, pval_threshold]
+
+    if "enrichment" in results:
+        fix_kegg_results(
+            fix_enrichment_results(results["enrichment"] or []),
+            _clean_dir(contrast.contrast_dir / "kegg_fixed"),
+        )
+        state["enrichment"] = genes
+
+    contrast.state_file.write_text(json.dumps(state, indent=2))
+
+
+def rethreshold_run(
+    results_dir: Path,
+    parameters: ParameterFile,
+    *,
+    fc_threshold: float,
+    pval_threshold: float,
+    enrichment: bool = False,
+    contrast_names: list[str] | None = None,
+) -> None:
+    """
+    Re-thresholds every contrast of a run, or the ones in contrast_names.
+    """
+    contrasts = [
+        x
+        for x in find_contrasts(results_dir)
+        if contrast_names is None
+        or x.limma_input.contrast_name in contrast_names
+    ]
+    print(f"Re-thresholding {len(contrasts)} contrasts in {results_dir}")
+
+    # the heatmaps are drawn on the render pool while the next contrasts run
+    with r_session(parameters.r), use_render_pool(parameters.render):
+        for contrast in contrasts:
+            rethreshold_contrast(
+                contrast,
+                parameters,
+                fc_threshold=fc_threshold,
+                pval_threshold=pval_threshold,
+                enrichment=enrichment,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--results_dir",
+        type=Path,
+        required=True,
+        help="The _results directory of a run",
+    )
+    parser.add_argument(
+        "--params_file",
+        type=Path,
+        required=True,
+        help="The config of the run, for the plot and R settings",
+    )
+    parser.add_argument("--fc_threshold", type=float, required=True)
+    parser.add_argument("--pval_threshold", type=float, required=True)
+    parser.add_argument(
+        "--enrichment",
+        action="store_true",
+        help="Also redo the enrichment analysis",
+    )
+    parser.add_argument(
+        "--contrasts",
+        nargs="+",
+        default=None,
+        help="Only these contrasts, all of them by default",
+    )
+    args = parser.parse_args()
+
+    rethreshold_run(
+        args.results_dir,
+        config_file_parser(args.params_file.read_text()),
+        fc_threshold=args.fc_threshold,
+        pval_threshold=args.pval_threshold,
+        enrichment=args.enrichment,
+        contrast_names=args.contrasts,
+    )
+
+
+if __name__ == "__main__":
+    main()
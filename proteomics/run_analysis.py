@@ -1,9 +1,8 @@
+from __future__ import annotations
+
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-import pandas as pd
-import yaml
-from matplotlib.colors import LinearSegmentedColormap
 from metaflow import (
     FlowSpec,
     step,
@@ -12,59 +11,55 @@ from metaflow import (
     IncludeFile,
 )
 from metaflow.cards import Image, Markdown, Table
-from PIL import Image as PILImage
 
-from proteomics.analysis.deg_analysis.R.limma import run_limma_r
-from proteomics.analysis.deg_analysis.R.run_enrichment import (
-    EnrichmentArgs,
-    run_enrichment_r,
-)
-from proteomics.analysis.deg_analysis.R.volcano_plot import (
-    VolcanoArgs,
-    run_volcano_plot_r,
-)
-from proteomics.analysis.deg_analysis.base_args import RConfig
-from proteomics.analysis.deg_analysis.fix_kegg_ids import fix_kegg_ids
-from proteomics.analysis.deg_analysis.heatmap import (
-    make_heatmap_sample,
-    MakeHeatmapOtherKwargs,
-)
-from proteomics.analysis.io.get_raw_data import (
-    load_imputed_counts,
-    ImputedIntensity,
-)
-from proteomics.analysis.io.load_metadata import MetadataMaps, make_metadata, \
-    validate_metadata, create_contrast_from_metadata
-from proteomics.analysis.pca.pca import run_pca
-from proteomics.analysis.preprocess import (
-    PreprocessParams,
-    normalize,
-)
-from proteomics.analysis.preprocess.export_limma import (
-    make_limma_contrasts,
-    LimmaInputs,
-)
-from proteomics.utils.base_params import BaseParams
 from proteomics.utils.metaflow_util import get_task_output, get_run_output
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from proteomics.analysis.deg_analysis.R.run_enrichment import (
+        EnrichResult,
+    )
+    from proteomics.analysis.deg_analysis.base_args import RConfig
+    from proteomics.analysis.preprocess.export_limma import LimmaInputs
+    from proteomics.params import ParameterFile, config_file_parser
+    from proteomics.pipeline import Ingested, Normalized, Pipeline
+
+# every task imports this module, so the analysis modules (pandas,
+# matplotlib, scipy) are imported by the steps that use them and the join
+# steps start without them, see proteomics.utils.startup
+
+# ParameterFile and config_file_parser moved to proteomics.params
+__all__ = [
+    "ParameterFile",
+    "config_file_parser",
+    "ProteomicsAnalysis",
+]
+
 
-class ParameterFile(BaseParams):
-    imputed_data: ImputedIntensity
-    preprocess: PreprocessParams
-    r: RConfig
-    heatmap: MakeHeatmapOtherKwargs
-    volcano: VolcanoArgs
-    enrich: EnrichmentArgs
+def __getattr__(name: str):
+    if name in ("ParameterFile", "config_file_parser"):
+        from proteomics import params
 
+        return getattr(params, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-def config_file_parser(config: str) -> ParameterFile:
-    config = yaml.safe_load(config)
-    print("Loaded:")
-    print(config)
-    return ParameterFile(**config)
+
+def png_image(path: Path, label: str | None = None) -> Image:
+    """
+    A card image of a PNG file.
+    """
+    from PIL import Image as PILImage
+
+    return Image.from_pil_image(PILImage.open(path), label)
 
 
 class ProteomicsAnalysis(FlowSpec):
+    """
+    Runs the stages of proteomics.pipeline as metaflow steps, with a task
+    per contrast and cards for every step.
+    """
+
     params_file: str = IncludeFile(
         "params_file",
         # default=(get_project_root() / "config.yaml").__str__(),
@@ -73,19 +68,20 @@ class ProteomicsAnalysis(FlowSpec):
     parameters: ParameterFile
 
     _run_output_dir: Path
-    preprocess_config: PreprocessParams
-    raw_input_config: ImputedIntensity
+    pipeline: Pipeline
     r_config: RConfig
 
-    raw_counts: pd.DataFrame
-    metadata_maps: MetadataMaps
-
-    counts_norm: pd.DataFrame
+    ingested: Ingested
+    normalized: Normalized
 
     pca_df: pd.DataFrame
 
     limma_inputs: list[LimmaInputs]
+    contrast_keys: dict[str, str]
+    execution_mode: str
+    contrast_batches: list[list[LimmaInputs]]
     limma_input: LimmaInputs
+    limma_results: dict[str, Path]
 
     result_path: Path | None
     kegg_results: list[Path] | None
@@ -100,17 +96,19 @@ class ProteomicsAnalysis(FlowSpec):
     @card
     @step
     def start(self):
+        from proteomics.params import config_file_parser
+        from proteomics.pipeline import Pipeline
+
         self.parameters = config_file_parser(self.params_file)
 
         print("Config loaded and validated")
 
-        self.preprocess_config = self.parameters.preprocess
-        self.raw_input_config = self.parameters.imputed_data
         self.r_config = self.parameters.r
 
         self._run_output_dir = get_run_output(self) / "_results"
         print(f"Creating output directory: {self._run_output_dir}")
         self._run_output_dir.mkdir(exist_ok=True)
+        self.pipeline = Pipeline(self.parameters, self._run_output_dir)
         print("Starting analysis")
 
         self.next(self.load_raw_counts_and_metadata)
@@ -120,29 +118,14 @@ class ProteomicsAnalysis(FlowSpec):
     def load_raw_counts_and_metadata(self):
         print("Loading raw counts and metadata")
 
-        self.raw_counts = load_imputed_counts(
-            input_file=self.raw_input_config.input_file,
-            sheet_name=self.raw_input_config.sheet_name,
-            index_col=self.raw_input_config.index_col,
-        )
-
-        counts_info = (
-            f"Loaded proteomics data with {self.raw_counts.shape[0]} genes "
-            f"and {self.raw_counts.shape[1]} samples"
-        )
-        print(counts_info)
-        current.card.append(Markdown(counts_info))
-
-        self.metadata_maps = make_metadata(
-            metadata_file=Path(self.raw_input_config.metadata_file),
-            metadata_sheet_name=self.raw_input_config.metadata_sheet_name,
-            metadata_index_col=self.raw_input_config.metadata_index_col,
-            condition_col=self.raw_input_config.condition_col,
-        )
+        self.ingested = self.pipeline.ingest()
 
-        validate_metadata(
-            self.raw_counts,
-            self.metadata_maps,
+        genes, samples = self.ingested.raw_store.labels()
+        current.card.append(
+            Markdown(
+                f"Loaded proteomics data with {len(genes)} genes "
+                f"and {len(samples)} samples"
+            )
         )
 
         self.next(self.normalize_data)
@@ -150,104 +133,149 @@ class ProteomicsAnalysis(FlowSpec):
     @card
     @step
     def normalize_data(self):
-        plot_dir = self.create_output_dir("normalization")
-
-        print("Normalizing data")
-        normalize_rt = normalize(
-            df=self.raw_counts,
-            plot_dir=plot_dir,
-            n_rows=self.preprocess_config.n_rows,
-            n_cols=self.preprocess_config.n_cols,
-        )
+        from proteomics.utils.render import use_render_pool
+
+        # the histograms are drawn while the normalized counts are written
+        with use_render_pool(self.parameters.render):
+            self.normalized = self.pipeline.normalize(self.ingested)
 
-        self.counts_norm = normalize_rt.df_norm
         current.card.append(Markdown("## Before Normalization"))
-        current.card.append(
-            Image.from_matplotlib(normalize_rt.before_norm_fig),
-            "Before normalization",
+        self.add_png_card(
+            self.normalized.before_norm_png, "Before normalization"
         )
         current.card.append(Markdown("## After Normalization"))
-        current.card.append(
-            Image.from_matplotlib(normalize_rt.after_norm_fig),
-            "After normalization",
+        self.add_png_card(
+            self.normalized.after_norm_png, "After normalization"
         )
 
-        print("Data normalized")
         self.next(self.pca, self.export_limma_contrasts)
 
     @card
     @step
     def pca(self):
-        plot_dir = self.create_output_dir("pca")
+        from proteomics.utils.render import use_render_pool
 
-        print("Running PCA")
-
-        pca_output = run_pca(
-            df_norm=self.counts_norm,
-            metadata_maps=self.metadata_maps,
-            scree_fig_name=plot_dir / "scree.png",
-            pca_fig_name=plot_dir / "pca.png",
-        )
-
-        self.pca_df = pca_output.pca_df
+        with use_render_pool(self.parameters.render):
+            pca_result = self.pipeline.pca(self.ingested, self.normalized)
+        self.pca_df = pca_result.pca_df
 
         current.card.append(Markdown("## PCA"))
-        current.card.append(Image.from_matplotlib(pca_output.pca_fig, "PCA"))
+        self.add_png_card(pca_result.pca_png, "PCA")
 
         current.card.append(Markdown("## Scree plot"))
         current.card.append(
             Markdown(
-                f"Explained variance of PC 1 and 2: {pca_output.scree_output.explained_variance:.2f}%"
+                "Explained variance of PC 1 and 2: "
+                f"{pca_result.explained_variance:.2f}%"
             )
         )
-        current.card.append(
-            Image.from_matplotlib(pca_output.scree_output.figure, "Scree plot")
-        )
-
-        print("PCA finished")
+        self.add_png_card(pca_result.scree_png, "Scree plot")
 
         self.next(self.join_pca_and_limma)
 
+    def add_png_card(self, png: Path | None, label: str):
+        if png is None:
+            current.card.append(Markdown(f"{label}: render.figures is off"))
+        else:
+            current.card.append(png_image(png, label))
+
     @card
     @step
     def export_limma_contrasts(self):
-        limma_input_dir = self.create_output_dir("limma_inputs")
+        plan = self.pipeline.export_contrasts(self.ingested, self.normalized)
+        self.limma_inputs = plan.limma_inputs
+        self.contrast_keys = plan.contrast_keys
+        self.limma_results = plan.limma_results
 
-        print("Getting contrasts")
-        contrast_list = create_contrast_from_metadata(
-            self.metadata_maps,
-            self.preprocess_config.contrasts,
-        )
+        print("Limma contrasts exported")
 
-        print("Exporting limma contrasts")
-        self.limma_inputs = make_limma_contrasts(
-            df=self.counts_norm,
-            output_dir=limma_input_dir,
-            contrast_list=contrast_list,
-            gene_list_file=Path(self.preprocess_config.gene_input_file)
-            if self.preprocess_config.gene_input_file
-            else None,
+        # a foreach can not be empty, e.g. when an incremental run found
+        # nothing changed
+        self.execution_mode = (
+            self.parameters.execution.mode if self.limma_inputs else "none"
+        )
+        self.next(
+            {
+                "split": self.fan_out_contrasts,
+                "fused": self.fan_out_fused_contrasts,
+                "batched": self.fan_out_contrast_batches,
+                "none": self.skip_contrasts,
+            },
+            condition="execution_mode",
         )
 
-        print("Limma contrasts exported")
+    @step
+    def skip_contrasts(self):
+        print("No contrast to run")
+        self.next(self.join_pca_and_limma)
 
+    @step
+    def fan_out_contrasts(self):
         self.next(self.run_limma, foreach="limma_inputs")
 
+    @step
+    def fan_out_fused_contrasts(self):
+        self.next(self.run_contrast, foreach="limma_inputs")
+
+    @step
+    def fan_out_contrast_batches(self):
+        from proteomics.analysis.deg_analysis.contrast import make_batches
+
+        self.contrast_batches = make_batches(
+            self.limma_inputs, self.parameters.execution.batches
+        )
+        print(
+            f"Running {len(self.limma_inputs)} contrasts in "
+            f"{len(self.contrast_batches)} batches"
+        )
+        self.next(self.run_contrast_batch, foreach="contrast_batches")
+
+    def limma_cache_of(self, limma_input: LimmaInputs):
+        """
+        The limma stage cache of a contrast, None with multi_contrast.
+        """
+        if self.parameters.limma.multi_contrast:
+            return None
+        return self.pipeline.limma_cache(
+            "limma", [limma_input], self.normalized
+        )
+
     @card
     @step
     def run_limma(self):
+        self.limma_contrast()
+
+        self.next(self.run_heatmap, self.run_volcano_plot, self.run_enrichment)
+
+    def limma_contrast(self):
+        """
+        Runs limma for the contrast of the foreach, or restores it from the
+        stage cache, and sets result_path.
+        """
         print("Running limma")
         self.limma_input = self.input
 
-        self.create_output_dir(f"{self.limma_input.contrast_name}")
+        self.add_limma_card()
 
-        limma_output_dir = self.create_output_dir(
-            f"{self.limma_input.contrast_name}/limma_outputs"
-        )
-        limma_sig_results_dir = self.create_output_dir(
-            f"{self.limma_input.contrast_name}/limma_sig_results"
-        )
+        if self.parameters.limma.multi_contrast:
+            # already fit with the other contrasts in export_limma_contrasts
+            self.result_path = self.limma_results[
+                self.limma_input.contrast_name
+            ]
+        else:
+            from proteomics.analysis.deg_analysis.contrast import (
+                fit_contrast,
+            )
 
+            self.result_path = fit_contrast(
+                self.limma_input,
+                results_dir=self._run_output_dir,
+                limma=self.parameters.limma,
+                r_config=self.r_config,
+                limma_cache=self.limma_cache_of(self.limma_input),
+            )
+
+    def add_limma_card(self):
         current.card.append(
             Markdown(f"## Limma for {self.limma_input.contrast_name}")
         )
@@ -257,22 +285,22 @@ class ProteomicsAnalysis(FlowSpec):
             )
         )
 
-        self.result_path = run_limma_r(
-            r_config=self.r_config,
-            output_dir=limma_output_dir,
-            counts=self.limma_input.counts_file,
-            metadata=self.limma_input.metadata_file,
-            sig_output_dir=limma_sig_results_dir,
-            contrast_name=self.limma_input.contrast_name,
-            contrast_1=self.limma_input.contrast_1,
-            contrast_2=self.limma_input.contrast_2,
-        )
-
-        self.next(self.run_heatmap, self.run_volcano_plot, self.run_enrichment)
-
     @card
     @step
     def run_volcano_plot(self):
+        from proteomics.analysis.deg_analysis.R.volcano_plot import (
+            run_volcano_plot_r,
+        )
+        from proteomics.analysis.deg_analysis.base_args import r_session
+
+        if not self.parameters.render.figures:
+            print("Figures are off, no volcano plot")
+            current.card.append(
+                Markdown("Volcano plot: render.figures is off")
+            )
+            self.next(self.join_post_deg)
+            return
+
         volcano_output = self.create_output_dir(
             f"{self.limma_input.contrast_name}/volcano"
         )
@@ -290,27 +318,35 @@ class ProteomicsAnalysis(FlowSpec):
             Markdown(f"### Volcano plot for {self.limma_input.contrast_name}")
         )
 
-        volcano_png = run_volcano_plot_r(
-            r_config=self.r_config,
-            output_dir=volcano_output,
-            deg_results=self.result_path,
-            experiment=self.limma_input.contrast_name,
-            volcano_args=self.parameters.volcano,
-        )
-
-        if volcano_png:
-            print("Plotting volcano plot: ", volcano_png)
-            current.card.append(
-                Image.from_pil_image(
-                    PILImage.open(volcano_png), "Volcano plot"
-                )
+        # a single R script, not worth preloading a worker pool
+        with r_session(self.r_config, pool=False):
+            volcano_png = run_volcano_plot_r(
+                r_config=self.r_config,
+                output_dir=volcano_output,
+                deg_results=self.result_path,
+                experiment=self.limma_input.contrast_name,
+                volcano_args=self.parameters.volcano,
             )
 
+        self.add_volcano_card(volcano_png)
+
         self.next(self.join_post_deg)
 
+    def add_volcano_card(self, volcano_png: Path | None):
+        if volcano_png:
+            print("Plotting volcano plot: ", volcano_png)
+            current.card.append(png_image(volcano_png, "Volcano plot"))
+
     @card
     @step
     def run_heatmap(self):
+        from proteomics.analysis.deg_analysis.heatmap import (
+            make_heatmap_sample,
+        )
+        from proteomics.analysis.deg_analysis.post_deg import heatmap_kwargs
+        from proteomics.utils.render import use_render_pool
+        from proteomics.utils.slots import slot, use_slots
+
         heatmap_output = self.create_output_dir(
             f"{self.limma_input.contrast_name}/heatmap"
         )
@@ -322,37 +358,41 @@ class ProteomicsAnalysis(FlowSpec):
             )
             self.next(self.join_post_deg)
 
-        # Define the colors
-        colors = ["royalblue", "white", "red"]
-        # Create the colormap
-        cmap = LinearSegmentedColormap.from_list("custom_cmap", colors, N=100)
-
-        heatmap = make_heatmap_sample(
-            counts_file=self.limma_input.counts_file,
-            metadata_file=self.limma_input.metadata_file,
-            limma_results_file=self.result_path,
-            output_dir=heatmap_output,
-            make_heatmap_kwargs=MakeHeatmapOtherKwargs(
-                title=self.limma_input.contrast_name,
-                cmap=cmap,
-                **self.parameters.heatmap.model_dump(
-                    exclude={"cmap", "title"}, exclude_unset=True
+        # the heatmap is drawn in the task, it shares the plot slots with
+        # the volcano plots
+        with (
+            use_slots(self.r_config.slots),
+            slot("plot"),
+            use_render_pool(self.parameters.render, workers=0),
+        ):
+            heatmap = make_heatmap_sample(
+                counts_df=self.limma_input.counts(),
+                metadata_df=self.limma_input.metadata(),
+                limma_results_file=self.result_path,
+                output_dir=heatmap_output,
+                make_heatmap_kwargs=heatmap_kwargs(
+                    self.parameters.heatmap, self.limma_input.contrast_name
                 ),
-            ),
-        )
+            )
+
+        self.add_heatmap_card(heatmap)
+
+        self.next(self.join_post_deg)
 
+    def add_heatmap_card(self, heatmap: Path | None):
         current.card.append(
             Markdown(f"### Heatmap for {self.limma_input.contrast_name}")
         )
-        current.card.append(
-            Image.from_pil_image(PILImage.open(heatmap), "Heatmap")
-        )
-
-        self.next(self.join_post_deg)
+        self.add_png_card(heatmap, "Heatmap")
 
     @card
     @step
     def run_enrichment(self):
+        from proteomics.analysis.deg_analysis.R.run_enrichment import (
+            run_enrichment_r,
+        )
+        from proteomics.analysis.deg_analysis.base_args import r_session
+
         enrich_output = self.create_output_dir(
             f"{self.limma_input.contrast_name}/enrichment"
         )
@@ -366,15 +406,28 @@ class ProteomicsAnalysis(FlowSpec):
 
         print("Running enrichment analysis")
 
-        enrich_results = run_enrichment_r(
-            r_config=self.r_config,
-            output_dir=enrich_output,
-            deg_results=self.result_path,
-            experiment=self.limma_input.contrast_name,
-            enrichment_args=self.parameters.enrich,
-        )
+        # a single R script, not worth preloading a worker pool
+        with r_session(self.r_config, pool=False):
+            enrich_results = run_enrichment_r(
+                r_config=self.r_config,
+                output_dir=enrich_output,
+                deg_results=self.result_path,
+                experiment=self.limma_input.contrast_name,
+                enrichment_args=self.parameters.enrich,
+            )
         print(enrich_results)
 
+        self.add_enrichment_cards(enrich_results)
+
+        self.next(self.fix_kegg_gene_ids)
+
+    def add_enrichment_cards(self, enrich_results: list[EnrichResult]):
+        """
+        Adds the enrichment results to the card and sets kegg_results and
+        gene_ids for fix_kegg_gene_ids.
+        """
+        import pandas as pd
+
         self.kegg_results = []
         self.gene_ids = None
 
@@ -402,16 +455,16 @@ class ProteomicsAnalysis(FlowSpec):
                 print("Reading gene ids")
                 self.gene_ids = pd.read_csv(result.file_path)
             elif result.result_type == "plot":
-                current.card.append(
-                    Image.from_pil_image(PILImage.open(result.file_path))
-                )
+                current.card.append(png_image(result.file_path))
             else:
                 current.card.append(Markdown(f"Unknown result type: {result}"))
 
-        self.next(self.fix_kegg_gene_ids)
-
     @step
     def fix_kegg_gene_ids(self):
+        import pandas as pd
+
+        from proteomics.analysis.deg_analysis.fix_kegg_ids import fix_kegg_ids
+
         kegg_fixed_dir = self.create_output_dir(
             f"{self.limma_input.contrast_name}/kegg_fixed"
         )
@@ -433,6 +486,81 @@ class ProteomicsAnalysis(FlowSpec):
 
         self.next(self.join_post_deg)
 
+    @card
+    @step
+    def run_contrast(self):
+        """
+        limma and every step after it for one contrast in a single task,
+        with execution.fused.
+        """
+        from proteomics.analysis.deg_analysis.base_args import r_session
+        from proteomics.analysis.deg_analysis.contrast import run_contrast
+
+        # one R worker pool for limma and the scripts after it
+        with r_session(self.r_config):
+            self.limma_contrast()
+
+            if not self.result_path:
+                print("No result path found for the contrast")
+                current.card.append(Markdown("No DEG result found"))
+                self.next(self.join_fused_contrasts)
+                return
+
+            results = run_contrast(
+                self.limma_input,
+                result_path=self.result_path,
+                **self.pipeline.contrast_kwargs(),
+            ).post_deg
+
+        self.add_heatmap_card(results.heatmap)
+        current.card.append(
+            Markdown(f"### Volcano plot for {self.limma_input.contrast_name}")
+        )
+        self.add_volcano_card(results.volcano)
+        self.add_enrichment_cards(results.enrichment)
+
+        self.next(self.join_fused_contrasts)
+
+    @step
+    def join_fused_contrasts(self, _inputs: Any):
+        self.next(self.join_pca_and_limma)
+
+    @card
+    @step
+    def run_contrast_batch(self):
+        """
+        The contrasts of a batch, each run like run_contrast, on a process
+        pool, with execution.batches.
+        """
+        runs = self.pipeline.run_contrasts(
+            self.input,
+            self.limma_results,
+            self.normalized,
+            max_workers=self.parameters.execution.workers_per_batch(),
+        )
+
+        for run in runs:
+            self.limma_input = run.limma_input
+            self.add_limma_card()
+            if run.post_deg is None:
+                current.card.append(Markdown("No DEG result found"))
+                continue
+
+            self.add_heatmap_card(run.post_deg.heatmap)
+            current.card.append(
+                Markdown(
+                    f"### Volcano plot for {self.limma_input.contrast_name}"
+                )
+            )
+            self.add_volcano_card(run.post_deg.volcano)
+            self.add_enrichment_cards(run.post_deg.enrichment)
+
+        self.next(self.join_contrast_batches)
+
+    @step
+    def join_contrast_batches(self, _inputs: Any):
+        self.next(self.join_pca_and_limma)
+
     @step
     def join_post_deg(self, _inputs: Any):
         self.next(self.join_deg_analysis)
@@ -447,6 +575,10 @@ class ProteomicsAnalysis(FlowSpec):
 
     @step
     def end(self):
+        from proteomics.utils.incremental import complete_manifest
+
+        # the contrasts of this run can be reused from now on
+        complete_manifest(get_run_output(self) / "_results")
         print(get_run_output(self))
         print(get_task_output(self))
         pass
@@ -37,9 +37,11 @@ class BaseParams(BaseModel):
 
         return self.output_dir / self.hash_params()
 
-    def hash_params(self) -> str:
+    def hash_params(self, exclude: set[str] | None = None) -> str:
         # Get the model dump as a JSON string
-        model_dump_str = self.model_dump_json(exclude={"get_samples"})
+        model_dump_str = self.model_dump_json(
+            exclude={"get_samples", *(exclude or ())}
+        )
 
         # Hash the JSON string
         hash_str = hashlib.sha256(model_dump_str.encode()).hexdigest()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+from pathlib import Path
+
+__all__ = [
+    "get_cache_dir",
+    "hash_file",
+    "hash_file_cached",
+]
+
+CACHE_DIR_ENV = "LFQ_PROTEOMICS_CACHE_DIR"
+
+# (path, size, mtime) -> sha256 so a file is only hashed once per process
+_file_hashes: dict[tuple[str, int, int], str] = {}
+
+
+def get_cache_dir(*parts: str) -> Path:
+    """
+    Returns (and creates) a directory in the persistent cache. The cache
+    root is $LFQ_PROTEOMICS_CACHE_DIR or ~/.cache/lfq-proteomics.
+    """
+    root = os.environ.get(CACHE_DIR_ENV)
+    cache_dir = (
+        Path(root) if root else Path.home() / ".cache" / "lfq-proteomics"
+    )
+    cache_dir = cache_dir.joinpath(*parts)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def hash_file(path: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    The sha256 of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file_cached(path: Path) -> str:
+    """
+    hash_file, remembered for the process until the file changes size or
+    modification time.
+    """
+    stat = Path(path).stat()
+    key = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+    if key not in _file_hashes:
+        _file_hashes[key] = hash_file(path)
+
+    return _file_hashes[key]
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+from pydantic import DirectoryPath
+
+from proteomics.utils.base_params import BaseParams
+
+__all__ = [
+    "MANIFEST_FILE",
+    "IncrementalParams",
+    "find_previous_results",
+    "read_manifest",
+    "write_manifest",
+    "complete_manifest",
+    "link_contrast",
+]
+
+MANIFEST_FILE = "manifest.json"
+"""The key of every contrast in a _results directory of a finished run"""
+
+PENDING_MANIFEST_FILE = "manifest.pending.json"
+
+
+class IncrementalParams(BaseParams):
+    enabled: bool = False
+    """Only run the contrasts that are new or changed since a previous run"""
+    previous_results: DirectoryPath | None = None
+    """The _results directory to reuse. None picks the latest finished run"""
+
+
+def find_previous_results(results_dir: Path) -> Path | None:
+    """
+    The _results directory of the latest finished run of the flow, found
+    next to the run of results_dir in the datastore.
+    """
+    run_dir = results_dir.parent
+    candidates = [
+        other / "_results"
+        for other in run_dir.parent.iterdir()
+        if other != run_dir and (other / "_results" / MANIFEST_FILE).exists()
+    ]
+
+    return max(
+        candidates,
+        key=lambda x: (x / MANIFEST_FILE).stat().st_mtime,
+        default=None,
+    )
+
+
+def read_manifest(results_dir: Path) -> dict[str, str]:
+    """
+    Returns: The key of every contrast of the run, {} if the run did not
+        finish.
+    """
+    manifest_file = results_dir / MANIFEST_FILE
+    if not manifest_file.exists():
+        return {}
+    return json.loads(manifest_file.read_text())["contrasts"]
+
+
+def write_manifest(results_dir: Path, contrast_keys: dict[str, str]) -> None:
+    """
+    Writes the manifest as pending. It is only used by later runs after
+    complete_manifest, so a failed run is never reused.
+    """
+    (results_dir / PENDING_MANIFEST_FILE).write_text(
+        json.dumps({"contrasts": contrast_keys}, indent=2)
+    )
+
+
+def complete_manifest(results_dir: Path) -> None:
+    pending = results_dir / PENDING_MANIFEST_FILE
+    if pending.exists():
+        os.replace(pending, results_dir / MANIFEST_FILE)
+
+
+def link_contrast(
+    previous_results: Path, results_dir: Path, contrast_name: str
+) -> Path:
+    """
+    Links the outputs of a contrast of a previous run into results_dir.
+    Links to a run that was itself incremental are followed, so the link
+    always points at the run that computed the contrast.
+    """
+    target = (previous_results / contrast_name).resolve()
+    link = results_dir / contrast_name
+
+    if link.is_symlink():
+        link.unlink()
+    elif link.exists():
+        shutil.rmtree(link)
+
+    link.symlink_to(target, target_is_directory=True)
+    print(f"Linked {link} to {target}")
+
+    return link
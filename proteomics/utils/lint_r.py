@@ -0,0 +1,37 @@
+"""
+Lints the R scripts bundled with the project so that the lint results are
+stored before the analysis runs, which then neither lints the bundled
+scripts nor looks up lintr. Run it once after installing or at image build
+time:
+
+    python -m proteomics.utils.lint_r --rscript_bin /opt/conda/bin/Rscript
+"""
+import argparse
+from pathlib import Path
+
+from proteomics.utils.base_params import get_project_root
+from proteomics.utils.run_r import lint_r_file, write_prelinted
+
+
+def get_bundled_r_scripts() -> list[Path]:
+    return sorted(
+        (get_project_root() / "proteomics" / "analysis").rglob("*.R")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rscript_bin", type=Path, default=Path("/opt/conda/bin/Rscript")
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for r_script in get_bundled_r_scripts():
+        print(f"Linting {r_script}")
+        results[r_script] = lint_r_file(args.rscript_bin, r_script)
+    write_prelinted(results)
+
+
+if __name__ == "__main__":
+    main()
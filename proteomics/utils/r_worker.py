@@ -0,0 +1,231 @@
+import itertools
+import json
+import queue
+import subprocess
+import threading
+from pathlib import Path
+from subprocess import SubprocessError
+
+__all__ = [
+    "DEFAULT_PRELOAD",
+    "RWorker",
+    "RWorkerCrashed",
+    "RWorkerPool",
+]
+
+WORKER_SCRIPT = Path(__file__).parent / "r_worker.R"
+
+# the libraries loaded by limma.R, volcano-plot.R and run_enrichment.R
+DEFAULT_PRELOAD = [
+    "arrow",
+    "limma",
+    "ggplot2",
+    "EnhancedVolcano",
+    "gridExtra",
+    "clusterProfiler",
+    "org.Mm.eg.db",
+    "org.Hs.eg.db",
+    "GOplot",
+    "enrichplot",
+    "stringr",
+]
+
+
+class RWorkerCrashed(SubprocessError):
+    """
+    The R worker process exited while starting or running a job.
+    """
+
+
+class RWorker:
+    """
+    A long lived Rscript process running r_worker.R. Jobs are sent as one
+    JSON line on stdin and the reply is read as one JSON line from stdout.
+    """
+
+    def __init__(self, rscript_bin: Path, preload: list[str]):
+        self.rscript_bin = rscript_bin
+        self.preload = preload
+        self._process: subprocess.Popen | None = None
+        self._ready = False
+        self._job_ids = itertools.count()
+
+    def start(self) -> None:
+        """
+        Starts the process without waiting for the packages to load, so
+        that the workers of a pool load their packages in parallel.
+        """
+        print(f"Starting R worker with packages: {self.preload}")
+        self._process = subprocess.Popen(
+            [str(self.rscript_bin), str(WORKER_SCRIPT), *self.preload],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self._ready = False
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def restart(self) -> None:
+        self.close()
+        self.start()
+
+    def _read_message(self) -> dict:
+        """
+        Reads stdout until the next JSON object. Anything else (like
+        package startup messages) is echoed.
+        """
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                raise RWorkerCrashed(
+                    f"R worker exited with code {self._process.wait()}"
+                )
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                print(line, end="")
+                continue
+            if isinstance(message, dict):
+                return message
+
+    def wait_ready(self) -> None:
+        if not self._ready:
+            self._read_message()
+            self._ready = True
+
+    def run(self, script: Path, args: list[str], cwd: Path) -> list[str]:
+        """
+        Runs the script in the worker as if it was run with
+        `Rscript script *args` from cwd.
+
+        Raises:
+            RWorkerCrashed: If the worker died
+            SubprocessError: If the script raised an error
+
+        Returns: The lines printed by the script
+        """
+        if not self.is_alive():
+            raise RWorkerCrashed("R worker is not running")
+        self.wait_ready()
+
+        job_id = next(self._job_ids)
+        job = {
+            "id": job_id,
+            "script": str(script),
+            "args": [str(arg) for arg in args],
+            "cwd": str(cwd),
+        }
+
+        try:
+            self._process.stdin.write(json.dumps(job) + "\n")
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RWorkerCrashed(f"Could not send job to R worker: {e}")
+
+        reply = self._read_message()
+        if reply.get("id") != job_id:
+            raise RWorkerCrashed(f"Unexpected reply from R worker: {reply}")
+
+        stdout = reply["stdout"]
+        for line in stdout:
+            print(line)
+
+        if reply["status"] != "ok":
+            raise SubprocessError(
+                f"Error running {script} in R worker: {reply['error']}"
+            )
+
+        return stdout
+
+    def close(self) -> None:
+        if self._process is None:
+            return
+
+        if self.is_alive():
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+
+        self._process = None
+
+
+class RWorkerPool:
+    """
+    A fixed number of R workers with the analysis libraries already
+    loaded. A job waits for a free worker. Workers that crash are
+    restarted and the job is tried once more on the new process.
+    """
+
+    def __init__(
+        self,
+        rscript_bin: Path,
+        *,
+        size: int = 2,
+        preload: list[str] | None = None,
+    ):
+        if size < 1:
+            raise ValueError("The pool needs at least one worker")
+
+        self.rscript_bin = rscript_bin
+        self.size = size
+        self.preload = DEFAULT_PRELOAD if preload is None else preload
+
+        self._workers = [
+            RWorker(rscript_bin, self.preload) for _ in range(size)
+        ]
+        self._idle: queue.Queue[RWorker] = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            for worker in self._workers:
+                worker.start()
+                self._idle.put(worker)
+            self._started = True
+
+    def run_command(self, command: list[str], *, cwd: Path) -> list[str]:
+        """
+        Runs a command built by RunRMixin.create_command, i.e.
+        [rscript_bin, r_script, *args], on a free worker.
+        """
+        self.start()
+
+        script, args = Path(command[1]), [str(arg) for arg in command[2:]]
+        worker = self._idle.get()
+        try:
+            for attempt in range(2):
+                if not worker.is_alive():
+                    print("R worker is not running. Restarting it.")
+                    worker.restart()
+                try:
+                    return worker.run(script, args, cwd)
+                except RWorkerCrashed as e:
+                    print(f"R worker crashed: {e}")
+                    worker.restart()
+                    if attempt == 1:
+                        raise
+        finally:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._idle = queue.Queue()
+            self._started = False
+
+    def __enter__(self) -> "RWorkerPool":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,122 @@
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from multiprocessing import get_context
+from typing import Any, Callable, Iterator
+
+from pydantic import Field
+
+from proteomics.utils.base_params import BaseParams
+
+__all__ = [
+    "RenderParams",
+    "use_render_pool",
+    "figures_enabled",
+    "render",
+    "wait_renders",
+]
+
+
+class RenderParams(BaseParams):
+    figures: bool = True
+    """
+    Draw the figures. False is the compute-only mode for re-analysis runs:
+    only the tables are written, no plots
+    """
+    workers: int = Field(
+        2,
+        description="Processes that draw the figures with the Agg backend "
+        "while the analysis goes on. 0 draws them in the calling process.",
+    )
+
+
+class _Renderer:
+    def __init__(self, params: RenderParams, workers: int):
+        self.params = params
+        self.executor = (
+            ProcessPoolExecutor(
+                max_workers=workers,
+                # spawn, the caller may have threads and pyplot state
+                mp_context=get_context("spawn"),
+                initializer=_use_agg,
+            )
+            if params.figures and workers > 0
+            else None
+        )
+        self.pending: list[Future] = []
+
+
+# set by use_render_pool, render draws inline with the figures on without it
+_renderer: _Renderer | None = None
+
+
+def _use_agg() -> None:
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+@contextmanager
+def use_render_pool(
+    params: RenderParams, *, workers: int | None = None
+) -> Iterator[None]:
+    """
+    Sends the figures drawn with render inside the context to a pool of
+    processes, or skips them with params.figures off. Waits for the
+    figures on exit.
+
+    Args:
+        workers: Overrides params.workers, e.g. 0 where the caller already
+            runs on a process pool
+    """
+    global _renderer
+
+    previous = _renderer
+    _renderer = _Renderer(
+        params, params.workers if workers is None else workers
+    )
+    try:
+        yield
+        wait_renders()
+    finally:
+        if _renderer.executor is not None:
+            _renderer.executor.shutdown(wait=True, cancel_futures=True)
+        _renderer = previous
+
+
+def figures_enabled() -> bool:
+    return _renderer is None or _renderer.params.figures
+
+
+def render(func: Callable[..., Any], *args, **kwargs) -> Future | None:
+    """
+    Draws a figure with func(*args, **kwargs) on the render pool. func must
+    be a module level function that writes its files, the arguments are
+    pickled to the worker.
+
+    Returns: The future of func, None if the figures are off
+    """
+    if not figures_enabled():
+        return None
+
+    if _renderer is None or _renderer.executor is None:
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+    future = _renderer.executor.submit(func, *args, **kwargs)
+    _renderer.pending.append(future)
+    return future
+
+
+def wait_renders() -> None:
+    """
+    Waits for the figures submitted so far, e.g. before the files are
+    cached or shown. Raises the error of a figure that failed.
+    """
+    if _renderer is None or not _renderer.pending:
+        return
+
+    pending, _renderer.pending = _renderer.pending, []
+    wait(pending)
+    for future in pending:
+        future.result()
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import os
+import resource
+import signal
+import time
+from datetime import datetime
+from pathlib import Path
+from subprocess import SubprocessError
+from typing import Callable, NamedTuple
+
+from pydantic import Field
+
+from proteomics.utils.base_params import BaseParams
+from proteomics.utils.cache import get_cache_dir
+
+__all__ = [
+    "ResourceLimits",
+    "ResourceUsage",
+    "ResourceLimitExceeded",
+    "ResourceWatchdog",
+    "make_preexec_fn",
+    "record_usage",
+]
+
+USAGE_LOG = "usage.jsonl"
+
+CPU_KILL_GRACE = 5
+"""Seconds of CPU between SIGXCPU and SIGKILL from RLIMIT_CPU"""
+
+_PROC = Path("/proc")
+
+
+class ResourceLimits(BaseParams):
+    max_memory_mb: int | None = Field(
+        None,
+        description="Memory budget of a job: the summed RSS of the script "
+        "and every process it started. Each process also gets it as "
+        "RLIMIT_DATA. None only records the peak.",
+    )
+    max_cpu_seconds: int | None = Field(
+        None,
+        description="CPU seconds each process of a job may use "
+        "(RLIMIT_CPU). None for no limit.",
+    )
+    watchdog_interval: float = Field(
+        0.5,
+        description="Seconds between the RSS samples of the watchdog",
+    )
+
+
+class ResourceUsage(NamedTuple):
+    """
+    The peak usage of a job, summed over its process group.
+    """
+
+    peak_rss_mb: float
+    cpu_seconds: float
+    wall_seconds: float
+
+    def __str__(self) -> str:
+        return (
+            f"peak RSS {self.peak_rss_mb:.1f} MB, "
+            f"CPU {self.cpu_seconds:.1f} s, wall {self.wall_seconds:.1f} s"
+        )
+
+
+class ResourceLimitExceeded(SubprocessError):
+    def __init__(self, cmd: list[str], reason: str, usage: ResourceUsage):
+        self.cmd = cmd
+        self.reason = reason
+        self.usage = usage
+
+    def __str__(self) -> str:
+        return f"Command {self.cmd} was killed, {self.reason} ({self.usage})"
+
+
+def make_preexec_fn(limits: ResourceLimits) -> Callable[[], None] | None:
+    """
+    The setrlimit calls for the child, run between fork and exec. None if
+    there is nothing to set.
+    """
+    if limits.max_memory_mb is None and limits.max_cpu_seconds is None:
+        return None
+
+    def set_limits() -> None:
+        if limits.max_memory_mb is not None:
+            size = limits.max_memory_mb << 20
+            resource.setrlimit(resource.RLIMIT_DATA, (size, size))
+        if limits.max_cpu_seconds is not None:
+            # SIGXCPU at the soft limit, SIGKILL at the hard limit
+            resource.setrlimit(
+                resource.RLIMIT_CPU,
+                (
+                    limits.max_cpu_seconds,
+                    limits.max_cpu_seconds + CPU_KILL_GRACE,
+                ),
+            )
+
+    return set_limits
+
+
+class ResourceWatchdog:
+    """
+    Samples the RSS and CPU time of every process in the process group of
+    a job from /proc. The group is killed as soon as its RSS goes over
+    max_memory_mb, before the machine starts swapping. On systems without
+    /proc only the rlimits apply and the usage is not recorded.
+    """
+
+    def __init__(self, pgid: int, limits: ResourceLimits):
+        self.pgid = pgid
+        self.limits = limits
+        self.started = time.monotonic()
+        self.peak_rss = 0
+        self.exceeded: str | None = None
+        # pid -> CPU seconds, exited children keep their last sample
+        self._cpu: dict[int, float] = {}
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._clock_ticks = os.sysconf("SC_CLK_TCK")
+
+    def sample(self) -> int:
+        """
+        Returns: The summed RSS of the group in bytes
+        """
+        rss = 0
+        for stat_file in _PROC.glob("[0-9]*/stat"):
+            try:
+                stat = stat_file.read_text()
+            except OSError:
+                # the process exited
+                continue
+            # the command name may contain spaces, the fields follow it
+            fields = stat[stat.rindex(")") + 2 :].split()
+            if int(fields[2]) != self.pgid:
+                continue
+
+            pid = int(stat_file.parent.name)
+            rss += int(fields[21]) * self._page_size
+            self._cpu[pid] = (
+                int(fields[11]) + int(fields[12])
+            ) / self._clock_ticks
+
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def usage(self) -> ResourceUsage:
+        return ResourceUsage(
+            peak_rss_mb=self.peak_rss / (1 << 20),
+            cpu_seconds=sum(self._cpu.values()),
+            wall_seconds=time.monotonic() - self.started,
+        )
+
+    async def watch(self) -> None:
+        """
+        Samples until cancelled, kills the group if it goes over budget.
+        """
+        if not _PROC.exists():
+            return
+
+        max_memory = self.limits.max_memory_mb
+        while True:
+            rss = await asyncio.to_thread(self.sample)
+            if max_memory is not None and rss > max_memory << 20:
+                self.exceeded = (
+                    f"RSS {rss / (1 << 20):.1f} MB over the budget of "
+                    f"{max_memory} MB"
+                )
+                try:
+                    # no SIGTERM first, the job would keep growing
+                    os.killpg(self.pgid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                return
+            await asyncio.sleep(self.limits.watchdog_interval)
+
+    def check_returncode(self, returncode: int) -> str | None:
+        """
+        Why the job was killed, None if it was not killed for its usage.
+        """
+        if self.exceeded is not None:
+            return self.exceeded
+        if self.limits.max_cpu_seconds is not None and returncode in (
+            -signal.SIGXCPU,
+            -signal.SIGKILL,
+        ):
+            return (
+                f"over the CPU limit of {self.limits.max_cpu_seconds} s "
+                f"(signal {-returncode})"
+            )
+        return None
+
+
+def record_usage(
+    command: list[str], usage: ResourceUsage, exceeded: str | None = None
+) -> None:
+    """
+    Prints the usage of a job and appends it to the usage log in the cache
+    (get_cache_dir("resources")/usage.jsonl), the data for sizing the
+    budgets and the number of workers.
+    """
+    # the script of an Rscript command
+    name = Path(command[1] if len(command) > 1 else command[0]).name
+    print(f"{name}: {usage}")
+
+    entry = {
+        "time": datetime.now().isoformat(),
+        "command": command,
+        **usage._asdict(),
+        "exceeded": exceeded,
+    }
+    with open(get_cache_dir("resources") / USAGE_LOG, "a") as f:
+        f.write(json.dumps(entry) + "\n")
@@ -1,14 +1,233 @@
 import abc
+import asyncio
+import functools
+import hashlib
+import json
+import os
 import re
+import shutil
+from contextlib import contextmanager
 from pathlib import Path
-from typing import TypeVar, Generic
+from typing import Iterator, TypeVar, Generic, Sequence
 
 from pydantic import FilePath, BaseModel
 
 
-__all__ = ["RConfig", "RunRMixin", "RResultType"]
+__all__ = [
+    "RConfig",
+    "RunRMixin",
+    "RResultType",
+    "get_r_worker_pool",
+    "use_r_worker_pool",
+    "use_r_memo",
+    "use_r_timeout",
+    "use_r_limits",
+    "lint_r_file",
+    "write_prelinted",
+    "run_analyses",
+]
 
-from proteomics.utils.run_subprocess import run_command
+from proteomics.utils.cache import get_cache_dir, hash_file, hash_file_cached
+from proteomics.utils.r_worker import RWorkerPool
+from proteomics.utils.resources import ResourceLimits
+from proteomics.utils.run_subprocess import (
+    run_command,
+    run_command_async,
+    run_sync,
+)
+from proteomics.utils.slots import slot_async
+
+# when set, RunRMixin sends its commands to the pool instead of starting a
+# new Rscript for every analysis
+_r_worker_pool: RWorkerPool | None = None
+
+# when set, RunRMixin replays the stdout and output files of an earlier run
+# with the same script, arguments and input files
+_r_memo: bool = False
+
+# seconds after which an Rscript started by RunRMixin is stopped
+_r_timeout: float | None = None
+
+# memory and CPU caps of an Rscript started by RunRMixin, its peak usage is
+# recorded either way
+_r_limits: ResourceLimits = ResourceLimits()
+
+
+def get_r_worker_pool() -> RWorkerPool | None:
+    return _r_worker_pool
+
+
+@contextmanager
+def use_r_worker_pool(pool: RWorkerPool | None) -> Iterator[None]:
+    """
+    Runs every RunRMixin analysis inside the context on the pool.
+    """
+    global _r_worker_pool
+
+    previous = _r_worker_pool
+    _r_worker_pool = pool
+    try:
+        yield
+    finally:
+        _r_worker_pool = previous
+
+
+@contextmanager
+def use_r_memo(enabled: bool = True) -> Iterator[None]:
+    """
+    Memoizes every RunRMixin analysis inside the context.
+    """
+    global _r_memo
+
+    previous = _r_memo
+    _r_memo = enabled
+    try:
+        yield
+    finally:
+        _r_memo = previous
+
+
+@contextmanager
+def use_r_timeout(timeout: float | None) -> Iterator[None]:
+    """
+    Stops every RunRMixin analysis inside the context that runs longer
+    than timeout seconds. Does not apply to the worker pool.
+    """
+    global _r_timeout
+
+    previous = _r_timeout
+    _r_timeout = timeout
+    try:
+        yield
+    finally:
+        _r_timeout = previous
+
+
+@contextmanager
+def use_r_limits(limits: ResourceLimits) -> Iterator[None]:
+    """
+    Caps every RunRMixin analysis inside the context, see ResourceLimits.
+    Does not apply to the worker pool.
+    """
+    global _r_limits
+
+    previous = _r_limits
+    _r_limits = limits
+    try:
+        yield
+    finally:
+        _r_limits = previous
+
+
+def _snapshot(output_dirs: list[Path]) -> dict[Path, tuple[int, int]]:
+    return {
+        file: (file.stat().st_size, file.stat().st_mtime_ns)
+        for output_dir in output_dirs
+        for file in output_dir.rglob("*")
+        if file.is_file()
+    }
+
+
+# the lint results of the bundled R scripts, written by
+# proteomics.utils.lint_r at image build, script hash -> lintr output
+PRELINTED_FILE = "prelinted.json"
+
+
+def _r_library_dirs(rscript_bin: Path) -> list[Path]:
+    """
+    The R libraries of the installation of rscript_bin, in the order R
+    searches them.
+    """
+    dirs = [
+        Path(path)
+        for var in ("R_LIBS", "R_LIBS_USER", "R_LIBS_SITE")
+        for path in os.environ.get(var, "").split(os.pathsep)
+        if path
+    ]
+    # e.g. /opt/conda/bin/Rscript -> /opt/conda/lib/R/library
+    prefix = Path(rscript_bin).resolve().parents[1]
+    for lib in (
+        "lib/R/library",
+        "lib/R/site-library",
+        "local/lib/R/site-library",
+    ):
+        dirs.append(prefix / lib)
+    return dirs
+
+
+@functools.cache
+def _lintr_version(rscript_bin: Path) -> str:
+    """
+    The version of lintr of the R installation, read from the DESCRIPTION
+    file of the package instead of starting R. Empty if lintr is not found.
+    """
+    for lib_dir in _r_library_dirs(rscript_bin):
+        description = lib_dir / "lintr" / "DESCRIPTION"
+        if not description.exists():
+            continue
+        for line in description.read_text().splitlines():
+            if line.startswith("Version:"):
+                return line.split(":", 1)[1].strip()
+    return ""
+
+
+@functools.cache
+def _prelinted() -> dict[str, list[str]]:
+    prelinted_file = get_cache_dir("lintr") / PRELINTED_FILE
+    if not prelinted_file.exists():
+        return {}
+    return json.loads(prelinted_file.read_text())
+
+
+def write_prelinted(results: dict[Path, list[str]]) -> None:
+    """
+    Stores the lint results of the bundled scripts, so that runs do not
+    lint them or look up lintr at all.
+    """
+    prelinted_file = get_cache_dir("lintr") / PRELINTED_FILE
+    prelinted_file.write_text(
+        json.dumps(
+            {
+                hash_file(r_script): result
+                for r_script, result in results.items()
+            }
+        )
+    )
+    _prelinted.cache_clear()
+
+
+def lint_r_file(rscript_bin: Path, r_script: Path) -> list[str]:
+    """
+    Runs lintr::lint on the R script. The output is cached by the hash of
+    the script, the Rscript binary and the version of lintr, so a script is
+    only linted again after one of them changed.
+
+    Returns: The lintr output
+    """
+    key = hashlib.sha256(
+        json.dumps(
+            [
+                hash_file(r_script),
+                str(Path(rscript_bin).resolve()),
+                _lintr_version(rscript_bin),
+            ]
+        ).encode()
+    ).hexdigest()
+    cache_file = get_cache_dir("lintr") / f"{key}.json"
+
+    if cache_file.exists():
+        print(f"Using cached lint results for {r_script}")
+        return json.loads(cache_file.read_text())
+
+    command = [
+        rscript_bin,
+        "-e",
+        f"lintr::lint(filename = '{r_script}')",
+    ]
+    result = run_command(command)
+    cache_file.write_text(json.dumps(result))
+
+    return result
 
 
 class RConfig(BaseModel):
@@ -27,6 +246,12 @@ class RunRMixin(RConfig, abc.ABC, Generic[RResultType]):
     def process_stdout(self, stdout: list[str]) -> RResultType:
         pass
 
+    def resource_class(self) -> str:
+        """
+        The class of SlotParams.limits the script counts against.
+        """
+        return "r"
+
     def ignored_linters(self) -> set[str]:
         return {"object_usage_linter"}
 
@@ -46,14 +271,14 @@ class RunRMixin(RConfig, abc.ABC, Generic[RResultType]):
 
     def lint_r_script(self):
         """
-        Runs R -e "lint(filename = 'self.get_r_script()')" on the R script
+        Runs R -e "lint(filename = 'self.get_r_script()')" on the R script,
+        unless it was linted at build (see proteomics.utils.lint_r) or the
+        same script was linted before.
         """
-        command = [
-            self.rscript_bin,
-            "-e",
-            f"lintr::lint(filename = '{self.get_r_script()}')",
-        ]
-        result = run_command(command)
+        r_script = self.get_r_script()
+        result = _prelinted().get(hash_file_cached(r_script))
+        if result is None:
+            result = lint_r_file(self.rscript_bin, r_script)
         self.raise_if_warning(result)
 
     def create_command(self) -> list[str]:
@@ -72,13 +297,131 @@ class RunRMixin(RConfig, abc.ABC, Generic[RResultType]):
 
         return command
 
+    def output_dirs(self) -> list[Path]:
+        """
+        The directory arguments, where the script writes its outputs.
+        """
+        return [
+            value
+            for value in self.model_dump().values()
+            if isinstance(value, Path) and value.is_dir()
+        ]
+
+    def memo_key(self) -> str:
+        """
+        The digest of the R scripts next to the script (they source each
+        other), the arguments and the contents of the input files. The
+        output directories are left out, a hit is replayed into the new
+        ones.
+        """
+        r_script = self.get_r_script()
+        digest = hashlib.sha256(str(self.rscript_bin).encode())
+
+        for script in sorted(r_script.parent.glob("*.R")):
+            digest.update(f"{script.name}:{hash_file_cached(script)}".encode())
+        digest.update(r_script.name.encode())
+
+        for arg_flag, argument in self.model_dump(
+            exclude={"rscript_bin", "hash_str_length"}
+        ).items():
+            if isinstance(argument, Path) and argument.is_dir():
+                argument = "<output_dir>"
+            elif isinstance(argument, Path) and argument.is_file():
+                argument = hash_file_cached(argument)
+            digest.update(f"--{arg_flag}={argument}".encode())
+
+        return digest.hexdigest()
+
+    async def run_command(self, command: list[str]) -> list[str] | None:
+        cwd = self.get_r_script().parent
+
+        async with slot_async(self.resource_class()):
+            pool = get_r_worker_pool()
+            if pool is not None:
+                # the pool blocks until a worker is free
+                return await asyncio.to_thread(
+                    pool.run_command, command, cwd=cwd
+                )
+            return await run_command_async(
+                command, cwd=cwd, timeout=_r_timeout, limits=_r_limits
+            )
+
+    async def run_memoized(self, command: list[str]) -> list[str] | None:
+        """
+        Runs the command, or replays an earlier run with the same memo_key:
+        the output files are copied into the output directories and the
+        old directories are replaced with the new ones in the stdout.
+        """
+        memo_dir = get_cache_dir("r_runs") / self.memo_key()
+        memo_file = memo_dir / "stdout.json"
+        output_dirs = self.output_dirs()
+
+        if memo_file.exists():
+            print(f"Replaying {self.get_r_script().name} from {memo_dir}")
+            memo = json.loads(memo_file.read_text())
+            stdout = memo["stdout"]
+            for i, (old_dir, new_dir) in enumerate(
+                zip(memo["output_dirs"], output_dirs)
+            ):
+                if (memo_dir / str(i)).exists():
+                    shutil.copytree(
+                        memo_dir / str(i), new_dir, dirs_exist_ok=True
+                    )
+                stdout = [x.replace(old_dir, str(new_dir)) for x in stdout]
+            return stdout
+
+        before = _snapshot(output_dirs)
+        result = await self.run_command(command)
+        if not result:
+            return result
+
+        after = _snapshot(output_dirs)
+        tmp_dir = memo_dir.with_name(f"{memo_dir.name}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        for i, output_dir in enumerate(output_dirs):
+            for file, stat in after.items():
+                if before.get(file) == stat or not file.is_relative_to(
+                    output_dir
+                ):
+                    continue
+                target = tmp_dir / str(i) / file.relative_to(output_dir)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(file, target)
+
+        (tmp_dir / "stdout.json").write_text(
+            json.dumps(
+                {
+                    "stdout": result,
+                    "output_dirs": [str(x) for x in output_dirs],
+                }
+            )
+        )
+        try:
+            tmp_dir.rename(memo_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return result
+
     def run_analysis(self) -> RResultType | None:
-        self.lint_r_script()
+        return run_sync(self.run_analysis_async())
+
+    async def run_analysis_async(self) -> RResultType | None:
+        """
+        run_analysis for running several analyses at once, see
+        run_analyses.
+        """
+        # lintr runs synchronously, off the event loop
+        await asyncio.to_thread(self.lint_r_script)
 
         command = self.create_command()
         print(" ".join(command))
 
-        result = run_command(command, cwd=self.get_r_script().parent)
+        if _r_memo:
+            result = await self.run_memoized(command)
+        else:
+            result = await self.run_command(command)
 
         if not result:
             print(f"Error running command: {result}")
@@ -89,3 +432,32 @@ class RunRMixin(RConfig, abc.ABC, Generic[RResultType]):
         except Exception as e:
             print(f"Error processing stdout: {e}")
             print(result)
+
+
+def run_analyses(
+    analyses: Sequence[RunRMixin], *, max_concurrent: int | None = None
+) -> list:
+    """
+    Runs several R analyses at the same time from one process. If one of
+    them raises, the others are cancelled and their Rscripts stopped.
+
+    Returns: The result of every analysis, in order
+    """
+
+    async def run_all() -> list:
+        semaphore = asyncio.Semaphore(max_concurrent or len(analyses) or 1)
+
+        async def run_one(analysis: RunRMixin):
+            async with semaphore:
+                return await analysis.run_analysis_async()
+
+        tasks = [asyncio.create_task(run_one(x)) for x in analyses]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    return run_sync(run_all())
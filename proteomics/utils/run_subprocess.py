@@ -1,43 +1,212 @@
-import selectors
-import subprocess
+import asyncio
+import collections
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from subprocess import SubprocessError
+from subprocess import CalledProcessError, SubprocessError, TimeoutExpired
+from typing import Awaitable, Sequence, TypeVar
 
+from proteomics.utils.resources import (
+    ResourceLimitExceeded,
+    ResourceLimits,
+    ResourceWatchdog,
+    make_preexec_fn,
+    record_usage,
+)
 
-def _run_subprocess(command: list[str], *, cwd: Path = None) -> list[str]:
+__all__ = [
+    "run_command",
+    "run_command_async",
+    "run_commands",
+    "add_metaflow_items",
+    "run_sync",
+]
+
+READ_SIZE = 1 << 16
+MAX_LINE_LENGTH = 1 << 20
+"""Longer lines are cut, so one line without a newline can not fill memory"""
+MAX_STDOUT_LINES = 100_000
+"""Only the last lines of stdout are kept, they hold the script's results"""
+MAX_STDERR_LINES = 50
+"""The last lines of stderr are kept for the error message"""
+KILL_TIMEOUT = 5.0
+"""Seconds a process gets to exit after SIGTERM before it is killed"""
+
+
+T = TypeVar("T")
+
+
+def run_sync(coroutine: Awaitable[T]) -> T:
+    """
+    asyncio.run that also works when called from a running event loop
+    (e.g. a notebook or an analysis run with run_analyses), by running the
+    coroutine on a new loop in a thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def _read_lines(
+    stream: asyncio.StreamReader,
+    lines: collections.deque[str],
+    *,
+    echo: bool,
+) -> None:
+    """
+    Reads the stream until EOF, splitting it into lines. Only a partial
+    line of at most MAX_LINE_LENGTH bytes is buffered.
+    """
+    partial = bytearray()
+
+    def add_line(data: bytes) -> None:
+        line = data.decode(errors="replace").rstrip("\r")
+        if echo:
+            print(line)
+        lines.append(line)
+
+    while chunk := await stream.read(READ_SIZE):
+        *complete, rest = chunk.split(b"\n")
+        for piece in complete:
+            partial += piece[: MAX_LINE_LENGTH - len(partial)]
+            add_line(bytes(partial))
+            partial.clear()
+
+        partial += rest[: MAX_LINE_LENGTH - len(partial)]
+
+    if partial:
+        add_line(bytes(partial))
+
+
+def _signal_group(process: asyncio.subprocess.Process, sig: int) -> None:
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _stop(process: asyncio.subprocess.Process) -> None:
+    """
+    Stops the process and everything it started, e.g. the R processes of
+    a parallel backend.
+    """
+    if process.returncode is not None:
+        return
+
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_TIMEOUT)
+    except asyncio.TimeoutError:
+        _signal_group(process, signal.SIGKILL)
+        await process.wait()
+
+
+async def _run_subprocess_async(
+    command: list[str],
+    *,
+    cwd: Path = None,
+    timeout: float | None = None,
+    limits: ResourceLimits | None = None,
+) -> list[str]:
+    """
+    Runs a subprocess and captures its stdout line by line. Both pipes are
+    read to EOF, the process is stopped if it runs longer than timeout or
+    the task is cancelled. With limits, the process group is capped and
+    watched by a ResourceWatchdog and its peak usage is recorded.
+
+    Raises:
+        CalledProcessError: If the subprocess returns a non-zero exit code
+        TimeoutExpired: If the subprocess ran longer than timeout seconds
+        ResourceLimitExceeded: If the subprocess went over limits
+
+    Returns: The last MAX_STDOUT_LINES lines of stdout
+    """
+    stdout = collections.deque(maxlen=MAX_STDOUT_LINES)
+    stderr = collections.deque(maxlen=MAX_STDERR_LINES)
+
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+        # in its own process group, so that _stop reaches its children
+        start_new_session=True,
+        preexec_fn=make_preexec_fn(limits) if limits else None,
+    )
+
+    watchdog = None
+    watch_task = None
+    if limits is not None:
+        watchdog = ResourceWatchdog(process.pid, limits)
+        watch_task = asyncio.create_task(watchdog.watch())
+
+    async def communicate() -> int:
+        await asyncio.gather(
+            _read_lines(process.stdout, stdout, echo=True),
+            _read_lines(process.stderr, stderr, echo=True),
+        )
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutExpired(command, timeout, output=list(stdout))
+    finally:
+        # timed out or cancelled
+        await _stop(process)
+        if watch_task is not None:
+            watch_task.cancel()
+
+    if watchdog is not None:
+        exceeded = watchdog.check_returncode(returncode)
+        record_usage(command, watchdog.usage(), exceeded)
+        if exceeded is not None:
+            raise ResourceLimitExceeded(command, exceeded, watchdog.usage())
+
+    if returncode != 0:
+        raise CalledProcessError(
+            returncode,
+            command,
+            output=list(stdout),
+            stderr="\n".join(stderr),
+        )
+
+    return list(stdout)
+
+
+def _run_subprocess(
+    command: list[str],
+    *,
+    cwd: Path = None,
+    timeout: float | None = None,
+    limits: ResourceLimits | None = None,
+) -> list[str]:
     """
     Run a subprocess and capture the output
 
     Args:
         command:  list[str]: The command to run
         cwd:  Path: The current working directory to run the command in
+        timeout: Seconds after which the subprocess is stopped
+        limits: Memory and CPU caps, see ResourceLimits
 
     Raises:
-        SubprocessError: If the subprocess returns a non-zero exit code
+        SubprocessError: If the subprocess returns a non-zero exit code,
+            times out or goes over its limits
 
     Returns: stdout if the command was successful
 
     """
-    stdout = []
-    with subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
-    ) as process:
-        sel = selectors.DefaultSelector()
-        sel.register(process.stdout, selectors.EVENT_READ)
-        sel.register(process.stderr, selectors.EVENT_READ)
-
-        while True:
-            for key, _ in sel.select():
-                data = key.fileobj.read1().decode()
-                if not data:
-                    return stdout
-                if key.fileobj is process.stdout:
-                    print(data, end="")
-                    stdout.append(data)
-                else:
-                    print(data, end="")
-
-    return stdout
+    return run_sync(
+        _run_subprocess_async(
+            command, cwd=cwd, timeout=timeout, limits=limits
+        )
+    )
 
 
 def add_metaflow_items(command: list[str]):
@@ -61,31 +230,113 @@ def add_metaflow_items(command: list[str]):
         )
 
 
-def run_command(
-    command: list[str], *, cwd: Path = None, raise_if_fail: bool = True
+async def run_command_async(
+    command: list[str],
+    *,
+    cwd: Path = None,
+    timeout: float | None = None,
+    limits: ResourceLimits | None = None,
+    raise_if_fail: bool = True,
 ) -> list[str] | None:
     """
-    Runss the command and captures the output
-
-    Args:
-        command:  list[str]: The command to run
-        cwd:  Path: The current working directory to run the command in
-
-    Returns: stdout if the command was successful, None otherwise
-
+    Same as run_command, for running several commands at once from an
+    event loop.
     """
     command = [str(c) for c in command]
 
     add_metaflow_items(command)
 
     try:
-        stdout = _run_subprocess(command, cwd=cwd)
+        return await _run_subprocess_async(
+            command, cwd=cwd, timeout=timeout, limits=limits
+        )
     except SubprocessError as e:
         # Handle errors in the subprocess
         print(f"Error running command: {command}")
+        if isinstance(e, CalledProcessError) and e.stderr:
+            print(e.stderr)
+        elif isinstance(e, ResourceLimitExceeded):
+            print(e)
         if raise_if_fail:
             raise e
 
         return None
 
-    return stdout
+
+def run_command(
+    command: list[str],
+    *,
+    cwd: Path = None,
+    timeout: float | None = None,
+    limits: ResourceLimits | None = None,
+    raise_if_fail: bool = True,
+) -> list[str] | None:
+    """
+    Runss the command and captures the output
+
+    Args:
+        command:  list[str]: The command to run
+        cwd:  Path: The current working directory to run the command in
+        timeout: Seconds after which the command is stopped
+        limits: Memory and CPU caps, see ResourceLimits
+
+    Returns: stdout if the command was successful, None otherwise
+
+    """
+    return run_sync(
+        run_command_async(
+            command,
+            cwd=cwd,
+            timeout=timeout,
+            limits=limits,
+            raise_if_fail=raise_if_fail,
+        )
+    )
+
+
+def run_commands(
+    commands: Sequence[tuple[list[str], Path | None]],
+    *,
+    timeout: float | None = None,
+    limits: ResourceLimits | None = None,
+    max_concurrent: int | None = None,
+    raise_if_fail: bool = True,
+) -> list[list[str] | None]:
+    """
+    Runs several (command, cwd) pairs at the same time.
+
+    Args:
+        timeout: Seconds after which each command is stopped
+        limits: Memory and CPU caps of each command
+        max_concurrent: Commands running at once, all of them if None
+        raise_if_fail: Raise the first error after every command finished.
+            Otherwise failed commands return None.
+
+    Returns: The stdout of every command, in order
+    """
+
+    async def run_all() -> list[list[str] | None]:
+        semaphore = asyncio.Semaphore(max_concurrent or len(commands) or 1)
+
+        async def run_one(command: list[str], cwd: Path | None):
+            async with semaphore:
+                return await run_command_async(
+                    command,
+                    cwd=cwd,
+                    timeout=timeout,
+                    limits=limits,
+                    raise_if_fail=True,
+                )
+
+        return await asyncio.gather(
+            *(run_one(command, cwd) for command, cwd in commands),
+            return_exceptions=True,
+        )
+
+    results = run_sync(run_all())
+
+    errors = [x for x in results if isinstance(x, BaseException)]
+    if errors and raise_if_fail:
+        raise errors[0]
+
+    return [None if isinstance(x, BaseException) else x for x in results]
@@ -0,0 +1,141 @@
+import asyncio
+import fcntl
+import os
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Iterator
+
+from pydantic import Field
+
+from proteomics.utils.base_params import BaseParams
+from proteomics.utils.cache import get_cache_dir
+
+__all__ = [
+    "SlotParams",
+    "use_slots",
+    "slot",
+    "slot_async",
+]
+
+
+class SlotParams(BaseParams):
+    enabled: bool = False
+    """Limit how many jobs of each resource class run at once on a node"""
+    limits: dict[str, int] = Field(
+        {"limma": 4, "plot": 8, "enrichment": 2},
+        description="Jobs of each resource class that may run at once, "
+        "across every task on the node. Classes not listed are not limited.",
+    )
+    lock_dir: Path | None = Field(
+        None,
+        description="Directory of the slot lock files, shared by the tasks. "
+        "None uses the cache (~/.cache/lfq-proteomics/slots).",
+    )
+    poll_interval: float = Field(
+        0.2, description="Seconds between tries for a free slot"
+    )
+
+
+# when set, slot and slot_async wait for a free slot of the resource class
+_slots: SlotParams | None = None
+
+
+@contextmanager
+def use_slots(params: SlotParams) -> Iterator[None]:
+    """
+    Limits the jobs run with slot or slot_async inside the context.
+    """
+    global _slots
+
+    previous = _slots
+    _slots = params if params.enabled else None
+    try:
+        yield
+    finally:
+        _slots = previous
+
+
+def _try_acquire(params: SlotParams, resource_class: str) -> int | None:
+    """
+    Locks one of the slot files of the class. The lock belongs to the open
+    file, so the slot is freed when the process exits, even if it crashed.
+
+    Returns: The file descriptor of the locked slot, None if all are taken
+    """
+    lock_dir = params.lock_dir or get_cache_dir("slots")
+    lock_dir.mkdir(parents=True, exist_ok=True)
+
+    n_slots = params.limits[resource_class]
+    # start at a random slot, so waiting tasks do not all try slot 0
+    start = random.randrange(n_slots)
+    for i in range(n_slots):
+        lock_file = lock_dir / f"{resource_class}.{(start + i) % n_slots}.lock"
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        return fd
+
+    return None
+
+
+def _release(fd: int) -> None:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _is_limited(params: SlotParams | None, resource_class: str) -> bool:
+    return params is not None and params.limits.get(resource_class, 0) > 0
+
+
+@asynccontextmanager
+async def slot_async(resource_class: str) -> AsyncIterator[None]:
+    """
+    Waits for a free slot of the resource class without blocking the event
+    loop, e.g. before starting an Rscript.
+    """
+    params = _slots
+    if not _is_limited(params, resource_class):
+        yield
+        return
+
+    started = time.monotonic()
+    while (fd := _try_acquire(params, resource_class)) is None:
+        await asyncio.sleep(params.poll_interval)
+    _print_waited(resource_class, started)
+
+    try:
+        yield
+    finally:
+        _release(fd)
+
+
+@contextmanager
+def slot(resource_class: str) -> Iterator[None]:
+    """
+    Same as slot_async, for jobs that run in the task's process.
+    """
+    params = _slots
+    if not _is_limited(params, resource_class):
+        yield
+        return
+
+    started = time.monotonic()
+    while (fd := _try_acquire(params, resource_class)) is None:
+        time.sleep(params.poll_interval)
+    _print_waited(resource_class, started)
+
+    try:
+        yield
+    finally:
+        _release(fd)
+
+
+def _print_waited(resource_class: str, started: float) -> None:
+    waited = time.monotonic() - started
+    if waited > 0.01:
+        print(f"Waited {waited:.1f} s for a {resource_class} slot")
@@ -0,0 +1,157 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Any, Iterable, NamedTuple
+
+from pydantic import BaseModel
+
+from proteomics.utils.base_params import BaseParams
+from proteomics.utils.cache import get_cache_dir, hash_file_cached
+
+__all__ = [
+    "StageCacheParams",
+    "StageCache",
+]
+
+CACHE_VERSION = 1
+"""Bump when a cached stage computes something different"""
+
+VALUES_FILE = "values.pkl"
+FILES_DIR = "files"
+
+PACKAGE_DIR = Path(__file__).parents[1]
+
+
+class StageCacheParams(BaseParams):
+    enabled: bool = False
+    """Serve stages whose params and inputs did not change from the cache"""
+
+
+@functools.cache
+def _source_digest() -> str:
+    """
+    The hash of the python modules and R scripts of the package, computed
+    once per process. Part of every key, so an upgraded package does not
+    restore outputs computed by the old code.
+    """
+    digest = hashlib.sha256()
+    for pattern in ("*.py", "*.R"):
+        for file in sorted(PACKAGE_DIR.rglob(pattern)):
+            digest.update(str(file.relative_to(PACKAGE_DIR)).encode())
+            digest.update(hash_file_cached(file).encode())
+    return digest.hexdigest()
+
+
+def _hash_params(params: BaseModel | str) -> str:
+    if isinstance(params, str):
+        return params
+    if isinstance(params, BaseParams):
+        return params.hash_params()
+    # plain models may hold arbitrary types, e.g. a matplotlib colormap
+    return hashlib.sha256(
+        json.dumps(params.model_dump(), default=str, sort_keys=True).encode()
+    ).hexdigest()
+
+
+class StageCache(NamedTuple):
+    """
+    The outputs of a flow step stored under a key made from the hash of the
+    step's params, the contents of its input files, the keys of the steps
+    it reads from and the source of the package. A step that finds its key in the cache copies the
+    stored files into the run directory instead of computing them again.
+    Entries live in get_cache_dir("stages", <stage>, <key>).
+    """
+
+    stage: str
+    key: str
+    enabled: bool = True
+
+    @classmethod
+    def make(
+        cls,
+        stage: str,
+        *,
+        params: Iterable[BaseModel | str | None] = (),
+        inputs: Iterable[Path | None] = (),
+        parents: Iterable["StageCache"] = (),
+        extra: Iterable[Any] = (),
+        enabled: bool = True,
+    ) -> "StageCache":
+        """
+        Args:
+            params: The params of the stage. BaseParams are hashed with
+                hash_params, a str is taken as an already computed hash.
+            inputs: The files the stage reads, hashed by contents
+            parents: The caches of the stages whose outputs this stage uses
+            extra: Anything else the outputs depend on, must be JSON
+                serializable
+            enabled: A disabled cache never hits and stores nothing. The
+                key is still computed, incremental runs compare them.
+        """
+        digest = hashlib.sha256(f"{stage}:{CACHE_VERSION}".encode())
+        digest.update(_source_digest().encode())
+        for param in params:
+            if param is not None:
+                digest.update(_hash_params(param).encode())
+        for input_file in inputs:
+            if input_file is not None:
+                digest.update(hash_file_cached(input_file).encode())
+        for parent in parents:
+            digest.update(parent.key.encode())
+        for value in extra:
+            digest.update(json.dumps(value, default=str).encode())
+
+        return cls(stage, digest.hexdigest()[:16], enabled=enabled)
+
+    @property
+    def cache_dir(self) -> Path:
+        return get_cache_dir("stages", self.stage) / self.key
+
+    def load(self, root: Path) -> dict[str, Any] | None:
+        """
+        Copies the stored files into root and returns the stored values.
+        None if the stage is not cached.
+        """
+        if not self.enabled or not (self.cache_dir / VALUES_FILE).exists():
+            return None
+
+        print(f"Restoring {self.stage} from {self.cache_dir}")
+        if (self.cache_dir / FILES_DIR).exists():
+            shutil.copytree(
+                self.cache_dir / FILES_DIR, root, dirs_exist_ok=True
+            )
+
+        with open(self.cache_dir / VALUES_FILE, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, root: Path, files: Iterable[Path], **values: Any) -> None:
+        """
+        Stores the files (somewhere under root) and the values. Paths in the
+        values should be relative to root, the run directory changes.
+        """
+        if not self.enabled:
+            return
+
+        tmp_dir = self.cache_dir.with_name(f"{self.key}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+
+        for file in files:
+            target = tmp_dir / FILES_DIR / Path(file).relative_to(root)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # a copy, files of the run may be rewritten later
+            shutil.copy2(file, target)
+
+        with open(tmp_dir / VALUES_FILE, "wb") as f:
+            pickle.dump(values, f)
+
+        try:
+            tmp_dir.rename(self.cache_dir)
+            print(f"Stored {self.stage} in {self.cache_dir}")
+        except OSError:
+            # another task stored the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
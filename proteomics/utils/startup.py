@@ -0,0 +1,401 @@
+"""
+Startup benchmark of the flow: how long the task of each step takes to
+import its modules before it runs. Every task imports the flow module, loads
+the artifacts the step reads (unpickling e.g. self.pipeline imports the
+modules of its classes), then the step imports what it uses; all three are
+timed in a fresh interpreter, e.g.
+
+    python -m proteomics.utils.startup --budget 1.0
+
+The artifacts are loaded from a finished run of the flow, the latest
+successful one unless --run is given. Without a run the artifact loads of
+the steps that read artifacts are reported as unmeasured.
+
+The join steps and end should stay well under the budget; the command exits
+with 1 if one of them is over it.
+"""
+
+import argparse
+import ast
+import json
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from proteomics.utils.cache import get_cache_dir
+
+__all__ = [
+    "STARTUP_LOG",
+    "StepStartup",
+    "step_imports",
+    "step_artifacts",
+    "time_step",
+    "find_run",
+    "record_startup",
+]
+
+STARTUP_LOG = "startup.jsonl"
+
+FLOW_FILE = Path(__file__).parents[1] / "run_analysis.py"
+
+# runs in the fresh interpreter: argv is the flow module, the task to load
+# the artifacts from and their names as JSON, then the modules of the step
+_TIMER = """
+import importlib, json, sys, time
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+flow = time.perf_counter()
+task, artifacts = json.loads(sys.argv[2])
+if task is not None:
+    from metaflow import Task, namespace
+    namespace(None)
+    task = Task(task)
+    for name in artifacts:
+        if name in task:
+            task[name].data
+loaded = time.perf_counter()
+for module in sys.argv[3:]:
+    importlib.import_module(module)
+print(json.dumps([flow - started, loaded - flow, time.perf_counter() - loaded]))
+"""
+
+
+class StepStartup(NamedTuple):
+    step: str
+    modules: list[str]
+    flow_seconds: float
+    """Importing the flow module, the same for every step"""
+    artifacts: list[str]
+    artifact_seconds: float | None
+    """Loading the artifacts the step reads, None if they were not loaded"""
+    step_seconds: float
+    """Importing the modules of the step"""
+    total_seconds: float
+    """From starting the interpreter until the step could run"""
+    bookkeeping: bool
+    """A join step or end, that should start without the analysis modules"""
+
+
+def _is_step(node: ast.FunctionDef) -> bool:
+    return any(
+        isinstance(decorator, ast.Name) and decorator.id == "step"
+        for decorator in node.decorator_list
+    )
+
+
+def _imports(node: ast.FunctionDef) -> list[str]:
+    modules = []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Import):
+            modules.extend(alias.name for alias in child.names)
+        elif isinstance(child, ast.ImportFrom) and child.module:
+            modules.append(child.module)
+    return modules
+
+
+def _self_attributes(node: ast.FunctionDef, ctx: type) -> list[str]:
+    """
+    The names of self.<name> in node, loaded or stored depending on ctx.
+    """
+    names = []
+    for child in ast.walk(node):
+        if (
+            isinstance(child, ast.Attribute)
+            and isinstance(child.ctx, ctx)
+            and isinstance(child.value, ast.Name)
+            and child.value.id == "self"
+            and child.attr not in names
+        ):
+            names.append(child.attr)
+    return names
+
+
+def _flow_methods(
+    flow_file: Path, flow_class: str
+) -> dict[str, ast.FunctionDef]:
+    tree = ast.parse(flow_file.read_text())
+    flow = next(
+        node
+        for node in tree.body
+        if isinstance(node, ast.ClassDef) and node.name == flow_class
+    )
+    return {
+        node.name: node
+        for node in flow.body
+        if isinstance(node, ast.FunctionDef)
+    }
+
+
+def _step_methods(
+    methods: dict[str, ast.FunctionDef], step: str
+) -> list[ast.FunctionDef]:
+    """
+    The step and the helper methods and properties it uses.
+    """
+    reached = []
+    todo = [step]
+    while todo:
+        method = methods[todo.pop()]
+        if method in reached:
+            continue
+        reached.append(method)
+        todo.extend(
+            name
+            for name in _self_attributes(method, ast.Load)
+            if name in methods and not _is_step(methods[name])
+        )
+    return reached
+
+
+def step_imports(
+    flow_file: Path = FLOW_FILE, flow_class: str = "ProteomicsAnalysis"
+) -> dict[str, tuple[list[str], bool]]:
+    """
+    The modules each step of the flow imports in its body or in the helper
+    methods it calls, read from the source.
+
+    Returns: step -> (modules, whether it is a join step or end)
+    """
+    methods = _flow_methods(flow_file, flow_class)
+
+    steps = {}
+    for name, node in methods.items():
+        if not _is_step(node):
+            continue
+
+        modules = []
+        for method in _step_methods(methods, name):
+            modules.extend(m for m in _imports(method) if m not in modules)
+
+        is_join = len(node.args.args) > 1
+        steps[name] = (modules, is_join or name == "end")
+
+    return steps
+
+
+def _foreach_inputs(methods: dict[str, ast.FunctionDef]) -> dict[str, str]:
+    """
+    step -> the artifact its self.input comes from, for foreach steps.
+    """
+    inputs = {}
+    for node in methods.values():
+        for child in ast.walk(node):
+            if not (
+                isinstance(child, ast.Call)
+                and isinstance(child.func, ast.Attribute)
+                and child.func.attr == "next"
+            ):
+                continue
+            foreach = next(
+                (k.value for k in child.keywords if k.arg == "foreach"), None
+            )
+            if isinstance(foreach, ast.Constant) and child.args:
+                target = child.args[0]
+                if isinstance(target, ast.Attribute):
+                    inputs[target.attr] = foreach.value
+    return inputs
+
+
+def step_artifacts(
+    flow_file: Path = FLOW_FILE, flow_class: str = "ProteomicsAnalysis"
+) -> dict[str, list[str]]:
+    """
+    The artifacts each step reads from the steps before it, in its body or
+    in the helper methods and properties it uses, read from the source.
+    Artifacts the step sets itself are left out. self.input of a
+    foreach step is the artifact the foreach runs over.
+
+    Returns: step -> artifact names
+    """
+    methods = _flow_methods(flow_file, flow_class)
+    artifacts = {
+        name
+        for node in methods.values()
+        for name in _self_attributes(node, ast.Store)
+    }
+    foreach_inputs = _foreach_inputs(methods)
+
+    steps = {}
+    for name, node in methods.items():
+        if not _is_step(node):
+            continue
+
+        step_methods = _step_methods(methods, name)
+        stores = {
+            attr
+            for method in step_methods
+            for attr in _self_attributes(method, ast.Store)
+        }
+        reads = []
+        for method in step_methods:
+            for attr in _self_attributes(method, ast.Load):
+                if attr == "input" and name in foreach_inputs:
+                    attr = foreach_inputs[name]
+                if (
+                    attr in artifacts
+                    and attr not in stores
+                    and attr not in reads
+                ):
+                    reads.append(attr)
+        steps[name] = reads
+
+    return steps
+
+
+def time_step(
+    step: str,
+    modules: list[str],
+    *,
+    artifacts: list[str] = (),
+    task: str | None = None,
+    bookkeeping: bool = False,
+    flow_module: str = "proteomics.run_analysis",
+    repeat: int = 3,
+) -> StepStartup:
+    """
+    Times the imports of a step in a fresh interpreter, the fastest of
+    repeat runs.
+
+    Args:
+        artifacts: The artifacts the step reads, loaded from task
+        task: The pathspec of a task of the step in a finished run. None
+            leaves the artifacts unmeasured.
+    """
+    artifacts = list(artifacts)
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                _TIMER,
+                flow_module,
+                json.dumps([task, artifacts]),
+                *modules,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        total = time.perf_counter() - started
+        runs.append((total, *json.loads(output.splitlines()[-1])))
+
+    total, flow_seconds, artifact_seconds, step_seconds = min(runs)
+    if task is None and artifacts:
+        artifact_seconds = None
+    return StepStartup(
+        step,
+        modules,
+        flow_seconds,
+        artifacts,
+        artifact_seconds,
+        step_seconds,
+        total,
+        bookkeeping,
+    )
+
+
+def find_run(run: str | None, flow_class: str = "ProteomicsAnalysis"):
+    """
+    The metaflow run to load the artifacts from: run (a pathspec like
+    ProteomicsAnalysis/<id>), or the latest successful run of the flow.
+    None if there is no such run.
+    """
+    from metaflow import Flow, Run, namespace
+    from metaflow.exception import MetaflowException
+
+    namespace(None)
+    try:
+        if run is not None:
+            return Run(run)
+        return Flow(flow_class).latest_successful_run
+    except MetaflowException as e:
+        print(f"No run to load the artifacts from: {e}")
+        return None
+
+
+def record_startup(times: list[StepStartup]) -> None:
+    """
+    Appends the times to the startup log in the cache
+    (get_cache_dir("startup")/startup.jsonl), to follow them across
+    changes.
+    """
+    now = datetime.now().isoformat()
+    with open(get_cache_dir("startup") / STARTUP_LOG, "a") as f:
+        for startup in times:
+            f.write(json.dumps({"time": now, **startup._asdict()}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1.0,
+        help="Seconds the join steps and end may take to start",
+    )
+    parser.add_argument(
+        "--steps", nargs="*", default=None, help="Only time these steps"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--run",
+        default=None,
+        help="The run (ProteomicsAnalysis/<id>) to load the artifacts from. "
+        "The latest successful run if not given.",
+    )
+    args = parser.parse_args()
+
+    run = find_run(args.run)
+    artifacts = step_artifacts()
+    times = []
+    for step, (modules, bookkeeping) in step_imports().items():
+        if args.steps is not None and step not in args.steps:
+            continue
+        task = None
+        if run is not None and artifacts[step] and step in run:
+            task = run[step].task.pathspec
+        times.append(
+            time_step(
+                step,
+                modules,
+                artifacts=artifacts[step],
+                task=task,
+                bookkeeping=bookkeeping,
+                repeat=args.repeat,
+            )
+        )
+    record_startup(times)
+
+    print(f"{'step':<28}{'flow':>8}{'load':>12}{'step':>8}{'total':>8}")
+    over = []
+    for startup in sorted(times, key=lambda t: t.total_seconds):
+        flag = ""
+        if startup.bookkeeping and startup.total_seconds > args.budget:
+            flag = "  over budget"
+            over.append(startup.step)
+        load = (
+            "unmeasured"
+            if startup.artifact_seconds is None
+            else f"{startup.artifact_seconds:.2f}"
+        )
+        print(
+            f"{startup.step:<28}{startup.flow_seconds:>8.2f}{load:>12}"
+            f"{startup.step_seconds:>8.2f}{startup.total_seconds:>8.2f}"
+            f"{flag}"
+        )
+
+    if over:
+        print(f"Over the {args.budget} s budget: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()